@@ -0,0 +1,129 @@
+import json
+import os
+import threading
+
+from datetime import datetime, timedelta, timezone
+from typing import Callable
+
+from metrics import METRICS
+from zaptec_client import ZaptecClient
+
+
+DEFAULT_ACCESS_TOKEN_CACHE_FILE_PATH = os.path.join(
+    os.path.expanduser('~'), '.cache', 'zaptecbilling', 'access-tokens.json')
+
+# Access tokens are refreshed this long before they expire, so that no request is sent with an expired token.
+ACCESS_TOKEN_REFRESH_MARGIN_TIMEDELTA = timedelta(minutes=5)
+
+
+def fetch_access_token(
+        client: ZaptecClient,
+        username: str,
+        password: str) -> tuple[str, datetime]:
+    # Returns the access token, together with when it expires.
+    AUTH_PATH = '/oauth/token'
+    ACCESS_TOKEN_KEY = 'access_token'
+    EXPIRES_IN_KEY = 'expires_in'
+
+    data = {
+        'grant_type': 'password',
+        'username': username,
+        'password': password,
+    }
+
+    # The lifetime is counted from before the request, so the expiry is never later than the server's.
+    requested_at = datetime.now(timezone.utc)
+    response_json = client.post_json(AUTH_PATH, data=data)
+    assert ACCESS_TOKEN_KEY in response_json,\
+        'access token not in auth response json: %s.' % (response_json,)
+    assert EXPIRES_IN_KEY in response_json,\
+        'access token expiry not in auth response json: %s.' % ({k: v for k, v in response_json.items() if k != ACCESS_TOKEN_KEY},)
+
+    return response_json[ACCESS_TOKEN_KEY], requested_at + timedelta(seconds=response_json[EXPIRES_IN_KEY])
+
+
+class AccessTokenManager:
+    # Hands out a valid access token for one account, and only calls the auth endpoint when there is no
+    # cached token that stays valid for at least the refresh margin. The tokens are cached in memory and,
+    # optionally, in a file shared by all the runs and processes of the same user, keyed by API and username.
+    # The password is only asked for, with get_password(), when a token needs to be fetched.
+    ACCESS_TOKEN_KEY = 'AccessToken'
+    EXPIRES_AT_KEY = 'ExpiresAt'
+
+    def __init__(
+            self,
+            client: ZaptecClient,
+            username: str,
+            get_password: Callable[[], str],
+            optional_cache_file_path: str | None = DEFAULT_ACCESS_TOKEN_CACHE_FILE_PATH,
+            refresh_margin: timedelta = ACCESS_TOKEN_REFRESH_MARGIN_TIMEDELTA):
+        self.client = client
+        self.username = username
+        self.get_password = get_password
+        self.optional_cache_file_path = optional_cache_file_path
+        self.refresh_margin = refresh_margin
+        self.cache_key = '%s %s' % (client.base_url, username)
+
+        self.optional_password = None
+        self.optional_access_token = None
+        self.optional_expires_at = None
+        self.num_fetched_access_tokens = 0
+        self.lock = threading.Lock()
+
+
+    def _is_valid(self) -> bool:
+        return self.optional_access_token is not None\
+            and datetime.now(timezone.utc) + self.refresh_margin < self.optional_expires_at
+
+
+    def _read_cache_file(self) -> dict:
+        if self.optional_cache_file_path is None or not os.path.exists(self.optional_cache_file_path):
+            return {}
+        with open(self.optional_cache_file_path) as cache_file:
+            return json.load(cache_file)
+
+
+    def _write_cache_file(self) -> None:
+        if self.optional_cache_file_path is None:
+            return
+        # Keep the tokens of the other accounts, and of the other processes, that are still valid.
+        now = datetime.now(timezone.utc)
+        cache_json = {k: v for k, v in self._read_cache_file().items()
+            if now < datetime.fromisoformat(v[AccessTokenManager.EXPIRES_AT_KEY])}
+        cache_json[self.cache_key] = {
+            AccessTokenManager.ACCESS_TOKEN_KEY: self.optional_access_token,
+            AccessTokenManager.EXPIRES_AT_KEY: self.optional_expires_at.isoformat(),
+        }
+
+        os.makedirs(os.path.dirname(self.optional_cache_file_path) or '.', exist_ok=True)
+        temporary_file_path = '%s.%d.tmp' % (self.optional_cache_file_path, os.getpid())
+        # The tokens are credentials, so only the user can read them.
+        with open(os.open(temporary_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as cache_file:
+            json.dump(cache_json, cache_file, indent=2)
+        os.replace(temporary_file_path, self.optional_cache_file_path)
+
+
+    def get_access_token(self) -> str:
+        with self.lock:
+            if self._is_valid():
+                return self.optional_access_token
+
+            # Another run, or another process of a batch, might have fetched a token in the meantime.
+            optional_cached_token_json = self._read_cache_file().get(self.cache_key)
+            if optional_cached_token_json is not None:
+                self.optional_access_token = optional_cached_token_json[AccessTokenManager.ACCESS_TOKEN_KEY]
+                self.optional_expires_at = datetime.fromisoformat(optional_cached_token_json[AccessTokenManager.EXPIRES_AT_KEY])
+                if self._is_valid():
+                    return self.optional_access_token
+
+            if self.optional_password is None:
+                self.optional_password = self.get_password()
+            with METRICS.stage('access_token', nested=False):
+                self.optional_access_token, self.optional_expires_at = fetch_access_token(
+                    client=self.client,
+                    username=self.username,
+                    password=self.optional_password)
+            self.num_fetched_access_tokens += 1
+            METRICS.increment('access_token_fetches')
+            self._write_cache_file()
+            return self.optional_access_token
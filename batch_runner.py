@@ -0,0 +1,340 @@
+import argparse
+import json
+import os
+import re
+import tempfile
+import timeit
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack, redirect_stderr, redirect_stdout
+from datetime import datetime, time, timedelta
+from enum import Enum
+from getpass import getpass
+from typing import Callable
+
+from access_token_cache import DEFAULT_ACCESS_TOKEN_CACHE_FILE_PATH, AccessTokenManager
+from chargehistory_validation import ValidationLevel
+from common import HighRateInterval, UsageInterval
+from energy_rate_decisions import MissingEnergyDetailsMode
+from metrics import METRICS
+from usage_fetcher import DEFAULT_MAX_CONCURRENT_REQUESTS, fetch_usage
+from usage_processor import process_usage
+from zaptec_client import ZAPTEC_API_BASE_URL, RateLimiter, RateLimiterManager, ZaptecClient
+
+
+# The workers can't fetch access tokens, so the batch starts with tokens that stay valid at least this long.
+BATCH_ACCESS_TOKEN_MIN_VALIDITY_TIMEDELTA = timedelta(hours=1)
+
+
+class ManifestKey(str, Enum):
+    DEFAULTS = 'Defaults'
+    JOBS = 'Jobs'
+
+
+class JobKey(str, Enum):
+    NAME = 'Name'
+    USERNAME = 'Username'
+    INSTALLATION_ID = 'InstallationId'
+    USAGE_INTERVAL_START = 'UsageIntervalStart'
+    USAGE_INTERVAL_END = 'UsageIntervalEnd'
+    NUM_CHARGING_STATIONS = 'NumChargingStations'
+    CHARGEHISTORY_FILE_NAME = 'ChargehistoryFileName'
+    EXCEL_FILE_NAME = 'ExcelFileName'
+    WEEKDAY_HIGH_RATE_INTERVAL = 'WeekdayHighRateInterval'
+    SATURDAY_HIGH_RATE_INTERVAL = 'SaturdayHighRateInterval'
+    ENERGY_RATE_DECISIONS_FILE = 'EnergyRateDecisionsFile'
+    DAILY_ENERGY_STORE_FILE = 'DailyEnergyStoreFile'
+    TARIFF_FILE = 'TariffFile'
+
+
+OPTIONAL_JOB_KEYS = frozenset([
+    JobKey.WEEKDAY_HIGH_RATE_INTERVAL,
+    JobKey.SATURDAY_HIGH_RATE_INTERVAL,
+    JobKey.ENERGY_RATE_DECISIONS_FILE,
+    JobKey.DAILY_ENERGY_STORE_FILE,
+    JobKey.TARIFF_FILE,
+])
+
+
+def _parse_optional_high_rate_interval(optional_times: list[str] | None) -> HighRateInterval | None:
+    if optional_times is None:
+        return None
+    assert len(optional_times) == 2,\
+        'expected a high-rate interval to be a [start, end] pair, but it was: %s.' % (optional_times,)
+    return HighRateInterval(time.fromisoformat(optional_times[0]), time.fromisoformat(optional_times[1]))
+
+
+class BatchJob:
+    # One installation and usage interval of a manifest. The file paths are relative to the manifest.
+    def __init__(self, job_json: dict, manifest_dir: str):
+        for k in JobKey:
+            if k in OPTIONAL_JOB_KEYS:
+                continue
+            assert k.value in job_json, 'Missing batch job key: %s, in job: %s.' % (k.value, job_json)
+        unknown_keys = set(job_json) - set(k.value for k in JobKey)
+        assert len(unknown_keys) == 0, 'Unknown batch job keys: %s, in job: %s.' % (sorted(unknown_keys), job_json)
+
+        def resolve_path(optional_path: str | None) -> str | None:
+            return os.path.join(manifest_dir, optional_path) if optional_path is not None else None
+
+        self.name = job_json[JobKey.NAME]
+        self.username = job_json[JobKey.USERNAME]
+        self.installation_id = job_json[JobKey.INSTALLATION_ID]
+        self.usage_interval_start = datetime.fromisoformat(job_json[JobKey.USAGE_INTERVAL_START])
+        self.usage_interval_end = datetime.fromisoformat(job_json[JobKey.USAGE_INTERVAL_END])
+        self.num_charging_stations = job_json[JobKey.NUM_CHARGING_STATIONS]
+        self.chargehistory_file_name = resolve_path(job_json[JobKey.CHARGEHISTORY_FILE_NAME])
+        self.excel_file_name = resolve_path(job_json[JobKey.EXCEL_FILE_NAME])
+        self.optional_weekday_high_rate_interval = _parse_optional_high_rate_interval(
+            job_json.get(JobKey.WEEKDAY_HIGH_RATE_INTERVAL))
+        self.optional_saturday_high_rate_interval = _parse_optional_high_rate_interval(
+            job_json.get(JobKey.SATURDAY_HIGH_RATE_INTERVAL))
+        self.optional_energy_rate_decisions_file_path = resolve_path(job_json.get(JobKey.ENERGY_RATE_DECISIONS_FILE))
+        self.optional_daily_energy_store_file_path = resolve_path(job_json.get(JobKey.DAILY_ENERGY_STORE_FILE))
+        self.optional_tariff_file_path = resolve_path(job_json.get(JobKey.TARIFF_FILE))
+
+        # Fail on an invalid interval before anything runs.
+        UsageInterval(self.usage_interval_start, self.usage_interval_end)
+
+
+def read_manifest(manifest_file_path: str) -> list[BatchJob]:
+    with open(manifest_file_path) as manifest_file:
+        manifest_json = json.load(manifest_file)
+
+    manifest_dir = os.path.dirname(manifest_file_path)
+    defaults = manifest_json.get(ManifestKey.DEFAULTS, {})
+    jobs = [BatchJob({**defaults, **job_json}, manifest_dir) for job_json in manifest_json[ManifestKey.JOBS]]
+
+    job_names = [j.name for j in jobs]
+    duplicate_job_names = set(n for n in job_names if job_names.count(n) > 1)
+    assert len(duplicate_job_names) == 0, 'Duplicate batch job names: %s.' % (sorted(duplicate_job_names),)
+    return jobs
+
+
+def get_log_file_name(job_index: int, job_name: str) -> str:
+    # Job names are free text, e.g. with slashes, so the log file is named after the position of the job in the
+    # manifest, which keeps it unique, and the job name only with the characters that are safe in file names.
+    return '%03d-%s.log' % (job_index + 1, re.sub(r'[^\w.-]+', '_', job_name))
+
+
+class BatchJobResult:
+    def __init__(self, name: str, elapsed_seconds: float, optional_error: str | None, log_file_path: str):
+        self.name = name
+        self.elapsed_seconds = elapsed_seconds
+        self.optional_error = optional_error
+        self.log_file_path = log_file_path
+
+
+def run_batch_job(
+        job: BatchJob,
+        fetch: bool,
+        rate_limiter: RateLimiter,
+        log_file_path: str,
+        max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS,
+        optional_cache_dir: str | None = None,
+        overwrite: bool = False,
+        optional_access_token_cache_file_path: str | None = DEFAULT_ACCESS_TOKEN_CACHE_FILE_PATH,
+        validation_level: ValidationLevel = ValidationLevel.STRICT,
+        base_url: str = ZAPTEC_API_BASE_URL) -> BatchJobResult:
+    # Runs in a worker process. The output of the job goes to its own log file, and its failure is
+    # reported in the result instead of being raised, so that it doesn't affect the other jobs.
+    # The workers never get the passwords: they reuse the access tokens that run_batch() cached, and nobody
+    # can be asked for a password afterwards.
+    def get_password() -> str:
+        assert False, 'the cached access token of %s expired during the batch; run it again to fetch a new one.' % (
+            job.username,)
+
+    start_time = timeit.default_timer()
+    optional_error = None
+    with open(log_file_path, 'w') as log_file, redirect_stdout(log_file), redirect_stderr(log_file):
+        try:
+            usage_interval = UsageInterval(job.usage_interval_start, job.usage_interval_end)
+            if fetch:
+                fetch_usage(
+                    username=job.username,
+                    get_password=get_password,
+                    installation_id=job.installation_id,
+                    usage_interval=usage_interval,
+                    num_charging_stations=job.num_charging_stations,
+                    output_chargehistory_file_name=job.chargehistory_file_name,
+                    max_concurrent_requests=max_concurrent_requests,
+                    optional_cache_dir=optional_cache_dir,
+                    optional_rate_limiter=rate_limiter,
+                    optional_overwrite=overwrite,
+                    optional_access_token_cache_file_path=optional_access_token_cache_file_path,
+                    base_url=base_url)
+            process_usage(
+                chargehistory_file_path=job.chargehistory_file_name,
+                usage_interval=usage_interval,
+                output_excel_file_name=job.excel_file_name,
+                weekday_high_rate_interval=job.optional_weekday_high_rate_interval,
+                saturday_high_rate_interval=job.optional_saturday_high_rate_interval,
+                # Nobody can answer prompts in a batch.
+                missing_energy_details_mode=MissingEnergyDetailsMode.RULES,
+                optional_energy_rate_decisions_file_path=job.optional_energy_rate_decisions_file_path,
+                validation_level=validation_level,
+                optional_daily_energy_store_file_path=job.optional_daily_energy_store_file_path,
+                optional_installation_id=job.installation_id,
+                optional_tariff_file_path=job.optional_tariff_file_path)
+        except (Exception, SystemExit) as e:
+            traceback.print_exc()
+            optional_error = '%s: %s' % (type(e).__name__, e)
+    return BatchJobResult(job.name, timeit.default_timer() - start_time, optional_error, log_file_path)
+
+
+def run_batch(
+        jobs: list[BatchJob],
+        optional_get_password: Callable[[str], str] | None,
+        log_dir: str,
+        max_workers: int,
+        max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS,
+        optional_cache_dir: str | None = None,
+        overwrite: bool = False,
+        optional_access_token_cache_file_path: str | None = DEFAULT_ACCESS_TOKEN_CACHE_FILE_PATH,
+        validation_level: ValidationLevel = ValidationLevel.STRICT,
+        base_url: str = ZAPTEC_API_BASE_URL) -> list[BatchJobResult]:
+    # Without optional_get_password(username), the jobs only process the chargehistory files that were
+    # already fetched.
+    assert max_workers > 0, 'the maximum number of workers needs to be > 0, but it was: %d.' % (max_workers,)
+    os.makedirs(log_dir, exist_ok=True)
+    job_to_log_file_path = {j: os.path.join(log_dir, get_log_file_name(i, j.name)) for i, j in enumerate(jobs)}
+
+    results = []
+    with ExitStack() as exit_stack:
+        rate_limiter_manager = exit_stack.enter_context(RateLimiterManager())
+        # All the workers share one rate limit, because it applies to the API account, not to a process.
+        rate_limiter = rate_limiter_manager.RateLimiter()
+
+        # Each account authenticates once, here, and the workers reuse its cached access token. The password
+        # is only asked for if there is no valid cached access token. Without a cache file, the tokens are
+        # cached in a temporary one, readable only by the user, for the duration of the batch.
+        if optional_get_password is not None:
+            if optional_access_token_cache_file_path is None:
+                optional_access_token_cache_file_path = os.path.join(
+                    exit_stack.enter_context(tempfile.TemporaryDirectory()), 'access-tokens.json')
+            with ZaptecClient(base_url=base_url, rate_limiter=rate_limiter) as client:
+                for username in sorted(set(j.username for j in jobs)):
+                    AccessTokenManager(
+                        client=client,
+                        username=username,
+                        get_password=lambda: optional_get_password(username),
+                        optional_cache_file_path=optional_access_token_cache_file_path,
+                        refresh_margin=BATCH_ACCESS_TOKEN_MIN_VALIDITY_TIMEDELTA).get_access_token()
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            future_to_job = {
+                executor.submit(
+                    run_batch_job,
+                    job=job,
+                    fetch=optional_get_password is not None,
+                    rate_limiter=rate_limiter,
+                    log_file_path=job_to_log_file_path[job],
+                    max_concurrent_requests=max_concurrent_requests,
+                    optional_cache_dir=optional_cache_dir,
+                    overwrite=overwrite,
+                    optional_access_token_cache_file_path=optional_access_token_cache_file_path,
+                    validation_level=validation_level,
+                    base_url=base_url): job
+                for job in jobs}
+
+            for future in as_completed(future_to_job):
+                job = future_to_job[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # E.g. the worker process died.
+                    result = BatchJobResult(job.name, 0.0, '%s: %s' % (type(e).__name__, e), job_to_log_file_path[job])
+                print('%s %s (%.1f s)%s' % (
+                    'FAILED' if result.optional_error is not None else 'OK',
+                    result.name,
+                    result.elapsed_seconds,
+                    ': %s' % (result.optional_error,) if result.optional_error is not None else ''))
+                results.append(result)
+
+        # The workers sleep for the shared rate limit in the manager process, so the parent reports it.
+        num_rate_limit_sleeps, rate_limit_sleep_seconds = rate_limiter.get_sleep_counters()
+        METRICS.increment('rate_limit_sleeps', num_rate_limit_sleeps)
+        METRICS.increment('rate_limit_sleep_seconds', rate_limit_sleep_seconds)
+        print('Rate limit: %d sleep(s), %.1f s in total.' % (num_rate_limit_sleeps, rate_limit_sleep_seconds))
+
+    # In the order of the manifest.
+    job_name_to_index = {j.name: i for i, j in enumerate(jobs)}
+    return sorted(results, key=lambda r: job_name_to_index[r.name])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Fetch and process the usage of several installations, as listed in a manifest, in parallel.')
+
+    parser.add_argument(
+        'manifest_file_path',
+        help='the path to the JSON manifest of the batch jobs; see \'manifest.json.tmpl\'')
+    parser.add_argument(
+        '--max_workers',
+        type=int,
+        default=os.cpu_count() or 1,
+        help='the maximum number of jobs that run at the same time, each in its own process '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '--max_concurrent_requests',
+        type=int,
+        default=DEFAULT_MAX_CONCURRENT_REQUESTS,
+        help='the maximum number of chargehistory pages fetched concurrently by each job; the API rate limit '
+        'is shared by all the jobs (default: %(default)s)')
+    parser.add_argument(
+        '--cache_dir',
+        help='a directory in which to cache the fetched charge sessions across runs, per installation')
+    parser.add_argument(
+        '--log_dir',
+        default='batch-logs',
+        help='the directory in which the output of each job is written, to \'<job number>-<job name>.log\' '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '--process_only',
+        action='store_true',
+        help='don\'t fetch anything, only process the chargehistory files that were already fetched')
+    parser.add_argument(
+        '--overwrite',
+        action='store_true',
+        help='overwrite the chargehistory files that already exist; otherwise, their jobs fail')
+    parser.add_argument(
+        '--access_token_cache_file',
+        default=DEFAULT_ACCESS_TOKEN_CACHE_FILE_PATH,
+        help='the file in which the Zaptec API access tokens are cached across runs, readable only by the '
+        'current user; an empty path disables it (default: %(default)s)')
+    parser.add_argument(
+        '--validation',
+        type=ValidationLevel,
+        choices=[v.value for v in ValidationLevel],
+        default=ValidationLevel.STRICT.value,
+        help='how much of each chargehistory to validate before processing it, see \'usage_processor.py\' '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '--base_url',
+        default=ZAPTEC_API_BASE_URL,
+        help='the base URL of the Zaptec API, e.g. of a local \'fake_zaptec_server.py\' for tests and '
+        'benchmarks (default: %(default)s)')
+
+    args = parser.parse_args()
+
+    jobs = read_manifest(args.manifest_file_path)
+
+    results = run_batch(
+        jobs=jobs,
+        optional_get_password=(lambda username: getpass('Password for %s: ' % (username,)))
+            if not args.process_only else None,
+        log_dir=args.log_dir,
+        max_workers=args.max_workers,
+        max_concurrent_requests=args.max_concurrent_requests,
+        optional_cache_dir=args.cache_dir,
+        overwrite=args.overwrite,
+        optional_access_token_cache_file_path=args.access_token_cache_file or None,
+        validation_level=args.validation,
+        base_url=args.base_url)
+
+    failed_results = [r for r in results if r.optional_error is not None]
+    print('%d of %d job(s) succeeded.' % (len(results) - len(failed_results), len(results)))
+    for result in failed_results:
+        print('  %s failed, see %s: %s' % (result.name, result.log_file_path, result.optional_error))
+    exit(1 if len(failed_results) > 0 else 0)
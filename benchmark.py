@@ -0,0 +1,241 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import timeit
+import tracemalloc
+
+from datetime import datetime, time, timedelta, timezone
+
+from chargehistory_generator import add_generator_arguments, generate_chargehistory_sessions_from_args,\
+    write_chargehistory_json
+from chargehistory_io import is_chargehistory_npz, read_chargehistory_npz, read_chargehistory_sessions,\
+    write_chargehistory_npz
+from chargehistory_validation import ChargehistoryValidator, ValidationLevel
+from common import HighRateInterval, UsageInterval, parse_fixed_point_energy
+from energy_rate_decisions import EnergyRateResolver, MissingEnergyDetailsMode
+from usage_processor import EnergyDetailBatch, collect_energy_detail_batch_from_columns,\
+    collect_energy_detail_batch_from_sessions, compute_energy_details_df, compute_summary_df, get_export_stage_name,\
+    make_weekday_to_optional_high_rate_interval, resolve_energy_rates, write_usage_excel
+from table_export import ExportFormat
+from tariff import Tariff, make_high_rate_tariff
+
+
+BENCHMARK_RESULTS_VERSION = 1
+
+
+class Stage:
+    # A stage of process_usage(): run(input) returns the input of the next stage.
+    def __init__(self, name: str, run):
+        self.name = name
+        self.run = run
+
+
+def make_stages(
+        chargehistory_file_path: str,
+        usage_interval: UsageInterval,
+        tariff: Tariff,
+        output_excel_file_name: str,
+        validation_level: ValidationLevel = ValidationLevel.STRICT,
+        export_format: ExportFormat = ExportFormat.EXCEL) -> list[Stage]:
+    def resolve(energy_detail_batch: EnergyDetailBatch) -> EnergyDetailBatch:
+        # Charge sessions without energy details can't be prompted for in a benchmark.
+        resolve_energy_rates(
+            energy_detail_batch, usage_interval, EnergyRateResolver(MissingEnergyDetailsMode.RULES, tariff))
+        return energy_detail_batch
+
+    if is_chargehistory_npz(chargehistory_file_path):
+        load = Stage('load', lambda _: read_chargehistory_npz(chargehistory_file_path))
+        session_parsing = Stage('session_parsing', lambda columns: resolve(collect_energy_detail_batch_from_columns(
+            columns, usage_interval, ChargehistoryValidator(validation_level))))
+    else:
+        load = Stage('load', lambda _: list(
+            read_chargehistory_sessions(chargehistory_file_path, parse_float=parse_fixed_point_energy)))
+        session_parsing = Stage('session_parsing', lambda charge_session_jsons: resolve(
+            collect_energy_detail_batch_from_sessions(
+                charge_session_jsons, usage_interval, ChargehistoryValidator(validation_level))))
+
+    return [
+        load,
+        session_parsing,
+        Stage('rate_classification', lambda energy_detail_batch: compute_energy_details_df(
+            energy_detail_batch, usage_interval, tariff)),
+        Stage('pivot', lambda energy_details_df: (compute_summary_df(energy_details_df), energy_details_df)),
+        Stage(get_export_stage_name(export_format), lambda dfs: write_usage_excel(
+            dfs[0], dfs[1], output_excel_file_name, tariff, export_format=export_format)),
+    ]
+
+
+def run_stages(stages: list[Stage], num_repeats: int) -> dict:
+    # Each stage is timed num_repeats times on the output of the previous stage, and then run once more under
+    # tracemalloc for its peak memory, which is measured separately because tracing slows everything down.
+    stage_results = {}
+    stage_input = None
+    for stage in stages:
+        seconds = []
+        for _ in range(num_repeats):
+            start_time = timeit.default_timer()
+            stage_output = stage.run(stage_input)
+            seconds.append(timeit.default_timer() - start_time)
+
+        tracemalloc.start()
+        try:
+            stage.run(stage_input)
+            _, peak_memory_bytes = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        stage_results[stage.name] = {
+            'Seconds': seconds,
+            'MinSeconds': min(seconds),
+            'MedianSeconds': statistics.median(seconds),
+            'PeakMemoryBytes': peak_memory_bytes,
+        }
+        stage_input = stage_output
+    return stage_results
+
+
+def get_optional_git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def find_optional_previous_results(results_file_path: str, input_description: dict) -> dict | None:
+    # The latest earlier run on the same input.
+    if not os.path.exists(results_file_path):
+        return None
+    optional_previous_results = None
+    with open(results_file_path) as results_file:
+        for line in results_file:
+            results = json.loads(line)
+            if results['Version'] == BENCHMARK_RESULTS_VERSION and results['Input'] == input_description:
+                optional_previous_results = results
+    return optional_previous_results
+
+
+def print_results(results: dict, optional_previous_results: dict | None) -> None:
+    print('%-20s %12s %12s %16s' % ('stage', 'min (s)', 'median (s)', 'peak memory (MB)'))
+    for stage_name, stage_results in results['Stages'].items():
+        line = '%-20s %12.4f %12.4f %16.1f' % (
+            stage_name,
+            stage_results['MinSeconds'],
+            stage_results['MedianSeconds'],
+            stage_results['PeakMemoryBytes'] / 1e6)
+
+        optional_previous_stage_results = optional_previous_results['Stages'].get(stage_name)\
+            if optional_previous_results is not None else None
+        if optional_previous_stage_results is not None:
+            line += '   time x%.2f, memory x%.2f vs. %s' % (
+                stage_results['MinSeconds'] / max(optional_previous_stage_results['MinSeconds'], 1e-9),
+                stage_results['PeakMemoryBytes'] / max(optional_previous_stage_results['PeakMemoryBytes'], 1),
+                (optional_previous_results['GitCommit'] or '?')[:10])
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Time and memory-profile each stage of \'usage_processor.py\' on a synthetic (or given) '
+        'chargehistory, and append the results to a JSON Lines file, to compare them run to run.')
+
+    parser.add_argument(
+        '--chargehistory_file_path',
+        help='the chargehistory to process, in JSON or .npz format; if unspecified, one is generated with '
+        'the generator arguments below')
+    parser.add_argument(
+        '--npz',
+        action='store_true',
+        help='convert the generated chargehistory to the columnar .npz format')
+    parser.add_argument(
+        '--usage_interval_start',
+        type=datetime.fromisoformat,
+        help='the start of the usage interval; if unspecified, 31 days after the start of the generated history')
+    parser.add_argument(
+        '--usage_interval_end',
+        type=datetime.fromisoformat,
+        help='the end of the usage interval; if unspecified, 31 days before the end of the generated history')
+    parser.add_argument(
+        '--num_repeats',
+        type=int,
+        default=3,
+        help='how many times each stage is timed (default: %(default)s)')
+    parser.add_argument(
+        '--results_file',
+        default='benchmark-results.jsonl',
+        help='the JSON Lines file to which the results of this run are appended; they are compared with '
+        'the latest earlier run on the same input (default: %(default)s)')
+    parser.add_argument(
+        '--validation',
+        type=ValidationLevel,
+        choices=[v.value for v in ValidationLevel],
+        default=ValidationLevel.STRICT.value,
+        help='how much of the chargehistory to validate while parsing it (default: %(default)s)')
+    parser.add_argument(
+        '--export_format',
+        type=ExportFormat,
+        choices=[f.value for f in ExportFormat],
+        default=ExportFormat.EXCEL.value,
+        help='the format of the export stage, see \'usage_processor.py\' (default: %(default)s)')
+    add_generator_arguments(parser)
+
+    args = parser.parse_args()
+    assert args.num_repeats > 0, 'the number of repeats needs to be > 0, but it was: %d.' % (args.num_repeats,)
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        if args.chargehistory_file_path is not None:
+            chargehistory_file_path = args.chargehistory_file_path
+            input_description = {'ChargehistoryFilePath': os.path.abspath(chargehistory_file_path)}
+        else:
+            chargehistory_file_path = os.path.join(temporary_dir, 'chargehistory.npz' if args.npz else 'chargehistory.json')
+            if args.npz:
+                write_chargehistory_npz(generate_chargehistory_sessions_from_args(args), chargehistory_file_path)
+            else:
+                write_chargehistory_json(generate_chargehistory_sessions_from_args(args), chargehistory_file_path)
+            input_description = {
+                'Generator': {k: str(v) for k, v in sorted(vars(args).items()) if k in (
+                    'start_date', 'num_years', 'num_devices', 'sessions_per_day', 'energy_details_interval_minutes',
+                    'dst_crossing_sessions_per_transition', 'missing_energy_details_fraction', 'seed', 'npz')},
+            }
+
+        history_start = datetime.combine(args.start_date, time())
+        history_end = history_start + timedelta(days=round(365.25 * args.num_years))
+        usage_interval_start = args.usage_interval_start or history_start + timedelta(days=31)
+        usage_interval_end = args.usage_interval_end or history_end - timedelta(days=31)
+        usage_interval = UsageInterval(usage_interval_start, usage_interval_end)
+        input_description['UsageInterval'] = [usage_interval_start.isoformat(), usage_interval_end.isoformat()]
+        input_description['ChargehistoryFileSizeBytes'] = os.path.getsize(chargehistory_file_path)
+        input_description['Validation'] = args.validation.value
+
+        stages = make_stages(
+            chargehistory_file_path=chargehistory_file_path,
+            usage_interval=usage_interval,
+            tariff=make_high_rate_tariff(make_weekday_to_optional_high_rate_interval(
+                HighRateInterval(time(7), time(20)), HighRateInterval(time(7), time(13)))),
+            output_excel_file_name=os.path.join(
+                temporary_dir, 'output.xlsx' if args.export_format == ExportFormat.EXCEL else 'output'),
+            validation_level=args.validation,
+            export_format=args.export_format)
+        results = {
+            'Version': BENCHMARK_RESULTS_VERSION,
+            'CreatedAt': datetime.now(timezone.utc).isoformat(),
+            'GitCommit': get_optional_git_commit(),
+            'Python': platform.python_version(),
+            'Platform': platform.platform(),
+            'Input': input_description,
+            'NumRepeats': args.num_repeats,
+            'Stages': run_stages(stages, args.num_repeats),
+        }
+
+    optional_previous_results = find_optional_previous_results(args.results_file, input_description)
+    print_results(results, optional_previous_results)
+    with open(args.results_file, 'a') as results_file:
+        results_file.write(json.dumps(results) + '\n')
@@ -0,0 +1,115 @@
+import json
+import os
+import pytz
+
+from datetime import datetime, timedelta
+
+from common import ChargeSession, UsageInterval
+
+
+# Sessions that started less than this long before a fetch might not be reported by the API yet.
+SETTLE_TIMEDELTA = timedelta(days=1)
+
+
+def get_charge_session_key(charge_session: dict) -> str:
+    ID_KEY = 'Id'
+
+    if charge_session.get(ID_KEY) is not None:
+        return str(charge_session[ID_KEY])
+    return '%s/%s' % (charge_session[ChargeSession.Key.DEVICE_ID], charge_session[ChargeSession.Key.START_DATE_TIME])
+
+
+def get_charge_session_start(charge_session: dict) -> datetime:
+    return pytz.utc.localize(datetime.fromisoformat(charge_session[ChargeSession.Key.START_DATE_TIME]))
+
+
+def is_charge_session_final(charge_session: dict) -> bool:
+    # Charge sessions that are still in progress don't have a commit end yet, and might still change.
+    return charge_session.get(ChargeSession.Key.COMMIT_END_DATE_TIME) is not None
+
+
+def _merge_intervals(intervals: list[tuple[datetime, datetime]]) -> list[tuple[datetime, datetime]]:
+    merged_intervals = []
+    for start, end in sorted(intervals):
+        if len(merged_intervals) > 0 and start <= merged_intervals[-1][1]:
+            merged_intervals[-1] = (merged_intervals[-1][0], max(merged_intervals[-1][1], end))
+        else:
+            merged_intervals.append((start, end))
+    return merged_intervals
+
+
+class ChargehistoryCache:
+    # A persistent cache of the detailed charge sessions of one installation, together with the
+    # intervals for which all the charge sessions are known and final. The chargehistory API is assumed
+    # to select charge sessions by their start time, so the sessions of any interval are the cached
+    # sessions that started in it.
+    SYNCED_INTERVALS_KEY = 'SyncedIntervals'
+    SESSIONS_KEY = 'Sessions'
+
+    def __init__(self, cache_dir: str, installation_id: str):
+        self.file_path = os.path.join(cache_dir, '%s.json' % (installation_id,))
+        self.synced_intervals = []
+        self.sessions = {}
+
+        if os.path.exists(self.file_path):
+            with open(self.file_path) as cache_file:
+                cache_json = json.load(cache_file)
+            self.synced_intervals = [
+                (datetime.fromisoformat(start), datetime.fromisoformat(end))
+                for start, end in cache_json[ChargehistoryCache.SYNCED_INTERVALS_KEY]]
+            self.sessions = cache_json[ChargehistoryCache.SESSIONS_KEY]
+
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.file_path) or '.', exist_ok=True)
+        temporary_file_path = self.file_path + '.tmp'
+        with open(temporary_file_path, 'w') as cache_file:
+            json.dump({
+                ChargehistoryCache.SYNCED_INTERVALS_KEY: [
+                    [start.isoformat(), end.isoformat()] for start, end in self.synced_intervals],
+                ChargehistoryCache.SESSIONS_KEY: self.sessions,
+            }, cache_file)
+        # Replace the previous cache atomically, so an interrupted run never corrupts it.
+        os.replace(temporary_file_path, self.file_path)
+
+
+    def find_missing_intervals(self, fetch_interval: UsageInterval) -> list[UsageInterval]:
+        fetch_start = fetch_interval.start_date_time.astimezone(pytz.utc)
+        fetch_end = fetch_interval.end_date_time.astimezone(pytz.utc)
+
+        missing_intervals = []
+        for synced_start, synced_end in self.synced_intervals + [(fetch_end, fetch_end)]:
+            if synced_end <= fetch_start:
+                continue
+            if fetch_start < synced_start:
+                missing_interval = fetch_interval.copy()
+                missing_interval.start_date_time = fetch_start
+                missing_interval.end_date_time = min(synced_start, fetch_end)
+                missing_intervals.append(missing_interval)
+            fetch_start = max(fetch_start, synced_end)
+            if fetch_end <= fetch_start:
+                break
+        return missing_intervals
+
+
+    def get_sessions(self, fetch_interval: UsageInterval) -> list[dict]:
+        return [s for s in self.sessions.values()
+            if fetch_interval.start_date_time <= get_charge_session_start(s) < fetch_interval.end_date_time]
+
+
+    def add(self, fetch_interval: UsageInterval, charge_sessions: list[dict], fetched_at: datetime) -> None:
+        # Only the part of the interval before the first charge session that might still change, and
+        # before the sessions the API might not report yet, is considered synced.
+        synced_end = min(fetch_interval.end_date_time, fetched_at - SETTLE_TIMEDELTA)
+        for charge_session in charge_sessions:
+            if not is_charge_session_final(charge_session):
+                synced_end = min(synced_end, get_charge_session_start(charge_session))
+
+        for charge_session in charge_sessions:
+            if is_charge_session_final(charge_session) and get_charge_session_start(charge_session) < synced_end:
+                self.sessions[get_charge_session_key(charge_session)] = charge_session
+
+        synced_start = fetch_interval.start_date_time.astimezone(pytz.utc)
+        synced_end = synced_end.astimezone(pytz.utc)
+        if synced_start < synced_end:
+            self.synced_intervals = _merge_intervals(self.synced_intervals + [(synced_start, synced_end)])
@@ -0,0 +1,235 @@
+import argparse
+import json
+import math
+import pytz
+import random
+import uuid
+
+from datetime import date, datetime, time, timedelta
+from typing import Iterable, Iterator
+
+from chargehistory_io import DATA_KEY, PAGES_KEY, is_chargehistory_npz, write_chargehistory_npz
+from common import ChargeSession, EnergyDetail, LocalTimeConverter, ZRH
+
+
+# Typical charging powers, in kW, of the charging stations.
+CHARGING_POWERS_KW = [3.7, 7.4, 11.0]
+
+# When charge sessions usually start, in local time: (weight, mean hour, standard deviation in hours).
+START_HOUR_DISTRIBUTION = [
+    (0.5, 18.5, 1.5),  # After work.
+    (0.3, 8.0, 1.0),   # In the morning.
+    (0.2, 13.0, 3.0),  # During the day.
+]
+
+
+def _sample_poisson(rng: random.Random, mean: float) -> int:
+    # Knuth's algorithm, which is fine for the small means of charge sessions per day.
+    limit = math.exp(-mean)
+    k = 0
+    p = rng.random()
+    while p > limit:
+        k += 1
+        p *= rng.random()
+    return k
+
+
+def _sample_start_hour(rng: random.Random) -> float:
+    _, mean_hour, standard_deviation_hours = rng.choices(
+        START_HOUR_DISTRIBUTION, weights=[w for w, _, _ in START_HOUR_DISTRIBUTION])[0]
+    return min(max(rng.gauss(mean_hour, standard_deviation_hours), 0), 23.99)
+
+
+def _format_naive_utc(d: datetime) -> str:
+    # Like the API: UTC, but without time zone info.
+    return d.astimezone(pytz.utc).replace(tzinfo=None).isoformat(timespec='microseconds')
+
+
+def _make_charge_session(
+        rng: random.Random,
+        device_id: str,
+        device_name: str,
+        charging_power_kw: float,
+        start_date_time: datetime,
+        duration: timedelta,
+        energy_details_interval: timedelta,
+        has_energy_details: bool) -> dict:
+    # The energy details are recorded at the end of every interval, a few seconds late, like the
+    # charging stations do (see TIMESTAMP_RECORD_DELAY).
+    end_date_time = start_date_time + duration
+    energy_details = []
+    interval_end = datetime.fromtimestamp(
+        (start_date_time.timestamp() // energy_details_interval.total_seconds() + 1) * energy_details_interval.total_seconds(),
+        pytz.utc)
+    interval_start = start_date_time
+    while interval_start < end_date_time:
+        interval_hours = (min(interval_end, end_date_time) - interval_start).total_seconds() / 3600
+        energy = round(charging_power_kw * interval_hours * rng.uniform(0.6, 1.0), 4)
+        energy_details.append({
+            EnergyDetail.Key.TIMESTAMP.value: (interval_end + timedelta(seconds=rng.randint(0, 6))).isoformat(),
+            EnergyDetail.Key.ENERGY.value: energy,
+        })
+        interval_start = interval_end
+        interval_end += energy_details_interval
+
+    return {
+        'Id': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+        ChargeSession.Key.DEVICE_ID.value: device_id,
+        ChargeSession.Key.DEVICE_NAME.value: device_name,
+        ChargeSession.Key.START_DATE_TIME.value: _format_naive_utc(start_date_time),
+        'EndDateTime': _format_naive_utc(end_date_time),
+        ChargeSession.Key.COMMIT_END_DATE_TIME.value: _format_naive_utc(end_date_time),
+        ChargeSession.Key.ENERGY.value: round(sum(ed[EnergyDetail.Key.ENERGY] for ed in energy_details), 4),
+        ChargeSession.Key.ENERGY_DETAILS.value: energy_details if has_energy_details else None,
+    }
+
+
+def generate_chargehistory_sessions(
+        start_date: date,
+        num_years: float = 1,
+        num_devices: int = 5,
+        sessions_per_day: float = 0.6,
+        energy_details_interval: timedelta = timedelta(minutes=15),
+        dst_crossing_sessions_per_transition: int = 1,
+        missing_energy_details_fraction: float = 0.01,
+        seed: int = 0) -> Iterator[dict]:
+    # Yields realistic charge sessions, like the chargehistory API returns them at the detailed level, day by
+    # day. sessions_per_day is the average per charging station. On every DST transition,
+    # each charging station also has dst_crossing_sessions_per_transition charge sessions across it.
+    assert num_devices > 0, 'the number of devices needs to be > 0, but it was: %d.' % (num_devices,)
+    assert sessions_per_day >= 0, 'the sessions per day need to be >= 0, but they were: %s.' % (sessions_per_day,)
+    assert energy_details_interval > timedelta(0),\
+        'the energy details interval needs to be > 0, but it was: %s.' % (energy_details_interval,)
+    assert 0 <= missing_energy_details_fraction <= 1,\
+        'the fraction of sessions missing energy details needs to be in [0, 1], but it was: %s.' % (missing_energy_details_fraction,)
+
+    rng = random.Random(seed)
+    devices = [
+        ('ZAP%06d' % (i,), 'Ladestation %d' % (i + 1,), rng.choice(CHARGING_POWERS_KW))
+        for i in range(num_devices)]
+    end_date = start_date + timedelta(days=round(365.25 * num_years))
+
+    # The first time of the conversion table is the start of its span, not a transition.
+    dst_transitions = [
+        pytz.utc.localize(t) for t in LocalTimeConverter(
+            datetime.combine(start_date, time()), datetime.combine(end_date, time())).utc_transition_times[1:]
+        if t < datetime.combine(end_date, time())]
+
+    day = start_date
+    device_id_to_last_end = {}
+    while day < end_date:
+        day_charge_sessions = []
+        for device_id, device_name, charging_power_kw in devices:
+            # Pairs of the start and the minimum end of the charge sessions.
+            start_and_min_end_date_times = [
+                (ZRH.localize(datetime.combine(day, time()) + timedelta(hours=_sample_start_hour(rng))), None)
+                for _ in range(_sample_poisson(rng, sessions_per_day))]
+            start_and_min_end_date_times += [
+                (t - timedelta(hours=rng.uniform(1, 3)), t + timedelta(hours=rng.uniform(0.25, 2)))
+                for t in dst_transitions if t.date() == day
+                for _ in range(dst_crossing_sessions_per_transition)]
+
+            for start_date_time, optional_min_end_date_time in sorted(start_and_min_end_date_times):
+                # A charging station only charges one car at a time.
+                if start_date_time < device_id_to_last_end.get(device_id, start_date_time):
+                    continue
+                duration = timedelta(hours=min(rng.lognormvariate(1, 0.6), 14))
+                if optional_min_end_date_time is not None:
+                    duration = max(duration, optional_min_end_date_time - start_date_time)
+                device_id_to_last_end[device_id] = start_date_time + duration
+                day_charge_sessions.append(_make_charge_session(
+                    rng=rng,
+                    device_id=device_id,
+                    device_name=device_name,
+                    charging_power_kw=charging_power_kw,
+                    start_date_time=start_date_time,
+                    duration=duration,
+                    energy_details_interval=energy_details_interval,
+                    has_energy_details=rng.random() >= missing_energy_details_fraction))
+
+        yield from sorted(day_charge_sessions, key=lambda s: s[ChargeSession.Key.START_DATE_TIME])
+        day += timedelta(days=1)
+
+
+def write_chargehistory_json(charge_sessions: Iterable[dict], chargehistory_file_path: str) -> None:
+    # Written one charge session at a time, so that large histories don't need to fit in memory.
+    with open(chargehistory_file_path, 'w') as chargehistory_file:
+        chargehistory_file.write('{"%s": 1, "%s": [' % (PAGES_KEY, DATA_KEY))
+        for i, charge_session in enumerate(charge_sessions):
+            chargehistory_file.write('\n  ' if i == 0 else ',\n  ')
+            json.dump(charge_session, chargehistory_file)
+        chargehistory_file.write('\n]}\n')
+
+
+def add_generator_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        '--start_date',
+        type=date.fromisoformat,
+        default=date(2023, 1, 1),
+        help='the day of the first generated charge session (default: %(default)s)')
+    parser.add_argument(
+        '--num_years',
+        type=float,
+        default=1,
+        help='how many years of history to generate (default: %(default)s)')
+    parser.add_argument(
+        '--num_devices',
+        type=int,
+        default=5,
+        help='the number of charging stations (default: %(default)s)')
+    parser.add_argument(
+        '--sessions_per_day',
+        type=float,
+        default=0.6,
+        help='the average number of charge sessions per charging station and day (default: %(default)s)')
+    parser.add_argument(
+        '--energy_details_interval_minutes',
+        type=float,
+        default=15,
+        help='the time between two energy details of a charge session (default: %(default)s)')
+    parser.add_argument(
+        '--dst_crossing_sessions_per_transition',
+        type=int,
+        default=1,
+        help='the number of charge sessions per charging station across each DST transition (default: %(default)s)')
+    parser.add_argument(
+        '--missing_energy_details_fraction',
+        type=float,
+        default=0.01,
+        help='the fraction of charge sessions without energy details (default: %(default)s)')
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='the random seed; the same arguments and seed generate the same history (default: %(default)s)')
+
+
+def generate_chargehistory_sessions_from_args(args: argparse.Namespace) -> Iterator[dict]:
+    return generate_chargehistory_sessions(
+        start_date=args.start_date,
+        num_years=args.num_years,
+        num_devices=args.num_devices,
+        sessions_per_day=args.sessions_per_day,
+        energy_details_interval=timedelta(minutes=args.energy_details_interval_minutes),
+        dst_crossing_sessions_per_transition=args.dst_crossing_sessions_per_transition,
+        missing_energy_details_fraction=args.missing_energy_details_fraction,
+        seed=args.seed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic, but realistic, Zaptec chargehistory API response, e.g. for benchmarks.')
+
+    parser.add_argument(
+        'output_chargehistory_file_name',
+        help='the path to the generated chargehistory, in JSON format, or in the columnar .npz format if '
+        'the path ends with \'.npz\'')
+    add_generator_arguments(parser)
+
+    args = parser.parse_args()
+
+    charge_sessions = generate_chargehistory_sessions_from_args(args)
+    if is_chargehistory_npz(args.output_chargehistory_file_name):
+        write_chargehistory_npz(charge_sessions, args.output_chargehistory_file_name)
+    else:
+        write_chargehistory_json(charge_sessions, args.output_chargehistory_file_name)
@@ -0,0 +1,196 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from decimal import Decimal
+from enum import Enum
+from typing import Iterator
+
+from chargehistory_io import decompress_ndjson_member, is_chargehistory_ndjson, is_chargehistory_npz,\
+    iter_chargehistory_session_spans, iterate_ndjson_members
+from common import ChargeSession, TIMESTAMP_RECORD_DELAY, UsageInterval
+
+
+CHARGEHISTORY_INDEX_VERSION = 1
+CHARGEHISTORY_INDEX_SUFFIX = '.index.npz'
+# The time range of charge sessions whose datetimes can't be parsed, which are always read, so that they are
+# reported like without an index.
+_MIN_NANOSECONDS = np.iinfo(np.int64).min
+_MAX_NANOSECONDS = np.iinfo(np.int64).max
+
+
+# The sidecar index of a chargehistory json or compressed NDJSON file has the time range of each charge session,
+# sorted by start, and where its text is: the offset and size of its bytes in a json, or of its member in a
+# compressed NDJSON, with its line in the member. The datetimes are UTC nanoseconds since the epoch, and the
+# end datetimes also have their running maximum, so that both bounds of a usage interval are binary searches.
+class IndexKey(str, Enum):
+    VERSION = 'version'
+    SOURCE_SIZE = 'source_size'
+    SOURCE_MTIME_NS = 'source_mtime_ns'
+    NUM_RECORDS = 'num_records'
+    START_DATE_TIMES = 'start_date_times'
+    END_DATE_TIMES = 'end_date_times'
+    MAX_END_DATE_TIMES = 'max_end_date_times'
+    RECORD_INDICES = 'record_indices'
+    OFFSETS = 'offsets'
+    SIZES = 'sizes'
+    LINE_INDICES = 'line_indices'
+
+
+def get_chargehistory_index_path(chargehistory_file_path: str) -> str:
+    return chargehistory_file_path + CHARGEHISTORY_INDEX_SUFFIX
+
+
+def _to_nanoseconds(date_times: list, nat_nanoseconds: int) -> np.ndarray:
+    # The charge session datetimes are in UTC, but without time zone info.
+    nanoseconds = pd.DatetimeIndex(pd.to_datetime(
+        [d if isinstance(d, str) else None for d in date_times], format='ISO8601', errors='coerce')).asi8.copy()
+    nanoseconds[nanoseconds == pd.NaT.value] = nat_nanoseconds
+    return nanoseconds
+
+
+def _iterate_charge_session_locations(chargehistory_file_path: str) -> Iterator[tuple[int, int, int, dict]]:
+    # Yields the offset, size and line index of each charge session, with its datetimes.
+    if is_chargehistory_ndjson(chargehistory_file_path):
+        start_offset = 0
+        for end_offset, data in iterate_ndjson_members(chargehistory_file_path):
+            for line_index, line in enumerate(line for line in data.decode().splitlines() if line):
+                yield start_offset, end_offset - start_offset, line_index, json.loads(line, parse_float=str)
+            start_offset = end_offset
+        return
+    # In latin-1 every byte is one character, so that the offsets are byte offsets; the datetimes are ASCII.
+    with open(chargehistory_file_path, encoding='latin-1', newline='') as chargehistory_file:
+        for start_offset, end_offset, charge_session in iter_chargehistory_session_spans(
+                chargehistory_file, parse_float=str):
+            yield start_offset, end_offset - start_offset, 0, charge_session
+
+
+def build_chargehistory_index(chargehistory_file_path: str) -> dict[IndexKey, np.ndarray]:
+    assert not is_chargehistory_npz(chargehistory_file_path),\
+        'the columnar .npz format doesn\'t need an index: %s.' % (chargehistory_file_path,)
+    stat = os.stat(chargehistory_file_path)
+    start_date_times = []
+    end_date_times = []
+    offsets = []
+    sizes = []
+    line_indices = []
+    for offset, size, line_index, charge_session in _iterate_charge_session_locations(chargehistory_file_path):
+        is_dict = isinstance(charge_session, dict)
+        start_date_times.append(charge_session.get(ChargeSession.Key.START_DATE_TIME) if is_dict else None)
+        end_date_times.append(charge_session.get(ChargeSession.Key.COMMIT_END_DATE_TIME) if is_dict else None)
+        offsets.append(offset)
+        sizes.append(size)
+        line_indices.append(line_index)
+
+    start_nanoseconds = _to_nanoseconds(start_date_times, _MIN_NANOSECONDS)
+    end_nanoseconds = _to_nanoseconds(end_date_times, _MAX_NANOSECONDS)
+    # A charge session without a start is always read, whatever its end.
+    end_nanoseconds[start_nanoseconds == _MIN_NANOSECONDS] = _MAX_NANOSECONDS
+    order = np.argsort(start_nanoseconds, kind='stable')
+    return {
+        IndexKey.VERSION: np.int64(CHARGEHISTORY_INDEX_VERSION),
+        IndexKey.SOURCE_SIZE: np.int64(stat.st_size),
+        IndexKey.SOURCE_MTIME_NS: np.int64(stat.st_mtime_ns),
+        IndexKey.NUM_RECORDS: np.int64(len(offsets)),
+        IndexKey.START_DATE_TIMES: start_nanoseconds[order],
+        IndexKey.END_DATE_TIMES: end_nanoseconds[order],
+        IndexKey.MAX_END_DATE_TIMES: np.maximum.accumulate(end_nanoseconds[order]),
+        IndexKey.RECORD_INDICES: order.astype(np.int64),
+        IndexKey.OFFSETS: np.array(offsets, dtype=np.int64)[order],
+        IndexKey.SIZES: np.array(sizes, dtype=np.int64)[order],
+        IndexKey.LINE_INDICES: np.array(line_indices, dtype=np.int64)[order],
+    }
+
+
+def write_chargehistory_index(index: dict[IndexKey, np.ndarray], index_file_path: str) -> None:
+    # Written next to the final path first, so that a concurrent reader never sees a partial index.
+    temporary_file_path = index_file_path + '.tmp.npz'
+    np.savez(temporary_file_path, **{k.value: v for k, v in index.items()})
+    os.replace(temporary_file_path, index_file_path)
+
+
+def read_chargehistory_index(index_file_path: str) -> dict[IndexKey, np.ndarray]:
+    with np.load(index_file_path) as npz_file:
+        return {k: npz_file[k.value] for k in IndexKey if k.value in npz_file.files}
+
+
+def is_chargehistory_index_current(index: dict[IndexKey, np.ndarray], chargehistory_file_path: str) -> bool:
+    # Whether the index is of this version, and of the chargehistory as it is now.
+    stat = os.stat(chargehistory_file_path)
+    return index.keys() == set(IndexKey)\
+        and int(index[IndexKey.VERSION]) == CHARGEHISTORY_INDEX_VERSION\
+        and int(index[IndexKey.SOURCE_SIZE]) == stat.st_size\
+        and int(index[IndexKey.SOURCE_MTIME_NS]) == stat.st_mtime_ns
+
+
+def open_chargehistory_index(chargehistory_file_path: str) -> dict[IndexKey, np.ndarray]:
+    # Reads the sidecar index, or builds it if it's missing or the chargehistory changed since.
+    index_file_path = get_chargehistory_index_path(chargehistory_file_path)
+    if os.path.exists(index_file_path):
+        index = read_chargehistory_index(index_file_path)
+        if is_chargehistory_index_current(index, chargehistory_file_path):
+            return index
+    index = build_chargehistory_index(chargehistory_file_path)
+    write_chargehistory_index(index, index_file_path)
+    return index
+
+
+def find_indexed_positions(index: dict[IndexKey, np.ndarray], usage_interval: UsageInterval) -> np.ndarray:
+    # The positions in the index of the charge sessions that overlap the usage interval, like
+    # is_charge_session_outside_usage_interval(), in the order of the chargehistory.
+    usage_start = pd.Timestamp(usage_interval.start_date_time).value
+    usage_end = (pd.Timestamp(usage_interval.end_date_time) + TIMESTAMP_RECORD_DELAY).value
+    # Before first, all the charge sessions end by the start of the usage interval; from last on, they start
+    # too late.
+    first = np.searchsorted(index[IndexKey.MAX_END_DATE_TIMES], usage_start, side='right')
+    last = np.searchsorted(index[IndexKey.START_DATE_TIMES], usage_end, side='left')
+    positions = first + np.flatnonzero(index[IndexKey.END_DATE_TIMES][first:last] > usage_start)
+    return positions[np.argsort(index[IndexKey.RECORD_INDICES][positions], kind='stable')]
+
+
+def read_indexed_charge_sessions(
+        chargehistory_file_path: str,
+        index: dict[IndexKey, np.ndarray],
+        positions: np.ndarray,
+        parse_float=Decimal) -> Iterator[tuple[int, dict]]:
+    # Yields the record index and the charge session at each of the positions in the index, only reading and
+    # parsing their text, e.g. only decompressing the members they are in.
+    decoder = json.JSONDecoder(parse_float=parse_float)
+    is_ndjson = is_chargehistory_ndjson(chargehistory_file_path)
+    with open(chargehistory_file_path, 'rb') as chargehistory_file:
+        member_offset = None
+        member_lines = []
+        for position in positions:
+            offset = int(index[IndexKey.OFFSETS][position])
+            chargehistory_file.seek(offset)
+            if not is_ndjson:
+                text = chargehistory_file.read(int(index[IndexKey.SIZES][position])).decode()
+            else:
+                if offset != member_offset:
+                    member_offset = offset
+                    member = chargehistory_file.read(int(index[IndexKey.SIZES][position]))
+                    member_lines = [
+                        line for line in decompress_ndjson_member(chargehistory_file_path, member).decode().splitlines()
+                        if line]
+                text = member_lines[int(index[IndexKey.LINE_INDICES][position])]
+            yield int(index[IndexKey.RECORD_INDICES][position]), decoder.decode(text)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build the sidecar time-range index of a chargehistory, which \'usage_processor.py\' '
+        '--chargehistory_index uses to only read the charge sessions of the usage interval.')
+
+    parser.add_argument(
+        'chargehistory_file_path',
+        help='the path to the Zaptec chargehistory API response, in JSON format, or in the compressed NDJSON format')
+
+    args = parser.parse_args()
+
+    index = build_chargehistory_index(args.chargehistory_file_path)
+    write_chargehistory_index(index, get_chargehistory_index_path(args.chargehistory_file_path))
+    print('Indexed %d charge sessions in %s.' % (
+        int(index[IndexKey.NUM_RECORDS]), get_chargehistory_index_path(args.chargehistory_file_path)))
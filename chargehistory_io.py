@@ -0,0 +1,597 @@
+import argparse
+import gzip
+import json
+import os
+import re
+import textwrap
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from decimal import Decimal, ROUND_FLOOR
+from enum import Enum
+from typing import Iterable, Iterator, TextIO
+
+try:
+    import zstandard
+except ImportError:
+    # Only needed for .ndjson.zst chargehistories.
+    zstandard = None
+
+from chargehistory_cache import get_charge_session_key
+from chargehistory_validation import ChargehistoryValidator, ValidationLevel
+from common import ChargeSession, EnergyDetail, ENERGY_FIXED_POINT_DECIMALS, FixedPointEnergy, energy_from_fixed_point,\
+    energy_to_decimal, energy_to_optional_fixed_point, fixed_point_to_decimals, get_energy_decimals,\
+    parse_energy_detail_timestamps
+
+
+DATA_KEY = 'Data'
+PAGES_KEY = 'Pages'
+CHARGEHISTORY_NPZ_VERSION = 2
+GZIP_NDJSON_SUFFIX = '.ndjson.gz'
+ZSTD_NDJSON_SUFFIX = '.ndjson.zst'
+# The charge sessions of a compressed NDJSON chargehistory are appended in independently compressed members of
+# up to this many charge sessions, the default chargehistory page size.
+NDJSON_MEMBER_SIZE = 5000
+NDJSON_READ_CHUNK_SIZE = 1 << 20
+
+_WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+
+
+class _JsonStreamScanner:
+    def __init__(self, json_file: TextIO, decoder: json.JSONDecoder, chunk_size: int):
+        self.json_file = json_file
+        self.decoder = decoder
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.position = 0
+        # The offset of the buffer in the file, in characters.
+        self.buffer_offset = 0
+        self.eof = False
+
+
+    def _read_more(self, size: int) -> None:
+        # Drop the part of the buffer that was already consumed, so memory stays bounded.
+        self.buffer = self.buffer[self.position:]
+        self.buffer_offset += self.position
+        self.position = 0
+
+        chunk = self.json_file.read(size)
+        if chunk == '':
+            self.eof = True
+        self.buffer += chunk
+
+
+    def next_char(self) -> str:
+        while True:
+            self.position = _WHITESPACE_RE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            assert not self.eof, 'Unexpected end of the chargehistory json.'
+            self._read_more(self.chunk_size)
+
+
+    def consume_char(self, expected_chars: str) -> str:
+        c = self.next_char()
+        assert c in expected_chars,\
+            'Expected one of %r at position %d of the chargehistory json, got %r.' % (expected_chars, self.position, c)
+        self.position += 1
+        return c
+
+
+    def decode_value(self):
+        self.next_char()
+        read_size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # A number at the very end of the buffer might continue in the next chunk.
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._read_more(read_size)
+            read_size *= 2
+
+
+    def get_offset(self) -> int:
+        return self.buffer_offset + self.position
+
+
+def iter_chargehistory_session_spans(
+        chargehistory_file: TextIO,
+        parse_float=Decimal,
+        chunk_size: int = 1 << 20) -> Iterator[tuple[int, int, dict]]:
+    # Yields the charge sessions from the 'Data' array of a chargehistory json one at a time, with the offsets
+    # of their start and end in the file, in characters, without ever holding more than one charge session (and
+    # one read chunk) in memory.
+    scanner = _JsonStreamScanner(chargehistory_file, json.JSONDecoder(parse_float=parse_float), chunk_size)
+
+    scanner.consume_char('{')
+    if scanner.next_char() == '}':
+        return
+    while True:
+        key = scanner.decode_value()
+        scanner.consume_char(':')
+
+        if key == DATA_KEY:
+            scanner.consume_char('[')
+            if scanner.next_char() == ']':
+                scanner.consume_char(']')
+            else:
+                while True:
+                    scanner.next_char()
+                    start_offset = scanner.get_offset()
+                    charge_session = scanner.decode_value()
+                    yield start_offset, scanner.get_offset(), charge_session
+                    if scanner.consume_char(',]') == ']':
+                        break
+        else:
+            scanner.decode_value()
+
+        if scanner.consume_char(',}') == '}':
+            return
+
+
+def iter_chargehistory_sessions(
+        chargehistory_file: TextIO,
+        parse_float=Decimal,
+        chunk_size: int = 1 << 20) -> Iterator[dict]:
+    for _, _, charge_session in iter_chargehistory_session_spans(chargehistory_file, parse_float, chunk_size):
+        yield charge_session
+
+
+def read_chargehistory_sessions(chargehistory_file_path: str, parse_float=Decimal) -> Iterator[dict]:
+    if is_chargehistory_ndjson(chargehistory_file_path):
+        yield from read_chargehistory_ndjson_sessions(chargehistory_file_path, parse_float=parse_float)
+        return
+    with open(chargehistory_file_path) as chargehistory_file:
+        yield from iter_chargehistory_sessions(chargehistory_file, parse_float=parse_float)
+
+
+# The compressed NDJSON chargehistory format has one charge session per line, like in the 'Data' array of
+# the chargehistory json, compressed with gzip or zstd (with the optional zstandard package). The lines are
+# appended in members, i.e. concatenated gzip members or zstd frames, each of which is only written once
+# it's complete, so that the charge sessions of an interrupted fetch can still be read, and the fetch resumed.
+def is_chargehistory_ndjson(chargehistory_file_path: str) -> bool:
+    return chargehistory_file_path.endswith((GZIP_NDJSON_SUFFIX, ZSTD_NDJSON_SUFFIX))
+
+
+def _is_chargehistory_zstd(chargehistory_file_path: str) -> bool:
+    if not chargehistory_file_path.endswith(ZSTD_NDJSON_SUFFIX):
+        return False
+    assert zstandard is not None,\
+        'the zstandard package is needed for %s chargehistories, install it with: pip install zstandard.' % (
+            ZSTD_NDJSON_SUFFIX,)
+    return True
+
+
+def _compress_ndjson_member(chargehistory_file_path: str, data: bytes) -> bytes:
+    if _is_chargehistory_zstd(chargehistory_file_path):
+        return zstandard.ZstdCompressor().compress(data)
+    return gzip.compress(data)
+
+
+def _make_ndjson_member_decompressor(chargehistory_file_path: str):
+    if _is_chargehistory_zstd(chargehistory_file_path):
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+
+
+def decompress_ndjson_member(chargehistory_file_path: str, member: bytes) -> bytes:
+    return _make_ndjson_member_decompressor(chargehistory_file_path).decompress(member)
+
+
+def iterate_ndjson_members(chargehistory_file_path: str) -> Iterator[tuple[int, bytes]]:
+    # Yields the end offset and the decompressed data of each complete member, reading the file in chunks.
+    # An incomplete last member, e.g. of an interrupted write, is ignored.
+    with open(chargehistory_file_path, 'rb') as ndjson_file:
+        decompressor = _make_ndjson_member_decompressor(chargehistory_file_path)
+        data_chunks = []
+        offset = 0
+        pending = b''
+        while True:
+            if len(pending) == 0:
+                pending = ndjson_file.read(NDJSON_READ_CHUNK_SIZE)
+                if len(pending) == 0:
+                    return
+            data_chunks.append(decompressor.decompress(pending))
+            if not decompressor.eof:
+                offset += len(pending)
+                pending = b''
+                continue
+            unused_data = decompressor.unused_data
+            offset += len(pending) - len(unused_data)
+            yield offset, b''.join(data_chunks)
+            decompressor = _make_ndjson_member_decompressor(chargehistory_file_path)
+            data_chunks = []
+            pending = unused_data
+
+
+def read_chargehistory_ndjson_sessions(chargehistory_file_path: str, parse_float=Decimal) -> Iterator[dict]:
+    # Decompresses and parses the charge sessions lazily, one member at a time.
+    decoder = json.JSONDecoder(parse_float=parse_float)
+    file_size = os.path.getsize(chargehistory_file_path)
+    end_offset = 0
+    for end_offset, data in iterate_ndjson_members(chargehistory_file_path):
+        for line in data.decode().splitlines():
+            if line:
+                yield decoder.decode(line)
+    assert end_offset == file_size,\
+        'the chargehistory %s ends with an incomplete member after byte %d, e.g. of an interrupted fetch; ' \
+        'resume the fetch to complete it.' % (chargehistory_file_path, end_offset)
+
+
+def dumps_exact_json(value, indent: int | None = None, separators: tuple[str, str] | None = None) -> str:
+    # Like json.dumps(), but writes the Decimals, e.g. the energies of a chargehistory read with Decimals, and
+    # the FixedPointEnergies as their exact text, instead of going through a float, or, for FixedPointEnergies,
+    # which are ints, as their fixed-point units.
+    item_separator, key_separator = separators if separators is not None\
+        else (', ', ': ') if indent is None else (',', ': ')
+
+    def encode(value, level: int) -> str:
+        if isinstance(value, FixedPointEnergy):
+            value = value.to_decimal()
+        if isinstance(value, Decimal):
+            assert value.is_finite(), 'the value is not valid JSON: %s.' % (value,)
+            return str(value)
+        if isinstance(value, dict):
+            brackets = '{}'
+            items = [json.dumps(k) + key_separator + encode(v, level + 1) for k, v in value.items()]
+        elif isinstance(value, (list, tuple)):
+            brackets = '[]'
+            items = [encode(v, level + 1) for v in value]
+        else:
+            return json.dumps(value)
+
+        if len(items) == 0:
+            return brackets
+        if indent is None:
+            return brackets[0] + item_separator.join(items) + brackets[1]
+        newline = '\n' + ' ' * (indent * (level + 1))
+        return brackets[0] + newline + (item_separator + newline).join(items) + '\n' + ' ' * (indent * level) + brackets[1]
+
+    return encode(value, 0)
+
+
+class ChargehistoryNdjsonWriter:
+    # Appends charge sessions to a compressed NDJSON chargehistory as they are written, one member every
+    # NDJSON_MEMBER_SIZE charge sessions. When resuming, the charge sessions of the complete members that
+    # were already written are kept, an incomplete last member is dropped, and only the charge sessions that
+    # aren't in the file yet are appended.
+    def __init__(self, ndjson_file_path: str, resume: bool = False, member_size: int = NDJSON_MEMBER_SIZE):
+        assert member_size > 0, 'the member size needs to be > 0, but it was: %d.' % (member_size,)
+        self.ndjson_file_path = ndjson_file_path
+        self.member_size = member_size
+        self.existing_charge_session_keys = set()
+        # Checks the compression, and that zstandard is available, before anything is written.
+        _compress_ndjson_member(ndjson_file_path, b'')
+        valid_size = 0
+        if resume and os.path.exists(ndjson_file_path):
+            for valid_size, data in iterate_ndjson_members(ndjson_file_path):
+                self.existing_charge_session_keys.update(
+                    get_charge_session_key(json.loads(line)) for line in data.decode().splitlines() if line)
+        self.ndjson_file = open(ndjson_file_path, 'r+b' if resume and os.path.exists(ndjson_file_path) else 'wb')
+        self.ndjson_file.truncate(valid_size)
+        self.ndjson_file.seek(valid_size)
+        self.lines = []
+        self.num_charge_sessions = 0
+        self.num_skipped_charge_sessions = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # The charge sessions written so far are kept even on errors, so that the fetch can be resumed.
+        self.close()
+
+
+    def write_charge_session(self, charge_session_json: dict) -> None:
+        if get_charge_session_key(charge_session_json) in self.existing_charge_session_keys:
+            self.num_skipped_charge_sessions += 1
+            return
+        self.lines.append(dumps_exact_json(charge_session_json, separators=(',', ':')))
+        self.num_charge_sessions += 1
+        if len(self.lines) >= self.member_size:
+            self.flush()
+
+
+    def flush(self) -> None:
+        if len(self.lines) == 0:
+            return
+        data = ''.join(line + '\n' for line in self.lines).encode()
+        self.ndjson_file.write(_compress_ndjson_member(self.ndjson_file_path, data))
+        self.ndjson_file.flush()
+        self.lines.clear()
+
+
+    def close(self) -> None:
+        self.flush()
+        self.ndjson_file.close()
+
+
+# The columnar chargehistory format is a NumPy .npz archive with one array per charge session field and
+# flattened energy details: the energy details of charge session i are at the indices
+# energy_details_offsets[i]:energy_details_offsets[i + 1]. Timestamps are UTC nanoseconds since the epoch
+# and energies are fixed-point (see ENERGY_FIXED_POINT_SCALE), with the number of decimals they were written
+# with. The energies with more decimals than the fixed-point units are also stored as their exact text, by
+# their index, and their fixed-point energy is rounded down.
+class NpzKey(str, Enum):
+    VERSION = 'version'
+    SESSION_KEYS = 'session_keys'
+    DEVICE_IDS = 'device_ids'
+    DEVICE_NAMES = 'device_names'
+    START_DATE_TIMES = 'start_date_times'
+    COMMIT_END_DATE_TIMES = 'commit_end_date_times'
+    ENERGIES = 'energies'
+    ENERGY_DETAILS_OFFSETS = 'energy_details_offsets'
+    ENERGY_DETAIL_TIMESTAMPS = 'energy_detail_timestamps'
+    ENERGY_DETAIL_ENERGIES = 'energy_detail_energies'
+    ENERGY_DECIMALS = 'energy_decimals'
+    ENERGY_DETAIL_ENERGY_DECIMALS = 'energy_detail_energy_decimals'
+    EXACT_ENERGY_INDICES = 'exact_energy_indices'
+    EXACT_ENERGIES = 'exact_energies'
+    EXACT_ENERGY_DETAIL_INDICES = 'exact_energy_detail_indices'
+    EXACT_ENERGY_DETAIL_ENERGIES = 'exact_energy_detail_energies'
+
+
+# The keys of the charge session energies, and of the energy detail energies: their fixed-point energies, their
+# decimals, and the indices and texts of the exact ones.
+NPZ_ENERGY_KEYS = (NpzKey.ENERGIES, NpzKey.ENERGY_DECIMALS, NpzKey.EXACT_ENERGY_INDICES, NpzKey.EXACT_ENERGIES)
+NPZ_ENERGY_DETAIL_ENERGY_KEYS = (
+    NpzKey.ENERGY_DETAIL_ENERGIES,
+    NpzKey.ENERGY_DETAIL_ENERGY_DECIMALS,
+    NpzKey.EXACT_ENERGY_DETAIL_INDICES,
+    NpzKey.EXACT_ENERGY_DETAIL_ENERGIES)
+
+
+class _NpzEnergyColumns:
+    def __init__(self):
+        self.energies = []
+        self.energy_decimals = []
+        self.exact_indices = []
+        self.exact_energies = []
+
+
+    def append(self, energy: Decimal | float | int) -> None:
+        fixed_point_energy = energy_to_optional_fixed_point(energy)
+        if fixed_point_energy is None:
+            decimal_energy = energy_to_decimal(energy)
+            self.exact_indices.append(len(self.energies))
+            self.exact_energies.append(str(decimal_energy))
+            fixed_point_energy = int(decimal_energy.scaleb(ENERGY_FIXED_POINT_DECIMALS).to_integral_value(ROUND_FLOOR))
+        self.energies.append(fixed_point_energy)
+        self.energy_decimals.append(get_energy_decimals(energy))
+
+
+    def to_arrays(self, keys: tuple[NpzKey, NpzKey, NpzKey, NpzKey]) -> dict[str, np.ndarray]:
+        energies_key, energy_decimals_key, exact_indices_key, exact_energies_key = keys
+        return {
+            energies_key.value: np.array(self.energies, dtype=np.int64),
+            energy_decimals_key.value: np.array(self.energy_decimals, dtype=np.int8),
+            exact_indices_key.value: np.array(self.exact_indices, dtype=np.int64),
+            exact_energies_key.value: np.array(self.exact_energies, dtype=str),
+        }
+
+
+class ChargehistoryNpzWriter:
+    # Writes charge sessions to the columnar format one at a time, e.g. as they are fetched; each of them is
+    # only kept as its columns, and the archive is written by close(), once they were all valid.
+    def __init__(self, npz_file_path: str):
+        self.npz_file_path = npz_file_path
+        self.session_keys = []
+        self.device_ids = []
+        self.device_names = []
+        self.start_date_times = []
+        self.commit_end_date_times = []
+        self.energies = _NpzEnergyColumns()
+        self.energy_details_offsets = [0]
+        self.energy_detail_timestamps = []
+        self.energy_detail_energies = _NpzEnergyColumns()
+        self.validator = ChargehistoryValidator(ValidationLevel.STRICT)
+        self.num_records = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+    def write_charge_session(self, charge_session_json: dict) -> None:
+        record_index = self.num_records
+        self.num_records += 1
+        if not self.validator.validate_charge_session(record_index, charge_session_json):
+            return
+        ChargeSession(charge_session_json)  # Only to check the datetimes.
+
+        self.session_keys.append(get_charge_session_key(charge_session_json))
+        self.device_ids.append(charge_session_json[ChargeSession.Key.DEVICE_ID])
+        self.device_names.append(charge_session_json[ChargeSession.Key.DEVICE_NAME])
+        self.start_date_times.append(charge_session_json[ChargeSession.Key.START_DATE_TIME])
+        self.commit_end_date_times.append(charge_session_json[ChargeSession.Key.COMMIT_END_DATE_TIME])
+        self.energies.append(charge_session_json[ChargeSession.Key.ENERGY])
+
+        for raw_energy_detail in charge_session_json.get(ChargeSession.Key.ENERGY_DETAILS) or []:
+            self.energy_detail_timestamps.append(raw_energy_detail[EnergyDetail.Key.TIMESTAMP])
+            self.energy_detail_energies.append(raw_energy_detail[EnergyDetail.Key.ENERGY])
+        self.energy_details_offsets.append(len(self.energy_detail_timestamps))
+
+
+    def close(self) -> None:
+        self.validator.assert_valid()
+        np.savez_compressed(
+            self.npz_file_path,
+            **{
+                NpzKey.VERSION.value: np.int64(CHARGEHISTORY_NPZ_VERSION),
+                NpzKey.SESSION_KEYS.value: np.array(self.session_keys, dtype=str),
+                NpzKey.DEVICE_IDS.value: np.array(self.device_ids, dtype=str),
+                NpzKey.DEVICE_NAMES.value: np.array(self.device_names, dtype=str),
+                # The charge session datetimes are in UTC, but without time zone info.
+                NpzKey.START_DATE_TIMES.value: pd.DatetimeIndex(pd.to_datetime(self.start_date_times, format='ISO8601')).asi8,
+                NpzKey.COMMIT_END_DATE_TIMES.value: pd.DatetimeIndex(pd.to_datetime(self.commit_end_date_times, format='ISO8601')).asi8,
+                NpzKey.ENERGY_DETAILS_OFFSETS.value: np.array(self.energy_details_offsets, dtype=np.int64),
+                NpzKey.ENERGY_DETAIL_TIMESTAMPS.value: parse_energy_detail_timestamps(self.energy_detail_timestamps).asi8,
+                **self.energies.to_arrays(NPZ_ENERGY_KEYS),
+                **self.energy_detail_energies.to_arrays(NPZ_ENERGY_DETAIL_ENERGY_KEYS),
+            })
+
+
+def write_chargehistory_npz(charge_sessions: Iterable[dict], npz_file_path: str) -> None:
+    with ChargehistoryNpzWriter(npz_file_path) as writer:
+        for charge_session_json in charge_sessions:
+            writer.write_charge_session(charge_session_json)
+
+
+class ChargehistoryJsonWriter:
+    # Writes charge sessions one at a time to a chargehistory JSON, with the same formatting as
+    # json.dump({'Pages': 1, 'Data': charge_sessions}, indent=2), i.e. like a response of the API with all the
+    # charge sessions in one page. The file only replaces an existing one once it's complete.
+    def __init__(self, json_file_path: str):
+        self.json_file_path = json_file_path
+        self.temporary_file_path = json_file_path + '.tmp'
+        self.json_file = open(self.temporary_file_path, 'w')
+        self.json_file.write('{\n  "%s": 1,\n  "%s": [' % (PAGES_KEY, DATA_KEY))
+        self.num_charge_sessions = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.json_file.close()
+            os.remove(self.temporary_file_path)
+
+
+    def write_charge_session(self, charge_session_json: dict) -> None:
+        self.json_file.write(',\n' if self.num_charge_sessions > 0 else '\n')
+        self.json_file.write(textwrap.indent(dumps_exact_json(charge_session_json, indent=2), '    '))
+        self.num_charge_sessions += 1
+
+
+    def close(self) -> None:
+        self.json_file.write('\n  ]\n}' if self.num_charge_sessions > 0 else ']\n}')
+        self.json_file.close()
+        os.replace(self.temporary_file_path, self.json_file_path)
+
+
+def open_chargehistory_writer(
+        chargehistory_file_path: str) -> ChargehistoryNpzWriter | ChargehistoryJsonWriter | ChargehistoryNdjsonWriter:
+    if is_chargehistory_ndjson(chargehistory_file_path):
+        return ChargehistoryNdjsonWriter(chargehistory_file_path)
+    if is_chargehistory_npz(chargehistory_file_path):
+        return ChargehistoryNpzWriter(chargehistory_file_path)
+    return ChargehistoryJsonWriter(chargehistory_file_path)
+
+
+def read_chargehistory_npz(npz_file_path: str) -> dict[NpzKey, np.ndarray]:
+    with np.load(npz_file_path, allow_pickle=False) as npz_file:
+        columns = {k: npz_file[k.value] for k in NpzKey}
+    assert columns[NpzKey.VERSION] == CHARGEHISTORY_NPZ_VERSION,\
+        'Unsupported chargehistory .npz version: want %d, got %d; convert the chargehistory again.' % (
+            CHARGEHISTORY_NPZ_VERSION, columns[NpzKey.VERSION])
+    return columns
+
+
+def select_npz_energies(
+        columns: dict[NpzKey, np.ndarray],
+        energy_keys: tuple[NpzKey, NpzKey, NpzKey, NpzKey],
+        indices: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # The energies at the indices, with their decimals, as fixed-point energies, or, if some of them have more
+    # decimals than the fixed-point units, all as exact Decimals, see make_energy_array().
+    energies_key, energy_decimals_key, exact_indices_key, exact_energies_key = energy_keys
+    energies = columns[energies_key][indices]
+    energy_decimals = columns[energy_decimals_key][indices]
+    exact_indices = columns[exact_indices_key]
+    if len(exact_indices) == 0:
+        return energies, energy_decimals
+
+    # The exact indices are sorted.
+    exact_positions = np.minimum(np.searchsorted(exact_indices, indices), len(exact_indices) - 1)
+    is_exact = exact_indices[exact_positions] == indices
+    if not is_exact.any():
+        return energies, energy_decimals
+    energies = fixed_point_to_decimals(energies, energy_decimals)
+    energies[is_exact] = [Decimal(e) for e in columns[exact_energies_key][exact_positions[is_exact]]]
+    return energies, energy_decimals
+
+
+def validate_chargehistory_npz_columns(columns: dict[NpzKey, np.ndarray], validator: ChargehistoryValidator) -> None:
+    # The columns were validated when they were written, so this only checks that they are consistent, and
+    # that the energies are >= 0. Vectorized, that's cheap enough to check every charge session, also when
+    # the validator only samples them.
+    if validator.level == ValidationLevel.TRUSTED:
+        return
+
+    num_charge_sessions = len(columns[NpzKey.SESSION_KEYS])
+    energy_details_offsets = columns[NpzKey.ENERGY_DETAILS_OFFSETS]
+    for key in (
+            NpzKey.DEVICE_IDS,
+            NpzKey.DEVICE_NAMES,
+            NpzKey.START_DATE_TIMES,
+            NpzKey.COMMIT_END_DATE_TIMES,
+            NpzKey.ENERGIES,
+            NpzKey.ENERGY_DECIMALS):
+        assert len(columns[key]) == num_charge_sessions,\
+            'Inconsistent chargehistory .npz: %d %s for %d charge sessions.' % (len(columns[key]), key.value, num_charge_sessions)
+    for key in (NpzKey.ENERGY_DETAIL_ENERGIES, NpzKey.ENERGY_DETAIL_ENERGY_DECIMALS):
+        assert len(columns[NpzKey.ENERGY_DETAIL_TIMESTAMPS]) == len(columns[key]),\
+            'Inconsistent chargehistory .npz: %d energy detail timestamps, but %d %s.' % (
+                len(columns[NpzKey.ENERGY_DETAIL_TIMESTAMPS]), len(columns[key]), key.value)
+    for energies_key, _, exact_indices_key, exact_energies_key in (NPZ_ENERGY_KEYS, NPZ_ENERGY_DETAIL_ENERGY_KEYS):
+        exact_indices = columns[exact_indices_key]
+        assert len(exact_indices) == len(columns[exact_energies_key])\
+            and (np.diff(exact_indices) > 0).all()\
+            and (len(exact_indices) == 0 or 0 <= exact_indices[0] and exact_indices[-1] < len(columns[energies_key])),\
+            'Inconsistent chargehistory .npz: invalid %s.' % (exact_indices_key.value,)
+    assert len(energy_details_offsets) == num_charge_sessions + 1\
+        and energy_details_offsets[0] == 0\
+        and energy_details_offsets[-1] == len(columns[NpzKey.ENERGY_DETAIL_ENERGIES])\
+        and (np.diff(energy_details_offsets) >= 0).all(),\
+        'Inconsistent chargehistory .npz: invalid energy details offsets.'
+
+    validator.num_validated_records += num_charge_sessions
+    for record_index in np.flatnonzero(columns[NpzKey.ENERGIES] < 0):
+        validator.add_error(int(record_index), 'the energy is < 0: %s.' % (
+            energy_from_fixed_point(columns[NpzKey.ENERGIES][record_index]),))
+    for energy_detail_index in np.flatnonzero(columns[NpzKey.ENERGY_DETAIL_ENERGIES] < 0):
+        record_index = np.searchsorted(energy_details_offsets, energy_detail_index, side='right') - 1
+        validator.add_error(int(record_index), 'the energy of energy detail %d is < 0: %s.' % (
+            energy_detail_index - energy_details_offsets[record_index],
+            energy_from_fixed_point(columns[NpzKey.ENERGY_DETAIL_ENERGIES][energy_detail_index])))
+
+
+def is_chargehistory_npz(chargehistory_file_path: str) -> bool:
+    return chargehistory_file_path.endswith('.npz')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert a Zaptec chargehistory API response to the columnar .npz format, which '
+        '\'usage_processor.py\' can load without parsing it again, or to the compressed NDJSON format.')
+
+    parser.add_argument(
+        'chargehistory_file_path',
+        help='the path to the Zaptec chargehistory API response, in JSON format, or in the compressed NDJSON format')
+    parser.add_argument(
+        'output_chargehistory_file_name',
+        help='the path to the output chargehistory, in the columnar .npz format, or in the compressed NDJSON '
+        'format if the path ends with \'%s\' or \'%s\'' % (GZIP_NDJSON_SUFFIX, ZSTD_NDJSON_SUFFIX))
+
+    args = parser.parse_args()
+
+    with open_chargehistory_writer(args.output_chargehistory_file_name) as writer:
+        for charge_session_json in read_chargehistory_sessions(args.chargehistory_file_path):
+            writer.write_charge_session(charge_session_json)
@@ -0,0 +1,111 @@
+from decimal import Decimal
+from enum import Enum
+
+from common import ChargeSession, EnergyDetail
+
+
+class ValidationLevel(str, Enum):
+    # How much of a chargehistory is checked before it's used: 'strict' checks every charge session and
+    # energy detail, 'sampled' every SAMPLED_VALIDATION_STRIDE-th charge session, with all its energy details,
+    # and 'trusted' nothing, e.g. for chargehistories that we wrote ourselves from validated data.
+    STRICT = 'strict'
+    SAMPLED = 'sampled'
+    TRUSTED = 'trusted'
+
+
+SAMPLED_VALIDATION_STRIDE = 100
+# Only the first errors are listed, but all of them are counted.
+MAX_REPORTED_VALIDATION_ERRORS = 20
+
+ENERGY_TYPES = (Decimal, int, float)
+
+
+def _is_valid_energy(energy) -> bool:
+    return isinstance(energy, ENERGY_TYPES) and not isinstance(energy, bool) and energy >= 0
+
+
+class ChargehistoryValidator:
+    # Checks the schema of raw charge sessions, identified by their index in the chargehistory, and collects
+    # all the errors, which assert_valid() then reports at once. The checks are set up once, and only compare
+    # key sets, so that validating millions of energy details stays cheap.
+    def __init__(
+            self,
+            level: ValidationLevel = ValidationLevel.STRICT,
+            sampled_validation_stride: int = SAMPLED_VALIDATION_STRIDE):
+        assert sampled_validation_stride > 0,\
+            'the sampled validation stride needs to be > 0, but it was: %d.' % (sampled_validation_stride,)
+        self.level = level
+        self.stride = {
+            ValidationLevel.STRICT: 1,
+            ValidationLevel.SAMPLED: sampled_validation_stride,
+            ValidationLevel.TRUSTED: None,
+        }[level]
+        self.required_charge_session_keys = frozenset(
+            k.value for k in ChargeSession.Key if k != ChargeSession.Key.ENERGY_DETAILS)
+        self.energy_detail_keys = EnergyDetail.KEYS
+
+        self.num_validated_records = 0
+        self.num_errors = 0
+        # Pairs of the record index and the error.
+        self.reported_errors = []
+
+
+    def is_validated(self, record_index: int) -> bool:
+        return self.stride is not None and record_index % self.stride == 0
+
+
+    def add_error(self, record_index: int, error: str) -> None:
+        self.num_errors += 1
+        if len(self.reported_errors) < MAX_REPORTED_VALIDATION_ERRORS:
+            self.reported_errors.append((record_index, error))
+
+
+    def validate_charge_session(self, record_index: int, charge_session: dict) -> bool:
+        # Whether the charge session can be used: it's either valid, or not validated at this level.
+        if not self.is_validated(record_index):
+            return True
+        self.num_validated_records += 1
+        num_errors = self.num_errors
+
+        keys = charge_session.keys()
+        if not keys >= self.required_charge_session_keys:
+            self.add_error(record_index, 'missing charge session keys: %s.' % (
+                sorted(self.required_charge_session_keys - keys),))
+            return False
+        if not _is_valid_energy(charge_session[ChargeSession.Key.ENERGY]):
+            self.add_error(record_index, 'the energy is not a number >= 0: %r.' % (
+                charge_session[ChargeSession.Key.ENERGY],))
+        for key in (ChargeSession.Key.START_DATE_TIME, ChargeSession.Key.COMMIT_END_DATE_TIME):
+            if not isinstance(charge_session[key], str):
+                self.add_error(record_index, 'the %s is not a string: %r.' % (key.value, charge_session[key]))
+
+        raw_energy_details = charge_session.get(ChargeSession.Key.ENERGY_DETAILS)
+        if raw_energy_details is not None and not isinstance(raw_energy_details, list):
+            self.add_error(record_index, 'the energy details are not a list: %r.' % (raw_energy_details,))
+            return False
+        for i, raw_energy_detail in enumerate(raw_energy_details or []):
+            if not isinstance(raw_energy_detail, dict) or raw_energy_detail.keys() != self.energy_detail_keys:
+                self.add_error(record_index, 'unexpected energy detail %d, want the keys %s: %r.' % (
+                    i, sorted(self.energy_detail_keys), raw_energy_detail))
+            elif not _is_valid_energy(raw_energy_detail[EnergyDetail.Key.ENERGY])\
+                    or not isinstance(raw_energy_detail[EnergyDetail.Key.TIMESTAMP], str):
+                self.add_error(record_index, 'invalid energy detail %d: %s.' % (i, raw_energy_detail))
+
+        return self.num_errors == num_errors
+
+
+    def assert_valid(self) -> None:
+        assert self.num_errors == 0,\
+            'Found %d error(s) in the chargehistory (%s validation of %d record(s)):\n%s%s' % (
+                self.num_errors,
+                self.level.value,
+                self.num_validated_records,
+                '\n'.join('  record %d: %s' % (record_index, error) for record_index, error in self.reported_errors),
+                '\n  ...' if self.num_errors > len(self.reported_errors) else '')
+
+
+def validate_charge_sessions(charge_sessions: list[dict], level: ValidationLevel = ValidationLevel.STRICT) -> None:
+    validator = ChargehistoryValidator(level)
+    for record_index, charge_session in enumerate(charge_sessions):
+        validator.validate_charge_session(record_index, charge_session)
+    validator.assert_valid()
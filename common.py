@@ -1,21 +1,250 @@
+import bisect
 import copy
 import inquirer
+import numpy as np
+import pandas as pd
 import pprint
 import pytz
+import sys
 
 from datetime import datetime, time, timedelta, timezone
+from decimal import Decimal
 from enum import Enum
-from functools import total_ordering
+from functools import lru_cache, total_ordering
+from typing import Callable
 
 
 ZRH = pytz.timezone('Europe/Zurich')
 TIMESTAMP_RECORD_DELAY = timedelta(seconds=5)
+# Fixed-point energies are integer numbers of mWh, i.e. millionths of a kWh.
+ENERGY_FIXED_POINT_DECIMALS = 6
+ENERGY_FIXED_POINT_SCALE = 10 ** ENERGY_FIXED_POINT_DECIMALS
 
 
 def is_timezone_naive(d: time | datetime) -> bool:
     return d.tzinfo is None or d.tzinfo.utcoffset(d) is None
 
 
+# The default time span of the UTC offset transitions, and the step with which it is probed for them, which needs to
+# be shorter than the time between two transitions (months, for Europe/Zurich).
+LOCAL_TIME_CONVERSION_SPAN = (datetime(1900, 1, 1), datetime(2100, 1, 1))
+UTC_OFFSET_PROBING_STEP = timedelta(days=28)
+
+
+def _to_zrh_date_time(naive_utc_date_time: datetime) -> datetime:
+    return pytz.utc.localize(naive_utc_date_time).astimezone(ZRH)
+
+
+class LocalTimeConverter:
+    # Converts UTC times to Europe/Zurich times with a precomputed table of the UTC offset transitions in a
+    # time span: whole arrays are converted with one vectorized lookup, and single datetimes without going
+    # through pytz's localize() and astimezone(). The transitions are found with astimezone() itself, by
+    # probing the span and bisecting each change of the tzinfo to the microsecond, so the results are exactly
+    # the same as pytz's.
+    def __init__(self, optional_span_start: datetime | None = None, optional_span_end: datetime | None = None):
+        # The span is in UTC; the transition that is in effect at its start is always included. It is probed with
+        # datetimes, whose tzinfos are pytz's own, also if it is given as pandas Timestamps.
+        span_start = LOCAL_TIME_CONVERSION_SPAN[0] if optional_span_start is None\
+            else pd.Timestamp(self._to_naive_utc(optional_span_start)).floor('us').to_pydatetime()
+        span_end = LOCAL_TIME_CONVERSION_SPAN[1] if optional_span_end is None\
+            else pd.Timestamp(self._to_naive_utc(optional_span_end)).ceil('us').to_pydatetime()
+
+        self.optional_span_start = optional_span_start
+        self.optional_span_end = optional_span_end
+        self.utc_transition_times = [span_start]
+        self.tzinfos = [_to_zrh_date_time(span_start).tzinfo]
+        self.utc_offsets = [_to_zrh_date_time(span_start).utcoffset()]
+        probe = span_start
+        while probe < span_end:
+            next_probe = min(probe + UTC_OFFSET_PROBING_STEP, span_end)
+            if _to_zrh_date_time(next_probe).tzinfo is not self.tzinfos[-1]:
+                self._append_transition(probe, next_probe)
+            probe = next_probe
+
+        # Everything before the first transition in the span uses its offset.
+        self.utc_transition_epochs_ns = np.array(
+            [np.iinfo(np.int64).min] + [pd.Timestamp(t).value for t in self.utc_transition_times[1:]], dtype=np.int64)
+        self.utc_offsets_ns = np.array(
+            [utc_offset // timedelta(microseconds=1) * 1000 for utc_offset in self.utc_offsets], dtype=np.int64)
+
+
+    def _append_transition(self, before: datetime, after: datetime) -> None:
+        # The first time at or after which the tzinfo is not the one before.
+        while after - before > timedelta(microseconds=1):
+            middle = before + (after - before) // 2
+            if _to_zrh_date_time(middle).tzinfo is self.tzinfos[-1]:
+                before = middle
+            else:
+                after = middle
+        local_date_time = _to_zrh_date_time(after)
+        self.utc_transition_times.append(after)
+        self.tzinfos.append(local_date_time.tzinfo)
+        self.utc_offsets.append(local_date_time.utcoffset())
+
+
+    @staticmethod
+    def _to_naive_utc(d: datetime) -> datetime:
+        return d if is_timezone_naive(d) else d.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+    def to_local_date_time(self, utc_date_time: datetime) -> datetime:
+        # Like utc_date_time.astimezone(ZRH); naive datetimes are taken to be in UTC.
+        naive_utc_date_time = self._to_naive_utc(utc_date_time)
+        index = max(0, bisect.bisect_right(self.utc_transition_times, naive_utc_date_time) - 1)
+        return (naive_utc_date_time + self.utc_offsets[index]).replace(tzinfo=self.tzinfos[index])
+
+
+    def to_wall_clock_epochs_ns(self, utc_epochs_ns: np.ndarray) -> np.ndarray:
+        # Converts UTC nanoseconds since the epoch to local wall-clock "nanoseconds since the epoch", keeping NaTs.
+        utc_epochs_ns = np.asarray(utc_epochs_ns, dtype=np.int64)
+        is_nat = utc_epochs_ns == np.iinfo(np.int64).min
+        if self.optional_span_end is not None:
+            assert not (utc_epochs_ns[~is_nat] > pd.Timestamp(self.optional_span_end).value).any(),\
+                'Some times are after the end of the time span of the conversion table: %s.' % (self.optional_span_end,)
+        if self.optional_span_start is not None:
+            assert not (utc_epochs_ns[~is_nat] < pd.Timestamp(self.optional_span_start).value).any(),\
+                'Some times are before the start of the time span of the conversion table: %s.' % (self.optional_span_start,)
+
+        offset_indices = np.searchsorted(self.utc_transition_epochs_ns, utc_epochs_ns, side='right') - 1
+        wall_clock_epochs_ns = utc_epochs_ns + self.utc_offsets_ns[np.maximum(offset_indices, 0)]
+        wall_clock_epochs_ns[is_nat] = np.iinfo(np.int64).min
+        return wall_clock_epochs_ns
+
+
+    def to_wall_clock(self, timestamps: pd.DatetimeIndex) -> pd.DatetimeIndex:
+        # Like timestamps.tz_convert(ZRH).tz_localize(None).
+        utc_timestamps = timestamps if timestamps.tz is None else timestamps.tz_convert(pytz.utc)
+        return pd.DatetimeIndex(self.to_wall_clock_epochs_ns(utc_timestamps.as_unit('ns').asi8).view('datetime64[ns]'))
+
+
+ZRH_LOCAL_TIME_CONVERTER = LocalTimeConverter()
+
+
+def energy_to_optional_fixed_point(energy: Decimal | float | int) -> int | None:
+    # None if the energy is written with more decimals than the fixed-point units have, e.g.
+    # 0.55150000000000004, or 1.0000000, which then needs to stay a Decimal to be exported and summed exactly.
+    if isinstance(energy, FixedPointEnergy):
+        return int(energy)
+    if isinstance(energy, int):
+        return energy * ENERGY_FIXED_POINT_SCALE
+    decimal_energy = Decimal(str(energy))
+    if not -ENERGY_FIXED_POINT_DECIMALS <= decimal_energy.as_tuple().exponent <= 0:
+        return None
+    return int(decimal_energy.scaleb(ENERGY_FIXED_POINT_DECIMALS))
+
+
+def energy_to_fixed_point(energy: Decimal | float | int) -> int:
+    fixed_point_energy = energy_to_optional_fixed_point(energy)
+    assert fixed_point_energy is not None,\
+        'The energy %s kWh has more decimals than the fixed-point units (1/%d kWh).' % (energy, ENERGY_FIXED_POINT_SCALE)
+    return fixed_point_energy
+
+
+def energy_from_fixed_point(fixed_point_energy: int) -> Decimal:
+    return Decimal(int(fixed_point_energy)) / ENERGY_FIXED_POINT_SCALE
+
+
+def get_energy_decimals(energy: Decimal | float | int) -> int:
+    # How many decimals the energy is written with, e.g. 2 for 3.50, like its Decimal.
+    if isinstance(energy, FixedPointEnergy):
+        return energy.decimals
+    if isinstance(energy, int):
+        return 0
+    return min(max(-Decimal(str(energy)).as_tuple().exponent, 0), ENERGY_FIXED_POINT_DECIMALS)
+
+
+def fixed_point_to_decimal(fixed_point_energy: int, decimals: int) -> Decimal:
+    # The Decimal with the given number of decimals, e.g. Decimal('3.50') for 3500000 with 2 decimals.
+    return Decimal(int(fixed_point_energy) // 10 ** (ENERGY_FIXED_POINT_DECIMALS - int(decimals))).scaleb(-int(decimals))
+
+
+class FixedPointEnergy(int):
+    # An exact energy in fixed-point units, which can be parsed straight from the JSON text with
+    # json.JSONDecoder(parse_float=parse_fixed_point_energy), instead of going through a Decimal. It remembers
+    # the number of decimals of the text, so that it's exported exactly like the Decimal would be.
+    def __new__(cls, fixed_point_energy: int, decimals: int):
+        energy = super().__new__(cls, fixed_point_energy)
+        energy.decimals = decimals
+        return energy
+
+
+    @classmethod
+    def from_energy(cls, energy: Decimal | float | int) -> 'FixedPointEnergy':
+        return cls(energy_to_fixed_point(energy), get_energy_decimals(energy))
+
+
+    @classmethod
+    def parse(cls, text: str) -> 'FixedPointEnergy | Decimal':
+        # The energies with more decimals than the fixed-point units stay Decimals, see
+        # energy_to_optional_fixed_point().
+        integer_part, _, fraction_part = text.partition('.')
+        if 'e' in text or 'E' in text or len(fraction_part) > ENERGY_FIXED_POINT_DECIMALS:
+            energy = Decimal(text)
+            return cls.from_energy(energy) if energy_to_optional_fixed_point(energy) is not None else energy
+        return cls(
+            int(integer_part + fraction_part) * 10 ** (ENERGY_FIXED_POINT_DECIMALS - len(fraction_part)),
+            len(fraction_part))
+
+
+    def to_decimal(self) -> Decimal:
+        return fixed_point_to_decimal(self, self.decimals)
+
+
+    def __repr__(self) -> str:
+        return '%s(%r)' % (type(self).__name__, str(self.to_decimal()))
+
+
+    def __str__(self) -> str:
+        return str(self.to_decimal())
+
+
+@lru_cache(maxsize=1 << 16)
+def parse_fixed_point_energy(text: str) -> FixedPointEnergy | Decimal:
+    # Like FixedPointEnergy.parse(), but the same texts, which are frequent among energies, share one object.
+    return FixedPointEnergy.parse(text)
+
+
+def fixed_point_to_decimals(fixed_point_energies: np.ndarray, decimals: np.ndarray) -> np.ndarray:
+    # Energies repeat a lot, so each distinct one is only converted, and stored, once. The number of
+    # decimals is at most 6, so it fits in the 3 lowest bits of the key.
+    keys = fixed_point_energies.astype(np.int64) * 8 + decimals.astype(np.int64)
+    unique_keys, inverse_indices = np.unique(keys, return_inverse=True)
+    return np.array([fixed_point_to_decimal(k >> 3, k & 7) for k in unique_keys], dtype=object)[inverse_indices]
+
+
+def energy_to_decimal(energy: Decimal | float | int) -> Decimal:
+    # The exact Decimal of the energy, as it's written in the chargehistory.
+    if isinstance(energy, FixedPointEnergy):
+        return energy.to_decimal()
+    return energy if isinstance(energy, Decimal) else Decimal(str(energy))
+
+
+def make_energy_array(energies: list[Decimal | float | int]) -> tuple[np.ndarray, np.ndarray]:
+    # The energies as an int64 array of fixed-point energies, with the number of decimals of each, or, if
+    # some of them have more decimals than the fixed-point units, as an object array of their exact Decimals.
+    fixed_point_energies = [energy_to_optional_fixed_point(e) for e in energies]
+    energy_decimals = np.array([get_energy_decimals(e) for e in energies], dtype=np.int8)
+    if any(e is None for e in fixed_point_energies):
+        return np.array([energy_to_decimal(e) for e in energies], dtype=object), energy_decimals
+    return np.array(fixed_point_energies, dtype=np.int64), energy_decimals
+
+
+def are_exact_decimal_energies(energies: np.ndarray) -> bool:
+    return energies.dtype == object
+
+
+def energies_to_decimals(energies: np.ndarray, decimals: np.ndarray) -> np.ndarray:
+    # The fixed-point energies are converted, and the exact Decimals kept as they are.
+    return energies if are_exact_decimal_energies(energies) else fixed_point_to_decimals(energies, decimals)
+
+
+def concatenate_energies(energies: list[np.ndarray], energy_decimals: list[np.ndarray]) -> np.ndarray:
+    # Fixed-point energies, unless some of them are exact Decimals, which all of them then become.
+    if not any(are_exact_decimal_energies(e) for e in energies):
+        return np.concatenate(energies).astype(np.int64, copy=False) if len(energies) > 0 else np.array([], dtype=np.int64)
+    return np.concatenate([energies_to_decimals(e, d) for e, d in zip(energies, energy_decimals)])
+
+
 class UsageInterval:
     def __init__(self, start_date_time: datetime, end_date_time: datetime):
         assert is_timezone_naive(start_date_time),\
@@ -71,35 +300,26 @@ class EnergyDetail:
         ENERGY = 'Energy'
         TIMESTAMP = 'Timestamp'
 
+    KEYS = frozenset(k.value for k in Key)
+
+    __slots__ = ('energy', 'timestamp')
 
-    def __init__(self, energy_detail: dict):
-        got_keys = sorted(energy_detail.keys())
-        want_keys = sorted([k.value for k in EnergyDetail.Key])
-        assert want_keys == got_keys,\
-            'Unexpected EnergyDetail keys: want %s, got %s.' % (want_keys, got_keys)
 
+    def __init__(self, energy_detail: dict):
+        # The schema is checked beforehand, see ChargehistoryValidator.
         energy = energy_detail[EnergyDetail.Key.ENERGY]
         timestamp = datetime.fromisoformat(energy_detail[EnergyDetail.Key.TIMESTAMP])
 
-        assert energy >= 0,\
-            'The energy is < 0 for energy detail: %s.' % (energy_detail,)
         assert timestamp.tzinfo == timezone.utc,\
             'The timestamp is not in UTC for energy detail: %s.' % (energy_detail,)
 
         self.energy = energy
-        self.timestamp = timestamp.astimezone(ZRH)
+        self.timestamp = ZRH_LOCAL_TIME_CONVERTER.to_local_date_time(timestamp)
 
 
-    def compute_energy_rate(self, weekday_to_optional_high_rate_interval: [HighRateInterval | None]) -> EnergyRate:
+    def compute_energy_rate(self, tariff: 'Tariff') -> EnergyRate | str:
         earliest_timestamp = self.timestamp - TIMESTAMP_RECORD_DELAY
-        optional_high_rate_interval = weekday_to_optional_high_rate_interval[earliest_timestamp.weekday()]
-
-        if optional_high_rate_interval is None:
-            return EnergyRate.LOW
-        return EnergyRate.HIGH\
-            if optional_high_rate_interval.start_time < earliest_timestamp.time()\
-            and earliest_timestamp.time() <= optional_high_rate_interval.end_time\
-            else EnergyRate.LOW
+        return tariff.compute_energy_rate(earliest_timestamp)
 
 
     def is_in_usage_interval(self, usage_interval: UsageInterval):
@@ -116,29 +336,37 @@ class ChargeSession:
         ENERGY_DETAILS = 'EnergyDetails'
         START_DATE_TIME = 'StartDateTime'
 
+    # Histories have many charge sessions, so they don't get a __dict__ each.
+    __slots__ = (
+        'device_id',
+        'device_name',
+        'energy',
+        'end_date_time',
+        'start_date_time',
+        'raw_charge_session',
+        'optional_energy_details',
+        'optional_energy_rate',
+        'comment',
+    )
 
-    def __init__(self, charge_session: dict):
-        for k in ChargeSession.Key:
-            if k.value == ChargeSession.Key.ENERGY_DETAILS:
-                continue  # This key is optional.
-            assert k.value in charge_session, 'Missing charge session key: %s.' % (k.value,)
 
+    def __init__(self, charge_session: dict):
+        # The schema is checked beforehand, see ChargehistoryValidator; the energy details key is optional.
         energy = charge_session[ChargeSession.Key.ENERGY]
         end_date_time = datetime.fromisoformat(charge_session[ChargeSession.Key.COMMIT_END_DATE_TIME])
         start_date_time = datetime.fromisoformat(charge_session[ChargeSession.Key.START_DATE_TIME])
 
-        assert energy >= 0,\
-            'The energy is < 0 for charge session: %s.' % (charge_session,)
         assert is_timezone_naive(end_date_time,),\
             'Unexpected timezone for end datetime (%s) of charge session %s' % (end_date_time, charge_session,)
         assert is_timezone_naive(start_date_time,),\
             'Unexpected timezone for start datetime of charge session %s' % (start_date_time, charge_session,)
 
-        self.device_id = charge_session[ChargeSession.Key.DEVICE_ID]
-        self.device_name = charge_session[ChargeSession.Key.DEVICE_NAME]
+        # All the charge sessions of a charging station share the same strings.
+        self.device_id = sys.intern(charge_session[ChargeSession.Key.DEVICE_ID])
+        self.device_name = sys.intern(charge_session[ChargeSession.Key.DEVICE_NAME])
         self.energy = energy
-        self.end_date_time = pytz.utc.localize(end_date_time).astimezone(ZRH)
-        self.start_date_time = pytz.utc.localize(start_date_time).astimezone(ZRH)
+        self.end_date_time = ZRH_LOCAL_TIME_CONVERTER.to_local_date_time(end_date_time)
+        self.start_date_time = ZRH_LOCAL_TIME_CONVERTER.to_local_date_time(start_date_time)
 
         self.raw_charge_session = charge_session
         self.optional_energy_details = None
@@ -146,9 +374,48 @@ class ChargeSession:
         self.comment = ''
 
 
-    def compute_energy_details_or_rate(self, usage_interval: UsageInterval):
-        optional_energy_details = [EnergyDetail(ed) for ed in self.raw_charge_session[ChargeSession.Key.ENERGY_DETAILS]]\
-            if len(self.raw_charge_session.get(ChargeSession.Key.ENERGY_DETAILS, [])) > 0 else None
+    def get_raw_energy_details(self) -> list[dict]:
+        return self.raw_charge_session.get(ChargeSession.Key.ENERGY_DETAILS) or []
+
+
+    def pop_raw_energy_details(self) -> list[dict]:
+        # Hands the energy details over, e.g. to be stored as arrays, so that the charge session doesn't keep
+        # them alive; the rest of the raw charge session is kept, e.g. for its key or to prompt for it.
+        raw_energy_details = self.get_raw_energy_details()
+        self.raw_charge_session = {
+            k: v for k, v in self.raw_charge_session.items() if k != ChargeSession.Key.ENERGY_DETAILS}
+        return raw_energy_details
+
+
+    def prompt_energy_rate(self, energy_rates: list[EnergyRate | str] = tuple(EnergyRate)) -> tuple[EnergyRate | str, str]:
+        print('The charging session that started on %s, %s and ended on %s, %s is missing energy details.' % (
+            self.start_date_time.strftime('%A'),
+            self.start_date_time,
+            self.end_date_time.strftime('%A'),
+            self.end_date_time))
+        print('Here is the full json:')
+        pprint.pprint(self.raw_charge_session)
+
+        energy_rate_names = [er.value if isinstance(er, EnergyRate) else er for er in energy_rates]
+        answers = inquirer.prompt([
+            inquirer.List(
+                'energy_rate',
+                message='What energy rate did this charging session use?',
+                choices=energy_rate_names),
+            inquirer.Text(
+                'comment',
+                message='Add a comment about your selection:')])
+        return energy_rates[energy_rate_names.index(answers['energy_rate'])], answers['comment']
+
+
+    def compute_energy_details_or_rate(
+            self,
+            usage_interval: UsageInterval,
+            optional_resolve_energy_rate: Callable[['ChargeSession'], tuple[EnergyRate, str]] | None = None):
+        # Without energy details, the energy rate and a comment come from optional_resolve_energy_rate(), or
+        # are asked for interactively.
+        optional_energy_details = [EnergyDetail(ed) for ed in self.get_raw_energy_details()]\
+            if len(self.get_raw_energy_details()) > 0 else None
         optional_energy_rate = None
         comment = ''
 
@@ -158,25 +425,56 @@ class ChargeSession:
                 'Charge sessions without energy details that don\'t fall entirely inside '\
                 'the usage interval are not supported: %s' % (self.raw_charge_session,)
 
-            print('The charging session that started on %s, %s and ended on %s, %s is missing energy details.' % (
-                self.start_date_time.strftime('%A'),
-                self.start_date_time,
-                self.end_date_time.strftime('%A'),
-                self.end_date_time))
-            print('Here is the full json:')
-            pprint.pprint(self.raw_charge_session)
-
-            answers = inquirer.prompt([
-                inquirer.List(
-                    'energy_rate',
-                    message='What energy rate did this charging session use?',
-                    choices=[er.value for er in EnergyRate]),
-                inquirer.Text(
-                    'comment',
-                    message='Add a comment about your selection:')])
-            optional_energy_rate = EnergyRate(answers['energy_rate'])
-            comment = answers['comment']
+            optional_energy_rate, comment = optional_resolve_energy_rate(self)\
+                if optional_resolve_energy_rate is not None else self.prompt_energy_rate()
 
         self.optional_energy_details = optional_energy_details
         self.optional_energy_rate = optional_energy_rate
         self.comment = comment
+
+
+# The functions below are the columnar counterparts of the EnergyDetail methods: they operate on
+# whole arrays of energy detail timestamps at once and give exactly the same results.
+
+def parse_energy_detail_timestamps(timestamps: list[str | None]) -> pd.DatetimeIndex:
+    parsed_timestamps = pd.DatetimeIndex(pd.to_datetime(timestamps, format='ISO8601'))
+    if parsed_timestamps.tz is None:
+        assert parsed_timestamps.isna().all(),\
+            'The energy detail timestamps are missing time zone info: %s.' % (parsed_timestamps[~parsed_timestamps.isna()][:5],)
+        return parsed_timestamps.tz_localize(pytz.utc)
+    assert parsed_timestamps.tz.utcoffset(None) == timedelta(0),\
+        'The energy detail timestamps are not in UTC: %s.' % (parsed_timestamps.tz,)
+    return parsed_timestamps
+
+
+def compute_energy_rates(
+        timestamps: pd.DatetimeIndex,
+        tariff: 'Tariff',
+        local_time_converter: LocalTimeConverter = ZRH_LOCAL_TIME_CONVERTER) -> np.ndarray:
+    # Like in EnergyDetail.compute_energy_rate(), the record delay is subtracted from the local
+    # wall-clock time (pytz datetime arithmetic keeps the UTC offset), which matters around DST changes.
+    earliest_wall_clock = local_time_converter.to_wall_clock(timestamps) - TIMESTAMP_RECORD_DELAY
+    return tariff.compute_energy_rates(earliest_wall_clock)
+
+
+def are_in_usage_interval(timestamps: pd.DatetimeIndex, usage_interval: UsageInterval) -> np.ndarray:
+    earliest_timestamps = timestamps - TIMESTAMP_RECORD_DELAY
+    return np.asarray((pd.Timestamp(usage_interval.start_date_time) < earliest_timestamps)
+        & (earliest_timestamps <= pd.Timestamp(usage_interval.end_date_time)))
+
+
+def compute_usage_interval_indices(timestamps: pd.DatetimeIndex, usage_intervals: list[UsageInterval]) -> np.ndarray:
+    # The index of the usage interval that each timestamp is in, like are_in_usage_interval(), or -1, with one
+    # binary search over the interval starts. The usage intervals are sorted and don't overlap.
+    for usage_interval, next_usage_interval in zip(usage_intervals, usage_intervals[1:]):
+        assert usage_interval.end_date_time <= next_usage_interval.start_date_time,\
+            'the usage intervals need to be sorted and not overlap, but %s - %s is followed by %s - %s.' % (
+                usage_interval.start_date_time, usage_interval.end_date_time,
+                next_usage_interval.start_date_time, next_usage_interval.end_date_time)
+    starts = np.array([pd.Timestamp(ui.start_date_time).value for ui in usage_intervals], dtype=np.int64)
+    ends = np.array([pd.Timestamp(ui.end_date_time).value for ui in usage_intervals], dtype=np.int64)
+    earliest_timestamps = (timestamps - TIMESTAMP_RECORD_DELAY).asi8
+    # The last usage interval that starts before the timestamp, which then needs to end at or after it.
+    indices = np.searchsorted(starts, earliest_timestamps, side='left') - 1
+    is_included = (indices >= 0) & (earliest_timestamps <= ends[np.maximum(indices, 0)])
+    return np.where(is_included, indices, -1)
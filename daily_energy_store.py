@@ -0,0 +1,138 @@
+import json
+import sqlite3
+
+from datetime import date, time, timedelta
+from typing import Iterable
+
+from common import EnergyRate, TIMESTAMP_RECORD_DELAY, UsageInterval
+from tariff import Tariff, get_energy_rate_name, make_energy_rate
+
+
+DAILY_ENERGY_STORE_VERSION = 2
+
+
+class DailyEnergy:
+    # The energy is fixed-point, see ENERGY_FIXED_POINT_SCALE, with the number of decimals of the most
+    # precise energy detail.
+    def __init__(self, device_id: str, device_name: str, day: date, energy_rate: EnergyRate | str, energy: int, energy_decimals: int):
+        self.device_id = device_id
+        self.device_name = device_name
+        self.day = day
+        self.energy_rate = energy_rate
+        self.energy = energy
+        self.energy_decimals = energy_decimals
+
+
+def make_tariff_key(tariff: Tariff) -> str:
+    # Everything the energy rate of an energy detail depends on.
+    return json.dumps({
+        'Version': DAILY_ENERGY_STORE_VERSION,
+        'TimestampRecordDelaySeconds': TIMESTAMP_RECORD_DELAY.total_seconds(),
+        'Tariff': tariff.to_json(),
+    }, sort_keys=True)
+
+
+class DailyEnergyStore:
+    # A SQLite database of the energy of each charging station per installation, local day and energy rate, with
+    # the number of decimals of its most precise energy detail, so that sums of days are exactly the sums of their
+    # energy details. A day of an installation is stored once it was processed as a whole, for all its charging
+    # stations, and never changes afterwards, so several installations can share a store. All the days of an
+    # installation are computed with the same tariff settings: opening the store with other ones invalidates its
+    # stored days.
+    def __init__(self, store_file_path: str, installation_id: str, tariff_key: str):
+        self.store_file_path = store_file_path
+        self.installation_id = installation_id
+        self.tariff_key = tariff_key
+        self.connection = sqlite3.connect(store_file_path)
+        with self.connection:
+            # The stores of the first version don't tell the installations apart, so their days are invalidated.
+            self.num_invalidated_days = 0
+            day_columns = [c for _, c, *_ in self.connection.execute('PRAGMA table_info(days)')]
+            if len(day_columns) > 0 and 'installation_id' not in day_columns:
+                self.num_invalidated_days = self.connection.execute('SELECT COUNT(*) FROM days').fetchone()[0]
+                self.connection.execute('DROP TABLE days')
+                self.connection.execute('DROP TABLE IF EXISTS daily_energies')
+
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS days ('
+                'installation_id TEXT NOT NULL, '
+                'day TEXT NOT NULL, '
+                'tariff_key TEXT NOT NULL, '
+                'PRIMARY KEY (installation_id, day))')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS daily_energies ('
+                'installation_id TEXT NOT NULL, '
+                'day TEXT NOT NULL, '
+                'device_id TEXT NOT NULL, '
+                'device_name TEXT NOT NULL, '
+                'energy_rate TEXT NOT NULL, '
+                # Fixed-point, see ENERGY_FIXED_POINT_SCALE.
+                'energy INTEGER NOT NULL, '
+                'energy_decimals INTEGER NOT NULL, '
+                'PRIMARY KEY (installation_id, day, device_id, energy_rate))')
+            self.num_invalidated_days += self.connection.execute(
+                'SELECT COUNT(*) FROM days WHERE installation_id = ? AND tariff_key != ?',
+                (installation_id, tariff_key)).fetchone()[0]
+            self.connection.execute(
+                'DELETE FROM daily_energies WHERE installation_id = ? AND day IN '
+                '(SELECT day FROM days WHERE installation_id = ? AND tariff_key != ?)',
+                (installation_id, installation_id, tariff_key))
+            self.connection.execute(
+                'DELETE FROM days WHERE installation_id = ? AND tariff_key != ?', (installation_id, tariff_key))
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.close()
+
+
+    def get_stored_days(self) -> set[date]:
+        return set(date.fromisoformat(d) for (d,) in self.connection.execute(
+            'SELECT day FROM days WHERE installation_id = ?', (self.installation_id,)))
+
+
+    def read_daily_energies(self, days: Iterable[date]) -> list[DailyEnergy]:
+        # The days are usually a range, which the primary key finds; the stored days in between that weren't
+        # asked for are skipped.
+        day_texts = set(d.isoformat() for d in days)
+        if len(day_texts) == 0:
+            return []
+        return [
+            DailyEnergy(device_id, device_name, date.fromisoformat(day), make_energy_rate(energy_rate), energy, energy_decimals)
+            for day, device_id, device_name, energy_rate, energy, energy_decimals in self.connection.execute(
+                'SELECT day, device_id, device_name, energy_rate, energy, energy_decimals FROM daily_energies '
+                'WHERE installation_id = ? AND day BETWEEN ? AND ? '
+                'ORDER BY day, device_id, energy_rate',
+                (self.installation_id, min(day_texts), max(day_texts)))
+            if day in day_texts]
+
+
+    def write_daily_energies(self, days: Iterable[date], daily_energies: Iterable[DailyEnergy]) -> None:
+        # The days are stored as a whole, also those without any energy, in one transaction.
+        day_texts = sorted(d.isoformat() for d in days)
+        with self.connection:
+            self.connection.executemany(
+                'DELETE FROM daily_energies WHERE installation_id = ? AND day = ?',
+                [(self.installation_id, d) for d in day_texts])
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO days (installation_id, day, tariff_key) VALUES (?, ?, ?)',
+                [(self.installation_id, d, self.tariff_key) for d in day_texts])
+            self.connection.executemany(
+                'INSERT INTO daily_energies '
+                '(installation_id, day, device_id, device_name, energy_rate, energy, energy_decimals) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(self.installation_id, de.day.isoformat(), de.device_id, de.device_name, get_energy_rate_name(de.energy_rate),
+                    int(de.energy), int(de.energy_decimals))
+                    for de in daily_energies])
+
+
+def get_whole_days(usage_interval: UsageInterval) -> list[date]:
+    # The local days that are entirely in the usage interval. An energy detail belongs to the day that it's
+    # in, or that it ends at midnight, like it belongs to a usage interval.
+    start_date_time = usage_interval.start_date_time
+    first_day = start_date_time.date() if start_date_time.time() == time() else start_date_time.date() + timedelta(days=1)
+    end_day = usage_interval.end_date_time.date()
+    return [first_day + timedelta(days=i) for i in range(max((end_day - first_day).days, 0))]
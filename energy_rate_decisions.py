@@ -0,0 +1,183 @@
+import json
+import os
+
+from datetime import datetime, timedelta
+from enum import Enum
+
+from chargehistory_cache import get_charge_session_key
+from common import ChargeSession, EnergyRate
+from tariff import Tariff, get_energy_rate_name, make_energy_rate
+
+
+class MissingEnergyDetailsMode(str, Enum):
+    # Ask for the energy rate of every new charge session without energy details.
+    PROMPT = 'prompt'
+    # Classify new charge sessions without energy details by their start and end, without asking.
+    RULES = 'rules'
+
+
+class DecisionSource(str, Enum):
+    PROMPT = 'prompt'
+    RULES = 'rules'
+    AMBIGUOUS_RULES = 'ambiguous-rules'
+
+
+# How many new decisions by rules are kept in memory before the decisions file is written again; decisions that
+# were prompted for are written right away.
+DECISIONS_SAVE_INTERVAL = 1000
+
+RULES_COMMENT_LOCALES = {
+    'de-CH': {
+        DecisionSource.RULES: 'Automatisch anhand von Beginn und Ende bestimmt',
+        DecisionSource.AMBIGUOUS_RULES: 'Automatisch bestimmt, nicht eindeutig: %s',
+    },
+}
+# The comments without a locale, like the tables named by their keys.
+RULES_COMMENTS = {
+    DecisionSource.RULES: 'Decided by rules from the start and end',
+    DecisionSource.AMBIGUOUS_RULES: 'Decided by rules, ambiguous: %s',
+}
+
+
+def compute_energy_rate_durations(
+        start_date_time: datetime,
+        end_date_time: datetime,
+        tariff: Tariff) -> dict[EnergyRate | str, timedelta]:
+    # How long a charge session spent in each energy rate, from its local wall-clock start and end, as the
+    # overlap with the energy rate segments of each day it touched.
+    start_date_time = start_date_time.replace(tzinfo=None)
+    end_date_time = end_date_time.replace(tzinfo=None)
+
+    energy_rate_durations = {}
+    day = datetime.combine(start_date_time.date(), datetime.min.time())
+    while day <= end_date_time:
+        for start_second, end_second, energy_rate in tariff.get_day_segments(day.date()):
+            segment_start_date_time = max(start_date_time, day + timedelta(seconds=start_second))
+            segment_end_date_time = min(end_date_time, day + timedelta(seconds=end_second))
+            if segment_start_date_time < segment_end_date_time:
+                energy_rate_durations[energy_rate] = energy_rate_durations.get(energy_rate, timedelta(0))\
+                    + segment_end_date_time - segment_start_date_time
+        day += timedelta(days=1)
+    if len(energy_rate_durations) == 0:
+        energy_rate_durations[tariff.compute_energy_rate(end_date_time)] = timedelta(0)
+    return energy_rate_durations
+
+
+class EnergyRateResolver:
+    # Resolves the energy rate of charge sessions without energy details, either interactively or by rules,
+    # and remembers the decisions in an optional decisions file, keyed by charge session, so that they are
+    # reused by later runs. Only the ambiguous decisions taken by rules in this run are reported at the end.
+    ENERGY_RATE_KEY = 'EnergyRate'
+    COMMENT_KEY = 'Comment'
+    SOURCE_KEY = 'Source'
+
+    def __init__(
+            self,
+            mode: MissingEnergyDetailsMode,
+            tariff: Tariff,
+            optional_decisions_file_path: str | None = None,
+            optional_locale: str | None = 'de-CH'):
+        self.mode = mode
+        self.tariff = tariff
+        self.optional_decisions_file_path = optional_decisions_file_path
+        self.optional_locale = optional_locale
+
+        self.decisions = {}
+        if optional_decisions_file_path is not None and os.path.exists(optional_decisions_file_path):
+            with open(optional_decisions_file_path) as decisions_file:
+                self.decisions = json.load(decisions_file)
+
+        self.num_unsaved_decisions = 0
+        self.num_reused_decisions = 0
+        self.new_decision_sources = []
+        self.new_ambiguous_charge_sessions = []
+
+
+    def save_decisions(self) -> None:
+        # Replaces the decisions file at once, so that an interrupted write leaves the previous one.
+        if self.optional_decisions_file_path is None or self.num_unsaved_decisions == 0:
+            return
+        temporary_file_path = self.optional_decisions_file_path + '.tmp'
+        with open(temporary_file_path, 'w') as decisions_file:
+            json.dump(self.decisions, decisions_file, indent=2, ensure_ascii=False)
+            decisions_file.flush()
+            os.fsync(decisions_file.fileno())
+        os.replace(temporary_file_path, self.optional_decisions_file_path)
+        self.num_unsaved_decisions = 0
+
+
+    def _get_rules_comment(self, source: DecisionSource) -> str:
+        return RULES_COMMENT_LOCALES[self.optional_locale][source] if self.optional_locale is not None\
+            else RULES_COMMENTS[source]
+
+
+    def _get_energy_rate_text(self, energy_rate: EnergyRate | str) -> str:
+        return self.tariff.get_energy_rate_text(energy_rate, self.optional_locale) if self.optional_locale is not None\
+            else get_energy_rate_name(energy_rate)
+
+
+    def _decide_by_rules(self, charge_session: ChargeSession) -> tuple[EnergyRate | str, str, DecisionSource]:
+        energy_rate_durations = compute_energy_rate_durations(
+            charge_session.start_date_time, charge_session.end_date_time, self.tariff)
+        # The energy rate in which the charge session spent most of its time.
+        energy_rate = max(energy_rate_durations, key=lambda er: (energy_rate_durations[er], er))
+        if len(energy_rate_durations) == 1:
+            return energy_rate, self._get_rules_comment(DecisionSource.RULES), DecisionSource.RULES
+
+        self.new_ambiguous_charge_sessions.append((charge_session, energy_rate, energy_rate_durations))
+        comment = self._get_rules_comment(DecisionSource.AMBIGUOUS_RULES) % (', '.join(
+            '%s %s' % (self._get_energy_rate_text(er), d) for er, d in sorted(energy_rate_durations.items())),)
+        return energy_rate, comment, DecisionSource.AMBIGUOUS_RULES
+
+
+    def resolve(self, charge_session: ChargeSession) -> tuple[EnergyRate | str, str]:
+        key = get_charge_session_key(charge_session.raw_charge_session)
+        if key in self.decisions:
+            self.num_reused_decisions += 1
+            decision = self.decisions[key]
+            energy_rate = make_energy_rate(decision[EnergyRateResolver.ENERGY_RATE_KEY])
+            assert energy_rate in self.tariff.energy_rates,\
+                'the decided energy rate %s of charge session %s is not one of the tariff energy rates: %s.' % (
+                    energy_rate, key, self.tariff.energy_rates)
+            return energy_rate, decision[EnergyRateResolver.COMMENT_KEY]
+
+        if self.mode == MissingEnergyDetailsMode.PROMPT:
+            energy_rate, comment = charge_session.prompt_energy_rate(self.tariff.energy_rates)
+            source = DecisionSource.PROMPT
+        else:
+            energy_rate, comment, source = self._decide_by_rules(charge_session)
+
+        self.new_decision_sources.append(source)
+        self.decisions[key] = {
+            EnergyRateResolver.ENERGY_RATE_KEY: get_energy_rate_name(energy_rate),
+            EnergyRateResolver.COMMENT_KEY: comment,
+            EnergyRateResolver.SOURCE_KEY: source.value,
+        }
+        self.num_unsaved_decisions += 1
+        if source == DecisionSource.PROMPT or self.num_unsaved_decisions >= DECISIONS_SAVE_INTERVAL:
+            self.save_decisions()
+        return energy_rate, comment
+
+
+    def print_summary(self) -> None:
+        if self.num_reused_decisions == 0 and len(self.new_decision_sources) == 0:
+            return
+        print('Charge sessions without energy details: %d decision(s) reused, %d new (%s).' % (
+            self.num_reused_decisions,
+            len(self.new_decision_sources),
+            ', '.join('%d by %s' % (self.new_decision_sources.count(s), s.value) for s in DecisionSource
+                if s in self.new_decision_sources) or 'none'))
+
+        if len(self.new_ambiguous_charge_sessions) == 0:
+            return
+        print('These new charge sessions were ambiguous; they were given the energy rate they spent most time in%s:' % (
+            ', which can be changed in %s' % (self.optional_decisions_file_path,)
+            if self.optional_decisions_file_path is not None else '',))
+        for charge_session, energy_rate, energy_rate_durations in self.new_ambiguous_charge_sessions:
+            print('  %s (%s): %s - %s, %s -> %s' % (
+                charge_session.device_id,
+                charge_session.device_name,
+                charge_session.start_date_time,
+                charge_session.end_date_time,
+                ', '.join('%s %s' % (get_energy_rate_name(er), d) for er, d in sorted(energy_rate_durations.items())),
+                get_energy_rate_name(energy_rate)))
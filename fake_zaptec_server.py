@@ -0,0 +1,393 @@
+import argparse
+import bisect
+import json
+import random
+import threading
+import time
+
+from collections import deque
+from datetime import datetime, timezone
+from decimal import Decimal
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from chargehistory_generator import add_generator_arguments, generate_chargehistory_sessions_from_args
+from chargehistory_io import DATA_KEY, read_chargehistory_sessions
+from common import ChargeSession
+
+
+AUTH_PATH = '/oauth/token'
+CHARGEHISTORY_PATH = '/api/chargehistory'
+PAGES_KEY = 'Pages'
+
+DEFAULT_PORT = 8080
+DEFAULT_TOKEN_LIFETIME_SECONDS = 3600
+DEFAULT_RATE_LIMIT_CALLS = 900
+DEFAULT_RATE_LIMIT_PERIOD_SECONDS = 60
+# The statuses of the injected server errors.
+ERROR_STATUS_CODES = (HTTPStatus.INTERNAL_SERVER_ERROR, HTTPStatus.BAD_GATEWAY, HTTPStatus.SERVICE_UNAVAILABLE)
+
+
+def _parse_naive_utc(date_time_text: str) -> datetime:
+    # The query datetimes have time zone info, and the charge session datetimes are UTC without it.
+    date_time = datetime.fromisoformat(date_time_text)
+    if date_time.tzinfo is not None:
+        date_time = date_time.astimezone(timezone.utc).replace(tzinfo=None)
+    return date_time
+
+
+class FakeZaptecApi:
+    # The state of a local stand-in for the Zaptec API, shared by the threads of the server: the charge sessions,
+    # sorted by start, the access tokens that were handed out, the rate limit window, and counters. Every
+    # installation ID has the same charge sessions.
+    def __init__(
+            self,
+            charge_sessions: list[dict],
+            latency_seconds: float = 0.0,
+            latency_jitter_seconds: float = 0.0,
+            error_rate: float = 0.0,
+            throttle_rate: float = 0.0,
+            retry_after_seconds: float = 1.0,
+            rate_limit_calls: int | None = DEFAULT_RATE_LIMIT_CALLS,
+            rate_limit_period_seconds: float = DEFAULT_RATE_LIMIT_PERIOD_SECONDS,
+            token_lifetime_seconds: float = DEFAULT_TOKEN_LIFETIME_SECONDS,
+            optional_password: str | None = None,
+            optional_max_page_size: int | None = None,
+            seed: int = 0):
+        assert 0 <= error_rate <= 1, 'the error rate needs to be in [0, 1], but it was: %s.' % (error_rate,)
+        assert 0 <= throttle_rate <= 1, 'the throttle rate needs to be in [0, 1], but it was: %s.' % (throttle_rate,)
+        assert rate_limit_calls is None or rate_limit_calls > 0,\
+            'the rate limit calls need to be > 0, but they were: %d.' % (rate_limit_calls,)
+        assert optional_max_page_size is None or optional_max_page_size > 0,\
+            'the maximum page size needs to be > 0, but it was: %d.' % (optional_max_page_size,)
+
+        self.charge_sessions = sorted(
+            charge_sessions, key=lambda s: _parse_naive_utc(s[ChargeSession.Key.START_DATE_TIME]))
+        self.start_date_times = [_parse_naive_utc(s[ChargeSession.Key.START_DATE_TIME]) for s in self.charge_sessions]
+        self.latency_seconds = latency_seconds
+        self.latency_jitter_seconds = latency_jitter_seconds
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after_seconds = retry_after_seconds
+        self.rate_limit_calls = rate_limit_calls
+        self.rate_limit_period_seconds = rate_limit_period_seconds
+        self.token_lifetime_seconds = token_lifetime_seconds
+        self.optional_password = optional_password
+        self.optional_max_page_size = optional_max_page_size
+
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+        self.access_token_to_expiry = {}
+        self.call_times = deque()
+        self.counters = {
+            'token_requests': 0,
+            'chargehistory_requests': 0,
+            'charge_sessions_served': 0,
+            'injected_errors': 0,
+            'injected_throttles': 0,
+            'rate_limited': 0,
+            'unauthorized': 0,
+        }
+
+
+    def increment(self, name: str, value: int = 1) -> None:
+        with self.lock:
+            self.counters[name] += value
+
+
+    def sleep_latency(self) -> None:
+        with self.lock:
+            latency_seconds = max(0.0, self.latency_seconds + self.rng.uniform(
+                -self.latency_jitter_seconds, self.latency_jitter_seconds))
+        time.sleep(latency_seconds)
+
+
+    def draw_injected_failure(self) -> HTTPStatus | None:
+        # An injected throttling or server error, or None.
+        with self.lock:
+            draw = self.rng.random()
+            if draw < self.throttle_rate:
+                self.counters['injected_throttles'] += 1
+                return HTTPStatus.TOO_MANY_REQUESTS
+            if draw < self.throttle_rate + self.error_rate:
+                self.counters['injected_errors'] += 1
+                return self.rng.choice(ERROR_STATUS_CODES)
+        return None
+
+
+    def acquire_rate_limit(self) -> tuple[bool, dict[str, str]]:
+        # Whether the call is within the rate limit, which is a sliding window over all the calls, with the rate
+        # limit headers of the response.
+        if self.rate_limit_calls is None:
+            return True, {}
+        now = time.monotonic()
+        with self.lock:
+            while len(self.call_times) > 0 and self.call_times[0] <= now - self.rate_limit_period_seconds:
+                self.call_times.popleft()
+            is_allowed = len(self.call_times) < self.rate_limit_calls
+            if is_allowed:
+                self.call_times.append(now)
+            else:
+                self.counters['rate_limited'] += 1
+            reset_seconds = self.call_times[0] + self.rate_limit_period_seconds - now if len(self.call_times) > 0 else 0
+            headers = {
+                'X-RateLimit-Limit': str(self.rate_limit_calls),
+                'X-RateLimit-Remaining': str(self.rate_limit_calls - len(self.call_times)),
+                'X-RateLimit-Reset': str(max(1, round(reset_seconds))),
+            }
+        return is_allowed, headers
+
+
+    def issue_access_token(self, username: str, password: str) -> dict | None:
+        # The auth response json, or None if the password is wrong.
+        if self.optional_password is not None and password != self.optional_password:
+            return None
+        with self.lock:
+            self.counters['token_requests'] += 1
+            access_token = 'fake-token-%d-%s' % (self.counters['token_requests'], username)
+            self.access_token_to_expiry[access_token] = time.monotonic() + self.token_lifetime_seconds
+        return {
+            'access_token': access_token,
+            'token_type': 'Bearer',
+            'expires_in': self.token_lifetime_seconds,
+        }
+
+
+    def is_authorized(self, optional_authorization: str | None) -> bool:
+        BEARER_PREFIX = 'Bearer '
+
+        if optional_authorization is None or not optional_authorization.startswith(BEARER_PREFIX):
+            return False
+        with self.lock:
+            optional_expiry = self.access_token_to_expiry.get(optional_authorization[len(BEARER_PREFIX):])
+        return optional_expiry is not None and time.monotonic() < optional_expiry
+
+
+    def get_chargehistory_page(self, params: dict[str, str]) -> dict:
+        # Like the API: the charge sessions that start in [From, To), in pages of PageSize, at the summary level
+        # (0) without their energy details. With a maximum page size, larger pages are cut to it, e.g. to
+        # paginate a few charge sessions.
+        from_date_time = _parse_naive_utc(params['From'])
+        to_date_time = _parse_naive_utc(params['To'])
+        page_size = int(params.get('PageSize', 50))
+        if self.optional_max_page_size is not None:
+            page_size = min(page_size, self.optional_max_page_size)
+        page_index = int(params.get('PageIndex', 0))
+        detail_level = int(params.get('DetailLevel', 0))
+        assert page_size > 0, 'the page size needs to be > 0, but it was: %d.' % (page_size,)
+
+        first = bisect.bisect_left(self.start_date_times, from_date_time)
+        last = bisect.bisect_left(self.start_date_times, to_date_time, lo=first)
+        num_pages = (last - first + page_size - 1) // page_size
+        page_start = min(first + page_index * page_size, last)
+        charge_sessions = self.charge_sessions[page_start:min(page_start + page_size, last)]
+        if detail_level == 0:
+            charge_sessions = [
+                {k: v for k, v in s.items() if k != ChargeSession.Key.ENERGY_DETAILS} for s in charge_sessions]
+        self.increment('charge_sessions_served', len(charge_sessions))
+        return {PAGES_KEY: num_pages, DATA_KEY: charge_sessions}
+
+
+class FakeZaptecRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive connections, like the API.
+    protocol_version = 'HTTP/1.1'
+    # Set on a subclass per server.
+    api: FakeZaptecApi = None
+    verbose = False
+
+
+    def log_message(self, format: str, *args) -> None:
+        if self.verbose:
+            super().log_message(format, *args)
+
+
+    def send_json(self, status: HTTPStatus, response_json, headers: dict[str, str] = {}) -> None:
+        body = json.dumps(response_json, default=float).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def send_failure(self, status: HTTPStatus, headers: dict[str, str] = {}) -> None:
+        if status == HTTPStatus.TOO_MANY_REQUESTS:
+            headers = dict(headers, **{'Retry-After': '%g' % (self.api.retry_after_seconds,)})
+        self.send_json(status, {'Message': status.phrase}, headers)
+
+
+    def handle_api_call(self, handle) -> None:
+        # The latency, rate limit and injected failures apply to every call.
+        self.api.sleep_latency()
+        is_allowed, headers = self.api.acquire_rate_limit()
+        if not is_allowed:
+            self.send_failure(HTTPStatus.TOO_MANY_REQUESTS, headers)
+            return
+        optional_failure = self.api.draw_injected_failure()
+        if optional_failure is not None:
+            self.send_failure(optional_failure, headers)
+            return
+        handle(headers)
+
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        if urlparse(self.path).path != AUTH_PATH:
+            self.send_failure(HTTPStatus.NOT_FOUND)
+            return
+
+        def handle(headers: dict[str, str]) -> None:
+            form = {k: v[0] for k, v in parse_qs(body).items()}
+            optional_response_json = self.api.issue_access_token(form.get('username', ''), form.get('password', ''))
+            if optional_response_json is None:
+                self.send_json(HTTPStatus.BAD_REQUEST, {'error': 'invalid_grant'}, headers)
+                return
+            self.send_json(HTTPStatus.OK, optional_response_json, headers)
+
+        self.handle_api_call(handle)
+
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        if url.path != CHARGEHISTORY_PATH:
+            self.send_failure(HTTPStatus.NOT_FOUND)
+            return
+
+        def handle(headers: dict[str, str]) -> None:
+            if not self.api.is_authorized(self.headers.get('Authorization')):
+                self.api.increment('unauthorized')
+                self.send_failure(HTTPStatus.UNAUTHORIZED, headers)
+                return
+            self.api.increment('chargehistory_requests')
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            self.send_json(HTTPStatus.OK, self.api.get_chargehistory_page(params), headers)
+
+        self.handle_api_call(handle)
+
+
+def start_fake_zaptec_server(
+        api: FakeZaptecApi,
+        host: str = '127.0.0.1',
+        port: int = DEFAULT_PORT,
+        verbose: bool = False) -> ThreadingHTTPServer:
+    # Serves in a daemon thread, e.g. for tests and benchmarks in the same process; port 0 picks a free port,
+    # and the base URL is then 'http://%s:%d' % server.server_address. server.shutdown() stops it.
+    handler_class = type('BoundFakeZaptecRequestHandler', (FakeZaptecRequestHandler,), {'api': api, 'verbose': verbose})
+    server = ThreadingHTTPServer((host, port), handler_class)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve a local stand-in for the Zaptec API \'/oauth/token\' and \'/api/chargehistory\' '
+        'endpoints, with synthetic charge sessions, e.g. to test or benchmark \'usage_fetcher.py\' with '
+        '--base_url http://127.0.0.1:%d.' % (DEFAULT_PORT,))
+
+    parser.add_argument(
+        '--host',
+        default='127.0.0.1',
+        help='the address to listen on (default: %(default)s)')
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=DEFAULT_PORT,
+        help='the port to listen on (default: %(default)s)')
+    parser.add_argument(
+        '--chargehistory_file_path',
+        help='serve the charge sessions of this chargehistory, in any of the formats that \'usage_processor.py\' '
+        'reads except .npz, instead of generated ones')
+    parser.add_argument(
+        '--latency_ms',
+        type=float,
+        default=50,
+        help='the latency of every response, in milliseconds (default: %(default)s)')
+    parser.add_argument(
+        '--latency_jitter_ms',
+        type=float,
+        default=20,
+        help='the latency varies uniformly by up to this much, in milliseconds (default: %(default)s)')
+    parser.add_argument(
+        '--error_rate',
+        type=float,
+        default=0,
+        help='the fraction of responses that are server errors (500, 502 or 503) (default: %(default)s)')
+    parser.add_argument(
+        '--throttle_rate',
+        type=float,
+        default=0,
+        help='the fraction of responses that are throttled (429), besides the rate limit (default: %(default)s)')
+    parser.add_argument(
+        '--retry_after_seconds',
+        type=float,
+        default=1,
+        help='the Retry-After of the throttled responses (default: %(default)s)')
+    parser.add_argument(
+        '--rate_limit_calls',
+        type=int,
+        default=DEFAULT_RATE_LIMIT_CALLS,
+        help='the number of calls per rate limit period, over all the clients, after which calls are throttled '
+        '(429); 0 disables the rate limit (default: %(default)s)')
+    parser.add_argument(
+        '--rate_limit_period_seconds',
+        type=float,
+        default=DEFAULT_RATE_LIMIT_PERIOD_SECONDS,
+        help='the sliding window of the rate limit (default: %(default)s)')
+    parser.add_argument(
+        '--token_lifetime_seconds',
+        type=float,
+        default=DEFAULT_TOKEN_LIFETIME_SECONDS,
+        help='how long the access tokens are valid; expired tokens are rejected (401) (default: %(default)s)')
+    parser.add_argument(
+        '--password',
+        help='the password that every username needs; if unspecified, any password is accepted')
+    parser.add_argument(
+        '--max_page_size',
+        type=int,
+        help='serve at most this many charge sessions per page, even if more were asked for; if unspecified, '
+        'the page size of the request')
+    parser.add_argument(
+        '--verbose',
+        action='store_true',
+        help='log every request')
+    add_generator_arguments(parser)
+
+    args = parser.parse_args()
+
+    if args.chargehistory_file_path is not None:
+        charge_sessions = list(read_chargehistory_sessions(args.chargehistory_file_path, parse_float=Decimal))
+    else:
+        # Up to now at most, since the API only has past charge sessions.
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        charge_sessions = [
+            s for s in generate_chargehistory_sessions_from_args(args)
+            if datetime.fromisoformat(s[ChargeSession.Key.COMMIT_END_DATE_TIME]) < now]
+    api = FakeZaptecApi(
+        charge_sessions=charge_sessions,
+        latency_seconds=args.latency_ms / 1000,
+        latency_jitter_seconds=args.latency_jitter_ms / 1000,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after_seconds=args.retry_after_seconds,
+        rate_limit_calls=args.rate_limit_calls or None,
+        rate_limit_period_seconds=args.rate_limit_period_seconds,
+        token_lifetime_seconds=args.token_lifetime_seconds,
+        optional_password=args.password,
+        optional_max_page_size=args.max_page_size,
+        seed=args.seed)
+    server = start_fake_zaptec_server(api, args.host, args.port, args.verbose)
+    print('Serving %d charge sessions (%s - %s) at http://%s:%d, stop with Ctrl-C.' % (
+        len(api.charge_sessions),
+        api.start_date_times[0] if len(api.start_date_times) > 0 else '-',
+        api.start_date_times[-1] if len(api.start_date_times) > 0 else '-',
+        *server.server_address))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(json.dumps(api.counters, indent=2))
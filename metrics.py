@@ -0,0 +1,212 @@
+import argparse
+import json
+import platform
+import sys
+import threading
+import timeit
+import tracemalloc
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Iterable, Iterator
+
+try:
+    import resource
+except ImportError:
+    # E.g. on Windows, where the maximum resident set size isn't available.
+    resource = None
+
+
+METRICS_VERSION = 1
+
+
+def get_optional_max_rss_bytes() -> int | None:
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # In bytes on macOS, but in kilobytes elsewhere.
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class Metrics:
+    # Wall time and memory per stage, and counters, for the whole process. Nothing is recorded until enable()
+    # is called, so the instrumentation costs next to nothing otherwise. Stages can be nested, and are then
+    # identified by their path, e.g. 'excel_export/sheet'.
+    #
+    # Each stage records the maximum resident set size of the process when it ends, which is cheap, but never
+    # decreases: a stage only used more memory than all the previous ones if it increased it. With
+    # trace_memory, the exact peak of the Python allocations during each stage of the main thread is also
+    # traced with tracemalloc, which makes everything a few times slower.
+    def __init__(self):
+        self.enabled = False
+        self.started_at = None
+        self.stages = []
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.thread_local = threading.local()
+
+
+    def enable(self, trace_memory: bool = False) -> None:
+        self.enabled = True
+        self.started_at = datetime.now(timezone.utc)
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+
+    def _get_stage_stack(self) -> list:
+        if not hasattr(self.thread_local, 'stage_stack'):
+            self.thread_local.stage_stack = []
+        return self.thread_local.stage_stack
+
+
+    def _is_tracing_memory(self) -> bool:
+        return tracemalloc.is_tracing() and threading.current_thread() is threading.main_thread()
+
+
+    def _record_stage(self, path: str, seconds: float, optional_peak_memory_bytes: int | None, attributes: dict) -> None:
+        stage_json = {'Stage': path, 'Seconds': seconds}
+        optional_max_rss_bytes = get_optional_max_rss_bytes()
+        if optional_max_rss_bytes is not None:
+            stage_json['MaxRssBytes'] = optional_max_rss_bytes
+        if optional_peak_memory_bytes is not None:
+            stage_json['PeakMemoryBytes'] = optional_peak_memory_bytes
+        if len(attributes) > 0:
+            stage_json['Attributes'] = attributes
+        with self.lock:
+            self.stages.append(stage_json)
+
+
+    @contextmanager
+    def stage(self, name: str, nested: bool = True, **attributes):
+        # Stages that run in several threads, e.g. page fetches, aren't nested, so that they all have the same path.
+        if not self.enabled:
+            yield
+            return
+
+        stage_stack = self._get_stage_stack()
+        path = '/'.join([s['Path'] for s in stage_stack[-1:] if nested] + [name])
+        # The peak of the enclosing stage is saved before resetting it for this one.
+        is_tracing_memory = self._is_tracing_memory()
+        if is_tracing_memory:
+            if len(stage_stack) > 0:
+                stage_stack[-1]['PeakMemoryBytes'] = max(stage_stack[-1]['PeakMemoryBytes'], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        stage = {'Path': path, 'PeakMemoryBytes': 0}
+        stage_stack.append(stage)
+
+        start_time = timeit.default_timer()
+        try:
+            yield
+        finally:
+            seconds = timeit.default_timer() - start_time
+            stage_stack.pop()
+            optional_peak_memory_bytes = None
+            if is_tracing_memory:
+                optional_peak_memory_bytes = max(stage['PeakMemoryBytes'], tracemalloc.get_traced_memory()[1])
+                if len(stage_stack) > 0:
+                    stage_stack[-1]['PeakMemoryBytes'] = max(stage_stack[-1]['PeakMemoryBytes'], optional_peak_memory_bytes)
+            self._record_stage(path, seconds, optional_peak_memory_bytes, attributes)
+
+
+    def timed_iterator(self, name: str, iterable: Iterable) -> Iterator:
+        # Records the time spent producing the items, e.g. reading them from a file, as one stage, without the
+        # time spent by the caller on each item.
+        if not self.enabled:
+            yield from iterable
+            return
+
+        stage_stack = self._get_stage_stack()
+        path = '/'.join([s['Path'] for s in stage_stack[-1:]] + [name])
+        iterator = iter(iterable)
+        seconds = 0.0
+        num_items = 0
+        while True:
+            start_time = timeit.default_timer()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                seconds += timeit.default_timer() - start_time
+                break
+            seconds += timeit.default_timer() - start_time
+            num_items += 1
+            yield item
+        self._record_stage(path, seconds, None, {'Items': num_items})
+
+
+    def increment(self, name: str, amount: int | float = 1) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+
+    def to_json(self) -> dict:
+        with self.lock:
+            return {
+                'Version': METRICS_VERSION,
+                'StartedAt': self.started_at.isoformat() if self.started_at is not None else None,
+                'Python': platform.python_version(),
+                'Stages': list(self.stages),
+                'Counters': dict(sorted(self.counters.items())),
+            }
+
+
+    def write_json(self, metrics_file_path: str) -> None:
+        with open(metrics_file_path, 'w') as metrics_file:
+            json.dump(self.to_json(), metrics_file, indent=2)
+
+
+    def print_report(self) -> None:
+        # The stages with the same path are aggregated, in the order they were first recorded.
+        path_to_stages = {}
+        with self.lock:
+            for stage_json in self.stages:
+                path_to_stages.setdefault(stage_json['Stage'], []).append(stage_json)
+            counters = dict(sorted(self.counters.items()))
+
+        def format_optional_megabytes(stages: list[dict], key: str) -> str:
+            values = [s[key] for s in stages if key in s]
+            return '%.1f' % (max(values) / 1e6,) if len(values) > 0 else '-'
+
+        print('%-40s %6s %10s %10s %13s %17s' % (
+            'stage', 'count', 'total (s)', 'max (s)', 'max RSS (MB)', 'traced peak (MB)'))
+        for path, stages in path_to_stages.items():
+            print('%-40s %6d %10.3f %10.3f %13s %17s' % (
+                path,
+                len(stages),
+                sum(s['Seconds'] for s in stages),
+                max(s['Seconds'] for s in stages),
+                format_optional_megabytes(stages, 'MaxRssBytes'),
+                format_optional_megabytes(stages, 'PeakMemoryBytes')))
+        for name, value in counters.items():
+            print('%-40s %s' % (name, '%.3f' % (value,) if isinstance(value, float) else value))
+
+
+METRICS = Metrics()
+
+
+def add_metrics_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='print the wall time and memory of each stage, and the counters, at the end')
+    parser.add_argument(
+        '--metrics_out',
+        help='the path to which to write the wall time and memory of each stage, and the counters, as JSON')
+    parser.add_argument(
+        '--trace_memory',
+        action='store_true',
+        help='with --profile or --metrics_out, also trace the exact peak memory of each stage with tracemalloc, '
+        'which makes everything a few times slower')
+
+
+def enable_metrics_from_args(args: argparse.Namespace) -> None:
+    if args.profile or args.metrics_out is not None:
+        METRICS.enable(trace_memory=args.trace_memory)
+
+
+def report_metrics(args: argparse.Namespace) -> None:
+    if args.profile:
+        METRICS.print_report()
+    if args.metrics_out is not None:
+        METRICS.write_json(args.metrics_out)
@@ -2,9 +2,7 @@
 
 source args.sh \
 && \
-python3 usage_fetcher.py $USERNAME $INSTALLATION_ID $USAGE_INTERVAL_START \
-    $USAGE_INTERVAL_END $NUM_CHARGING_STATIONS "$CHARGEHISTORY_FILE_NAME" \
-&& \
-python3 usage_processor.py "$CHARGEHISTORY_FILE_NAME" $USAGE_INTERVAL_START \
-    $USAGE_INTERVAL_END "$EXCEL_FILE_NAME" --weekday_high_rate_interval \
+python3 usage_pipeline.py $USERNAME $INSTALLATION_ID $USAGE_INTERVAL_START \
+    $USAGE_INTERVAL_END $NUM_CHARGING_STATIONS "$EXCEL_FILE_NAME" \
+    --raw_output_file "$CHARGEHISTORY_FILE_NAME" --weekday_high_rate_interval \
     $WEEKDAY_HIGH_RATE_INTERVAL
@@ -0,0 +1,89 @@
+import os
+
+import pandas as pd
+
+from decimal import Decimal
+from enum import Enum
+
+from xlsx_writer import StreamingXlsxWriter
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # Only needed for the Parquet export.
+    pyarrow = None
+
+
+class ExportFormat(str, Enum):
+    EXCEL = 'excel'
+    CSV = 'csv'
+    PARQUET = 'parquet'
+
+
+CSV_SUFFIX = '.csv'
+PARQUET_SUFFIX = '.parquet'
+
+
+class _TableDirectoryWriter:
+    # Writes each sheet as its own file in a directory, named after the sheet. The formatting of the index
+    # columns only applies to Excel.
+    suffix = None
+
+    def __init__(self, dir_path: str):
+        os.makedirs(dir_path, exist_ok=True)
+        self.dir_path = dir_path
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+    def get_file_path(self, sheet_name: str) -> str:
+        assert os.sep not in sheet_name and sheet_name not in ('', '.', '..'),\
+            'the table name needs to be a valid file name, but it was: %s.' % (sheet_name,)
+        return os.path.join(self.dir_path, sheet_name + self.suffix)
+
+
+class CsvTableWriter(_TableDirectoryWriter):
+    # The datetimes are written in ISO format, with their UTC offset if they have one, and the Decimals as their
+    # exact text.
+    suffix = CSV_SUFFIX
+
+    def write_sheet(self, sheet_name: str, df: pd.DataFrame, num_index_columns: int = 0) -> None:
+        df.to_csv(self.get_file_path(sheet_name), index=False, date_format='%Y-%m-%dT%H:%M:%S%z')
+
+
+def _to_arrow_array(column: pd.Series):
+    # The energies are Decimals, or 0 where a summary has none, and are written as exact decimals.
+    if column.dtype == object and any(isinstance(v, Decimal) for v in column):
+        return pyarrow.array([Decimal(v) if isinstance(v, int) else v for v in column])
+    return pyarrow.array(column, from_pandas=True)
+
+
+class ParquetTableWriter(_TableDirectoryWriter):
+    suffix = PARQUET_SUFFIX
+
+    def __init__(self, dir_path: str):
+        assert pyarrow is not None, 'the Parquet export needs the pyarrow package: pip install pyarrow.'
+        super().__init__(dir_path)
+
+
+    def write_sheet(self, sheet_name: str, df: pd.DataFrame, num_index_columns: int = 0) -> None:
+        table = pyarrow.Table.from_arrays(
+            [_to_arrow_array(df.iloc[:, i]) for i in range(len(df.columns))],
+            names=[str(c) for c in df.columns])
+        pyarrow.parquet.write_table(table, self.get_file_path(sheet_name))
+
+
+def open_table_writer(export_format: ExportFormat, output_path: str):
+    # An Excel export is a workbook with a sheet per table; the others are a directory with a file per table.
+    if export_format == ExportFormat.EXCEL:
+        return StreamingXlsxWriter(output_path)
+    if export_format == ExportFormat.CSV:
+        return CsvTableWriter(output_path)
+    return ParquetTableWriter(output_path)
@@ -0,0 +1,318 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from datetime import date, datetime, time, timedelta
+from enum import Enum
+
+from common import ENERGY_RATE_LOCALES, EnergyRate, HighRateInterval, is_timezone_naive
+
+
+SECONDS_PER_DAY = 24 * 60 * 60
+NANOSECONDS_PER_SECOND = 10**9
+NANOSECONDS_PER_DAY = SECONDS_PER_DAY * NANOSECONDS_PER_SECOND
+# 1970-01-01, day 0, was a Thursday.
+EPOCH_DAY = date(1970, 1, 1)
+EPOCH_WEEKDAY = EPOCH_DAY.weekday()
+
+WEEKDAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+SUNDAY = WEEKDAY_NAMES.index('Sunday')
+# Like the end of a day's last window, which is written as 24:00.
+END_OF_DAY_TEXT = '24:00'
+
+
+class TariffKey(str, Enum):
+    RATES = 'Rates'
+    NAME = 'Name'
+    LABELS = 'Labels'
+    DEFAULT_RATE = 'DefaultRate'
+    PERIODS = 'Periods'
+    FROM = 'From'
+    WEEKDAYS = 'Weekdays'
+    HOLIDAYS = 'Holidays'
+    DATE_OVERRIDES = 'DateOverrides'
+    DATE = 'Date'
+    WINDOWS = 'Windows'
+    RATE = 'Rate'
+    START = 'Start'
+    END = 'End'
+
+
+def make_energy_rate(name: str) -> EnergyRate | str:
+    # The two built-in energy rates keep their EnergyRate, the others are identified by their name; both
+    # compare, and hash, like their name.
+    return EnergyRate(name) if name in EnergyRate._value2member_map_ else name
+
+
+def get_energy_rate_name(energy_rate: EnergyRate | str) -> str:
+    return energy_rate.value if isinstance(energy_rate, EnergyRate) else energy_rate
+
+
+def _parse_second_of_day(text: str) -> int:
+    if text == END_OF_DAY_TEXT:
+        return SECONDS_PER_DAY
+    return _time_to_second_of_day(time.fromisoformat(text))
+
+
+def _format_second_of_day(second_of_day: int) -> str:
+    if second_of_day == SECONDS_PER_DAY:
+        return END_OF_DAY_TEXT
+    return (datetime.min + timedelta(seconds=second_of_day)).time().isoformat()
+
+
+def _time_to_second_of_day(t: time) -> int:
+    assert is_timezone_naive(t),\
+        'the tariff times should not have time zone info, but %s has: %s.' % (t, t.tzinfo)
+    assert t.microsecond == 0,\
+        'the tariff times need to be whole seconds, but it was: %s.' % (t,)
+    return t.hour * 60 * 60 + t.minute * 60 + t.second
+
+
+def _to_day_number(day: date) -> int:
+    return (day - EPOCH_DAY).days
+
+
+class TariffWindow:
+    # An energy rate between two times of a local day, in seconds since midnight, which, like the high-rate
+    # intervals, excludes its start and includes its end.
+    def __init__(self, energy_rate: str, start_second: int, end_second: int):
+        assert 0 <= start_second < end_second <= SECONDS_PER_DAY,\
+            'the tariff window needs to start before it ends, within a day, but it was: %s to %s.' % (
+                _format_second_of_day(start_second), _format_second_of_day(end_second))
+        self.energy_rate = make_energy_rate(energy_rate)
+        self.start_second = start_second
+        self.end_second = end_second
+
+
+    @staticmethod
+    def from_json(window_json: dict) -> 'TariffWindow':
+        return TariffWindow(
+            window_json[TariffKey.RATE],
+            _parse_second_of_day(window_json[TariffKey.START]),
+            _parse_second_of_day(window_json[TariffKey.END]))
+
+
+    def to_json(self) -> dict:
+        return {
+            TariffKey.RATE.value: get_energy_rate_name(self.energy_rate),
+            TariffKey.START.value: _format_second_of_day(self.start_second),
+            TariffKey.END.value: _format_second_of_day(self.end_second),
+        }
+
+
+class TariffPeriod:
+    # The windows of each weekday, from a local day on, until the next period; the first period has no start.
+    def __init__(self, optional_start_day: date | None, weekday_to_windows: list[list[TariffWindow]]):
+        assert len(weekday_to_windows) == len(WEEKDAY_NAMES),\
+            'a tariff period needs the windows of %d weekdays, but it has: %d.' % (len(WEEKDAY_NAMES), len(weekday_to_windows))
+        self.optional_start_day = optional_start_day
+        self.weekday_to_windows = weekday_to_windows
+
+
+    @staticmethod
+    def from_json(period_json: dict) -> 'TariffPeriod':
+        unknown_weekday_names = set(period_json.get(TariffKey.WEEKDAYS, {})) - set(WEEKDAY_NAMES)
+        assert len(unknown_weekday_names) == 0,\
+            'unknown weekdays in tariff period: %s.' % (sorted(unknown_weekday_names),)
+        optional_start_day_text = period_json.get(TariffKey.FROM)
+        return TariffPeriod(
+            date.fromisoformat(optional_start_day_text) if optional_start_day_text is not None else None,
+            [[TariffWindow.from_json(w) for w in period_json.get(TariffKey.WEEKDAYS, {}).get(weekday_name, [])]
+                for weekday_name in WEEKDAY_NAMES])
+
+
+    def to_json(self) -> dict:
+        period_json = {}
+        if self.optional_start_day is not None:
+            period_json[TariffKey.FROM.value] = self.optional_start_day.isoformat()
+        period_json[TariffKey.WEEKDAYS.value] = {
+            weekday_name: [w.to_json() for w in windows]
+            for weekday_name, windows in zip(WEEKDAY_NAMES, self.weekday_to_windows)
+            if len(windows) > 0}
+        return period_json
+
+
+class Tariff:
+    # The energy rate of each moment, from a declarative schedule: the windows of each weekday, for periods
+    # that start on given days, holidays, which are billed like Sundays, and the windows of single days,
+    # which override everything else. Outside of the windows, the default energy rate applies.
+    #
+    # The schedule is compiled once into a table of the energy rate of each second of each distinct day
+    # schedule, and an index of the day schedule of each day, so that classifying a timestamp is a constant
+    # time lookup, and classifying an array of timestamps a few vectorized ones. The second k of a day covers
+    # (k, k + 1], like the windows, so the tariff times need to be whole seconds.
+    def __init__(
+            self,
+            energy_rates: list[str],
+            default_energy_rate: str,
+            periods: list[TariffPeriod],
+            holidays: list[date] = (),
+            day_to_windows: dict[date, list[TariffWindow]] = None,
+            energy_rate_to_labels: dict[str, dict[str, str]] = None):
+        day_to_windows = day_to_windows or {}
+        energy_rate_to_labels = energy_rate_to_labels or {}
+
+        self.energy_rates = [make_energy_rate(er) for er in energy_rates]
+        assert len(set(self.energy_rates)) == len(self.energy_rates),\
+            'the tariff energy rates need to be unique, but they are: %s.' % (energy_rates,)
+        assert len(self.energy_rates) <= np.iinfo(np.int8).max,\
+            'a tariff can have at most %d energy rates, but it has: %d.' % (np.iinfo(np.int8).max, len(self.energy_rates))
+        self.default_energy_rate = make_energy_rate(default_energy_rate)
+        assert self.default_energy_rate in self.energy_rates,\
+            'the default energy rate %s is not one of the tariff energy rates: %s.' % (default_energy_rate, energy_rates)
+        assert len(periods) > 0 and periods[0].optional_start_day is None,\
+            'the first tariff period must not have a start day.'
+        assert all(p.optional_start_day is not None for p in periods[1:])\
+            and all(p.optional_start_day < q.optional_start_day for p, q in zip(periods[1:], periods[2:])),\
+            'the later tariff periods need increasing start days, but they are: %s.' % (
+                [p.optional_start_day for p in periods[1:]],)
+        self.periods = periods
+        self.holidays = sorted(set(holidays))
+        self.day_to_windows = dict(sorted(day_to_windows.items()))
+        self.energy_rate_to_labels = {
+            er: {
+                **{locale: texts[er] for locale, texts in ENERGY_RATE_LOCALES.items() if er in texts},
+                **energy_rate_to_labels.get(er, {})}
+            for er in self.energy_rates}
+
+        self._compile()
+
+
+    def _compile_day_schedule(self, windows: list[TariffWindow], day_schedules: dict[bytes, int]) -> int:
+        # The row of the day schedule, which identical day schedules share.
+        day_schedule = np.full(SECONDS_PER_DAY, self.energy_rates.index(self.default_energy_rate), dtype=np.int8)
+        is_covered = np.zeros(SECONDS_PER_DAY, dtype=bool)
+        for window in windows:
+            assert window.energy_rate in self.energy_rates,\
+                'the energy rate %s of a tariff window is not one of the tariff energy rates: %s.' % (
+                    window.energy_rate, self.energy_rates)
+            assert not is_covered[window.start_second:window.end_second].any(),\
+                'the tariff windows of a day overlap: %s.' % ([w.to_json() for w in windows],)
+            is_covered[window.start_second:window.end_second] = True
+            day_schedule[window.start_second:window.end_second] = self.energy_rates.index(window.energy_rate)
+        return day_schedules.setdefault(day_schedule.tobytes(), len(day_schedules))
+
+
+    def _compile(self) -> None:
+        day_schedules = {}
+        period_weekday_rows = [
+            [self._compile_day_schedule(windows, day_schedules) for windows in period.weekday_to_windows]
+            for period in self.periods]
+
+        # The days whose day schedule isn't the weekday's of the first period are indexed, from the first to
+        # the last of them; the days after them have the weekday's of the last period.
+        special_days = [p.optional_start_day for p in self.periods[1:]] + self.holidays + list(self.day_to_windows)
+        self.first_day_number = _to_day_number(min(special_days)) if len(special_days) > 0 else 0
+        end_day_number = _to_day_number(max(special_days)) + 1 if len(special_days) > 0 else 0
+        day_numbers = np.arange(self.first_day_number, end_day_number)
+        period_indices = np.searchsorted(
+            [_to_day_number(p.optional_start_day) for p in self.periods[1:]], day_numbers, side='right')
+        self.day_number_to_row = np.array(period_weekday_rows, dtype=np.intp).reshape(-1, len(WEEKDAY_NAMES))[
+            period_indices, (day_numbers + EPOCH_WEEKDAY) % len(WEEKDAY_NAMES)]
+        for holiday in self.holidays:
+            day_index = _to_day_number(holiday) - self.first_day_number
+            self.day_number_to_row[day_index] = period_weekday_rows[period_indices[day_index]][SUNDAY]
+        for day, windows in self.day_to_windows.items():
+            self.day_number_to_row[_to_day_number(day) - self.first_day_number] =\
+                self._compile_day_schedule(windows, day_schedules)
+        self.first_period_weekday_rows = np.array(period_weekday_rows[0], dtype=np.intp)
+        self.last_period_weekday_rows = np.array(period_weekday_rows[-1], dtype=np.intp)
+
+        self.day_schedules = np.frombuffer(b''.join(day_schedules), dtype=np.int8).reshape(-1, SECONDS_PER_DAY)
+        self.energy_rate_array = np.array(self.energy_rates, dtype=object)
+        # The energy rate changes of each day schedule, as (start second, end second, energy rate) segments.
+        self.day_schedule_segments = []
+        for day_schedule in self.day_schedules:
+            change_seconds = np.flatnonzero(np.diff(day_schedule)) + 1
+            starts = np.concatenate([[0], change_seconds])
+            ends = np.concatenate([change_seconds, [SECONDS_PER_DAY]])
+            self.day_schedule_segments.append(
+                [(int(s), int(e), self.energy_rates[day_schedule[s]]) for s, e in zip(starts, ends)])
+
+
+    def _get_day_schedule_rows(self, day_numbers: np.ndarray) -> np.ndarray:
+        day_indices = day_numbers - self.first_day_number
+        weekdays = (day_numbers + EPOCH_WEEKDAY) % len(WEEKDAY_NAMES)
+        rows = np.where(day_indices < 0, self.first_period_weekday_rows[weekdays], self.last_period_weekday_rows[weekdays])
+        is_indexed = (0 <= day_indices) & (day_indices < len(self.day_number_to_row))
+        rows[is_indexed] = self.day_number_to_row[day_indices[is_indexed]]
+        return rows
+
+
+    def get_day_segments(self, day: date) -> list[tuple[int, int, str]]:
+        # The energy rates of a local day, as (start second, end second) segments, which exclude their start
+        # and include their end.
+        return self.day_schedule_segments[self._get_day_schedule_rows(np.array([_to_day_number(day)]))[0]]
+
+
+    def compute_energy_rate(self, date_time: datetime) -> EnergyRate | str:
+        # The energy rate at a local wall-clock datetime, i.e. at most a microsecond after the second it's in.
+        earlier_date_time = date_time.replace(tzinfo=None) - timedelta(microseconds=1)
+        second_of_day = _time_to_second_of_day(earlier_date_time.time().replace(microsecond=0))
+        row = self._get_day_schedule_rows(np.array([_to_day_number(earlier_date_time.date())]))[0]
+        return self.energy_rates[self.day_schedules[row, second_of_day]]
+
+
+    def compute_energy_rates(self, wall_clock_date_times: pd.DatetimeIndex) -> np.ndarray:
+        # The energy rates at local wall-clock datetimes without time zone info, as an object array.
+        earlier_nanoseconds = wall_clock_date_times.asi8 - 1
+        day_numbers = earlier_nanoseconds // NANOSECONDS_PER_DAY
+        seconds_of_day = (earlier_nanoseconds - day_numbers * NANOSECONDS_PER_DAY) // NANOSECONDS_PER_SECOND
+        return self.energy_rate_array[self.day_schedules[self._get_day_schedule_rows(day_numbers), seconds_of_day]]
+
+
+    def get_energy_rate_text(self, energy_rate: str, locale: str) -> str:
+        return self.energy_rate_to_labels[make_energy_rate(energy_rate)].get(locale, get_energy_rate_name(energy_rate))
+
+
+    @staticmethod
+    def from_json(tariff_json: dict) -> 'Tariff':
+        return Tariff(
+            energy_rates=[r[TariffKey.NAME] for r in tariff_json[TariffKey.RATES]],
+            default_energy_rate=tariff_json[TariffKey.DEFAULT_RATE],
+            periods=[TariffPeriod.from_json(p) for p in tariff_json[TariffKey.PERIODS]],
+            holidays=[date.fromisoformat(d) for d in tariff_json.get(TariffKey.HOLIDAYS, [])],
+            day_to_windows={
+                date.fromisoformat(o[TariffKey.DATE]): [TariffWindow.from_json(w) for w in o[TariffKey.WINDOWS]]
+                for o in tariff_json.get(TariffKey.DATE_OVERRIDES, [])},
+            energy_rate_to_labels={
+                make_energy_rate(r[TariffKey.NAME]): r[TariffKey.LABELS]
+                for r in tariff_json[TariffKey.RATES] if TariffKey.LABELS in r})
+
+
+    def to_json(self) -> dict:
+        return {
+            TariffKey.RATES.value: [
+                {TariffKey.NAME.value: get_energy_rate_name(er), TariffKey.LABELS.value: self.energy_rate_to_labels[er]}
+                for er in self.energy_rates],
+            TariffKey.DEFAULT_RATE.value: get_energy_rate_name(self.default_energy_rate),
+            TariffKey.PERIODS.value: [p.to_json() for p in self.periods],
+            TariffKey.HOLIDAYS.value: [d.isoformat() for d in self.holidays],
+            TariffKey.DATE_OVERRIDES.value: [
+                {TariffKey.DATE.value: d.isoformat(), TariffKey.WINDOWS.value: [w.to_json() for w in windows]}
+                for d, windows in self.day_to_windows.items()],
+        }
+
+
+def read_tariff(tariff_file_path: str) -> Tariff:
+    with open(tariff_file_path) as tariff_file:
+        return Tariff.from_json(json.load(tariff_file))
+
+
+def make_high_rate_tariff(weekday_to_optional_high_rate_interval: [HighRateInterval | None]) -> Tariff:
+    # The low and high energy rates, with at most one high-rate interval per weekday. The table is in whole
+    # seconds, so the high-rate interval times are truncated to the second, which classifies the timestamps in
+    # whole seconds exactly like the times themselves; an interval within a second has no such timestamps.
+    def make_windows(optional_high_rate_interval: HighRateInterval | None) -> list[TariffWindow]:
+        if optional_high_rate_interval is None:
+            return []
+        start_second, end_second = (
+            _time_to_second_of_day(t.replace(microsecond=0))
+            for t in (optional_high_rate_interval.start_time, optional_high_rate_interval.end_time))
+        return [TariffWindow(EnergyRate.HIGH, start_second, end_second)] if start_second < end_second else []
+
+    return Tariff(
+        energy_rates=[EnergyRate.LOW, EnergyRate.HIGH],
+        default_energy_rate=EnergyRate.LOW,
+        periods=[TariffPeriod(None, [make_windows(i) for i in weekday_to_optional_high_rate_interval])])
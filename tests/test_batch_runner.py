@@ -0,0 +1,68 @@
+import os
+
+from datetime import date
+
+from batch_runner import BatchJob, run_batch
+from chargehistory_generator import generate_chargehistory_sessions
+from fake_zaptec_server import FakeZaptecApi, start_fake_zaptec_server
+from zaptec_client import RateLimiterManager
+
+
+PASSWORD = 'password'
+
+
+def test_batch_fetches_and_processes_with_cached_access_tokens(tmp_path, capsys):
+    api = FakeZaptecApi(
+        list(generate_chargehistory_sessions(start_date=date(2023, 2, 1), num_years=0.2, num_devices=2)),
+        optional_password=PASSWORD)
+    server = start_fake_zaptec_server(api, port=0)
+    # Job names are free text, and don't choose where their logs go.
+    job_names = ['../outside', 'installation/2023 Q1']
+    jobs = [BatchJob({
+        'Name': job_name,
+        'Username': 'owner@example.com',
+        'InstallationId': 'installation-id',
+        'UsageIntervalStart': '2023-03-01',
+        'UsageIntervalEnd': '2023-04-01',
+        'NumChargingStations': 2,
+        'ChargehistoryFileName': 'chargehistory-%d.json' % (i,),
+        'ExcelFileName': 'output-%d.xlsx' % (i,),
+        'WeekdayHighRateInterval': ['07:00', '20:00'],
+    }, str(tmp_path)) for i, job_name in enumerate(job_names)]
+    log_dir = tmp_path / 'logs'
+    requested_usernames = []
+
+    def get_password(username: str) -> str:
+        requested_usernames.append(username)
+        return PASSWORD
+
+    try:
+        results = run_batch(
+            jobs=jobs,
+            optional_get_password=get_password,
+            log_dir=str(log_dir),
+            max_workers=2,
+            optional_access_token_cache_file_path=None,
+            base_url='http://%s:%d' % server.server_address)
+    finally:
+        server.shutdown()
+
+    assert [(r.name, r.optional_error) for r in results] == [(n, None) for n in job_names]
+    assert sorted(os.listdir(log_dir)) == ['001-.._outside.log', '002-installation_2023_Q1.log']
+    assert [r.log_file_path for r in results] == [str(log_dir / n) for n in sorted(os.listdir(log_dir))]
+    assert all(os.path.exists(tmp_path / ('output-%d.xlsx' % (i,))) for i in range(len(jobs)))
+    # The account authenticated once, in the parent, and the workers reused its access token.
+    assert requested_usernames == ['owner@example.com']
+    assert api.counters['token_requests'] == 1
+    assert 'Rate limit: 0 sleep(s)' in capsys.readouterr().out
+
+
+def test_shared_rate_limiter_counts_the_sleeps_of_its_users():
+    # The sleeps happen in the manager process, and are read through the proxy.
+    with RateLimiterManager() as rate_limiter_manager:
+        rate_limiter = rate_limiter_manager.RateLimiter(calls=1, period_seconds=0.05)
+        for _ in range(3):
+            rate_limiter.acquire()
+        num_sleeps, sleep_seconds = rate_limiter.get_sleep_counters()
+    assert num_sleeps >= 2
+    assert sleep_seconds > 0
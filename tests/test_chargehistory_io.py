@@ -0,0 +1,47 @@
+import json
+
+import pytest
+
+from decimal import Decimal
+
+from chargehistory_io import dumps_exact_json, open_chargehistory_writer, read_chargehistory_sessions
+from common import FixedPointEnergy
+
+
+CHARGE_SESSION_JSON = '''{
+  "Id": "session-1",
+  "DeviceId": "ZAP000001",
+  "DeviceName": "Station 1",
+  "StartDateTime": "2024-03-04T08:00:00.000000",
+  "EndDateTime": "2024-03-04T09:00:00",
+  "CommitEndDateTime": "2024-03-04T09:00:00.000000",
+  "Energy": 392.55490000000000004,
+  "EnergyDetails": [
+    {"Timestamp": "2024-03-04T08:15:00+00:00", "Energy": 0.55150000000000004},
+    {"Timestamp": "2024-03-04T08:30:00+00:00", "Energy": 392.0030},
+    {"Timestamp": "2024-03-04T08:45:00+00:00", "Energy": 1E+2}
+  ]
+}'''
+
+
+def get_energy_texts(charge_session: dict) -> list[str]:
+    return [str(charge_session['Energy'])] + [str(ed['Energy']) for ed in charge_session['EnergyDetails']]
+
+
+@pytest.mark.parametrize('chargehistory_file_name', ['chargehistory.json', 'chargehistory.ndjson.gz'])
+def test_decimal_energies_are_written_exactly(tmp_path, chargehistory_file_name):
+    charge_session = json.loads(CHARGE_SESSION_JSON, parse_float=Decimal)
+    chargehistory_file_path = str(tmp_path / chargehistory_file_name)
+    with open_chargehistory_writer(chargehistory_file_path) as writer:
+        writer.write_charge_session(charge_session)
+
+    charge_sessions = list(read_chargehistory_sessions(chargehistory_file_path))
+    assert [get_energy_texts(s) for s in charge_sessions] == [['392.55490000000000004', '0.55150000000000004', '392.0030', '1E+2']]
+
+
+@pytest.mark.parametrize('indent, separators', [(None, None), (2, None), (None, (',', ':'))])
+def test_exact_json_is_formatted_like_json_dumps(indent, separators):
+    charge_session = json.loads(CHARGE_SESSION_JSON)
+    assert dumps_exact_json(charge_session, indent, separators) == json.dumps(charge_session, indent=indent, separators=separators)
+    assert dumps_exact_json({'Energy': FixedPointEnergy.parse('3.50'), 'Empty': [{}]}, indent, separators)\
+        == json.dumps({'Energy': 'ENERGY', 'Empty': [{}]}, indent=indent, separators=separators).replace('"ENERGY"', '3.50')
@@ -0,0 +1,35 @@
+from datetime import date
+
+from common import EnergyRate
+from daily_energy_store import DailyEnergy, DailyEnergyStore
+
+
+def to_tuples(daily_energies: list[DailyEnergy]) -> list[tuple]:
+    return [(de.device_id, de.device_name, de.day, de.energy_rate, de.energy, de.energy_decimals) for de in daily_energies]
+
+
+def test_installations_sharing_a_store_keep_their_own_days(tmp_path):
+    store_file_path = str(tmp_path / 'daily-energies.sqlite')
+    days = [date(2024, 3, 4), date(2024, 3, 5)]
+    with DailyEnergyStore(store_file_path, 'installation-1', 'tariff-1') as store:
+        store.write_daily_energies(days, [DailyEnergy('ZAP000001', 'Station 1', days[0], EnergyRate.HIGH, 15000, 1)])
+    with DailyEnergyStore(store_file_path, 'installation-2', 'tariff-2') as store:
+        assert store.num_invalidated_days == 0
+        assert store.get_stored_days() == set()
+        store.write_daily_energies(days[:1], [DailyEnergy('ZAP000001', 'Station A', days[0], EnergyRate.LOW, 7, 3)])
+
+    with DailyEnergyStore(store_file_path, 'installation-1', 'tariff-1') as store:
+        assert store.num_invalidated_days == 0
+        assert store.get_stored_days() == set(days)
+        assert to_tuples(store.read_daily_energies(days)) == [
+            ('ZAP000001', 'Station 1', days[0], EnergyRate.HIGH, 15000, 1)]
+        assert store.read_daily_energies([days[1]]) == []
+    with DailyEnergyStore(store_file_path, 'installation-2', 'tariff-2') as store:
+        assert to_tuples(store.read_daily_energies(days)) == [('ZAP000001', 'Station A', days[0], EnergyRate.LOW, 7, 3)]
+    # Other tariff settings only invalidate the days of their installation.
+    with DailyEnergyStore(store_file_path, 'installation-2', 'tariff-3') as store:
+        assert store.num_invalidated_days == 1
+        assert store.get_stored_days() == set()
+    with DailyEnergyStore(store_file_path, 'installation-1', 'tariff-1') as store:
+        assert store.num_invalidated_days == 0
+        assert store.get_stored_days() == set(days)
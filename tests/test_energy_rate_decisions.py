@@ -0,0 +1,70 @@
+import json
+import os
+
+import pytest
+
+from datetime import datetime, time, timedelta
+
+import energy_rate_decisions
+
+from common import ChargeSession, EnergyRate, HighRateInterval
+from energy_rate_decisions import RULES_COMMENT_LOCALES, RULES_COMMENTS, DecisionSource, EnergyRateResolver,\
+    MissingEnergyDetailsMode
+from usage_processor import make_tariff
+
+
+TARIFF = make_tariff(HighRateInterval(time(7), time(20)), HighRateInterval(time(7), time(13)))
+
+
+def make_charge_sessions(num_charge_sessions: int) -> list[ChargeSession]:
+    start_date_time = datetime(2024, 3, 4, 8)
+    return [ChargeSession({
+        'Id': 'session-%d' % i,
+        'DeviceId': 'ZAP000001',
+        'DeviceName': 'Station 1',
+        'StartDateTime': (start_date_time + timedelta(days=i)).isoformat(),
+        'CommitEndDateTime': (start_date_time + timedelta(days=i, hours=1)).isoformat(),
+        'Energy': 1.5,
+    }) for i in range(num_charge_sessions)]
+
+
+@pytest.fixture
+def replaced_file_paths(monkeypatch) -> list[str]:
+    # The decisions file is only ever replaced as a whole.
+    replaced_file_paths = []
+    replace = os.replace
+
+    def record_replace(source, destination):
+        replaced_file_paths.append(destination)
+        replace(source, destination)
+    monkeypatch.setattr(energy_rate_decisions.os, 'replace', record_replace)
+    return replaced_file_paths
+
+
+def test_decisions_by_rules_are_saved_in_batches(tmp_path, monkeypatch, replaced_file_paths):
+    monkeypatch.setattr(energy_rate_decisions, 'DECISIONS_SAVE_INTERVAL', 10)
+    decisions_file_path = str(tmp_path / 'decisions.json')
+    resolver = EnergyRateResolver(MissingEnergyDetailsMode.RULES, TARIFF, decisions_file_path)
+    charge_sessions = make_charge_sessions(25)
+    energy_rates = [resolver.resolve(cs) for cs in charge_sessions]
+    assert replaced_file_paths == [decisions_file_path] * 2
+
+    resolver.save_decisions()
+    resolver.save_decisions()
+    assert replaced_file_paths == [decisions_file_path] * 3
+    assert not os.path.exists(decisions_file_path + '.tmp')
+    with open(decisions_file_path) as decisions_file:
+        assert len(json.load(decisions_file)) == 25
+
+    # A later run reuses every decision.
+    reusing_resolver = EnergyRateResolver(MissingEnergyDetailsMode.PROMPT, TARIFF, decisions_file_path)
+    assert [reusing_resolver.resolve(cs) for cs in charge_sessions] == energy_rates
+    assert reusing_resolver.num_reused_decisions == 25
+
+
+def test_decisions_without_a_locale_are_commented_by_keys():
+    charge_session, = make_charge_sessions(1)
+    assert EnergyRateResolver(MissingEnergyDetailsMode.RULES, TARIFF, optional_locale=None).resolve(charge_session)\
+        == (EnergyRate.HIGH, RULES_COMMENTS[DecisionSource.RULES])
+    assert EnergyRateResolver(MissingEnergyDetailsMode.RULES, TARIFF).resolve(charge_session)\
+        == (EnergyRate.HIGH, RULES_COMMENT_LOCALES['de-CH'][DecisionSource.RULES])
@@ -0,0 +1,137 @@
+import json
+
+import pandas as pd
+import pytest
+import pytz
+
+from datetime import date, datetime, time, timezone
+from decimal import Decimal
+
+from chargehistory_generator import generate_chargehistory_sessions, write_chargehistory_json
+from chargehistory_io import write_chargehistory_npz
+from chargehistory_validation import ChargehistoryValidator, ValidationLevel
+from common import EnergyRate, HighRateInterval, TIMESTAMP_RECORD_DELAY, UsageInterval, ZRH, energies_to_decimals
+from energy_rate_decisions import EnergyRateResolver, MissingEnergyDetailsMode
+from usage_processor import ENERGY_DECIMALS_COLUMN, SummaryTableLabels, TableColumns, collect_energy_detail_batch,\
+    compute_energy_details_df, compute_summary_df, make_tariff, resolve_energy_rates
+
+
+WEEKDAY_HIGH_RATE_INTERVAL = HighRateInterval(time(7), time(20))
+SATURDAY_HIGH_RATE_INTERVAL = HighRateInterval(time(7), time(13))
+# Usage intervals around the DST transitions of 2023, which start, or end, at the transition, or in the hour that
+# is skipped or repeated.
+USAGE_INTERVALS = [
+    (datetime(2023, 3, 1), datetime(2023, 4, 1)),
+    (datetime(2023, 3, 26, 2), datetime(2023, 10, 29, 2)),
+    (datetime(2023, 3, 26, 1, 30), datetime(2023, 10, 29, 2, 30)),
+    (datetime(2023, 10, 29, 2, 30), datetime(2023, 11, 15)),
+]
+
+
+def compute_reference_energy_rate(local_timestamp: datetime) -> EnergyRate:
+    # Like the per-object EnergyDetail.compute_energy_rate() that the columnar classification replaced.
+    earliest_timestamp = local_timestamp - TIMESTAMP_RECORD_DELAY
+    optional_high_rate_interval = [WEEKDAY_HIGH_RATE_INTERVAL] * 5 + [SATURDAY_HIGH_RATE_INTERVAL, None]
+    optional_high_rate_interval = optional_high_rate_interval[earliest_timestamp.weekday()]
+    if optional_high_rate_interval is None:
+        return EnergyRate.LOW
+    return EnergyRate.HIGH\
+        if optional_high_rate_interval.start_time < earliest_timestamp.time()\
+        and earliest_timestamp.time() <= optional_high_rate_interval.end_time\
+        else EnergyRate.LOW
+
+
+def compute_reference_energy_details(chargehistory_file_path: str, usage_interval: UsageInterval) -> list[tuple]:
+    # The energy details of the usage interval, with pytz's astimezone() and Decimals, one at a time.
+    with open(chargehistory_file_path) as chargehistory_file:
+        chargehistory_json = json.load(chargehistory_file, parse_float=Decimal)
+
+    rows = []
+    for charge_session_json in chargehistory_json['Data']:
+        start_date_time = pytz.utc.localize(datetime.fromisoformat(charge_session_json['StartDateTime'])).astimezone(ZRH)
+        end_date_time = pytz.utc.localize(datetime.fromisoformat(charge_session_json['CommitEndDateTime'])).astimezone(ZRH)
+        if end_date_time <= usage_interval.start_date_time\
+                or usage_interval.end_date_time <= start_date_time - TIMESTAMP_RECORD_DELAY:
+            continue
+        for energy_detail_json in charge_session_json['EnergyDetails']:
+            timestamp = datetime.fromisoformat(energy_detail_json['Timestamp'])
+            assert timestamp.tzinfo == timezone.utc
+            local_timestamp = timestamp.astimezone(ZRH)
+            earliest_timestamp = local_timestamp - TIMESTAMP_RECORD_DELAY
+            if not (usage_interval.start_date_time < earliest_timestamp and earliest_timestamp <= usage_interval.end_date_time):
+                continue
+            rows.append((
+                charge_session_json['DeviceId'],
+                charge_session_json['DeviceName'],
+                local_timestamp.replace(tzinfo=None),
+                energy_detail_json['Energy'],
+                compute_reference_energy_rate(local_timestamp)))
+    return rows
+
+
+def compute_reference_summary(rows: list[tuple]) -> pd.DataFrame:
+    summary_df = pd.pivot_table(
+        pd.DataFrame(rows, columns=[
+            TableColumns.DEVICE_ID, TableColumns.DEVICE_NAME, TableColumns.TIMESTAMP, TableColumns.ENERGY,
+            TableColumns.ENERGY_RATE]).drop(columns=TableColumns.TIMESTAMP),
+        values=TableColumns.ENERGY,
+        index=[TableColumns.DEVICE_ID, TableColumns.DEVICE_NAME],
+        columns=[TableColumns.ENERGY_RATE],
+        fill_value=0,
+        aggfunc='sum',
+        margins=True,
+        margins_name=SummaryTableLabels.TOTAL_ENERGY)
+    summary_df.columns = [SummaryTableLabels.LOW_ENERGY if c == EnergyRate.LOW else c for c in summary_df.columns]
+    summary_df.columns = [SummaryTableLabels.HIGH_ENERGY if c == EnergyRate.HIGH else c for c in summary_df.columns]
+    return summary_df
+
+
+def to_exact_texts(summary_df: pd.DataFrame) -> dict:
+    # Decimals compare equal regardless of their trailing zeros, but their texts don't.
+    return {k: str(v) for k, v in summary_df.stack().items()}
+
+
+@pytest.fixture(scope='module')
+def chargehistory_file_paths(tmp_path_factory) -> dict[str, str]:
+    # Every charging station also charges across each DST transition.
+    charge_sessions = list(generate_chargehistory_sessions(
+        start_date=date(2023, 2, 15),
+        num_years=0.8,
+        num_devices=3,
+        sessions_per_day=1.5,
+        energy_details_interval=pd.Timedelta(minutes=15).to_pytimedelta(),
+        dst_crossing_sessions_per_transition=2,
+        missing_energy_details_fraction=0))
+    json_file_path = str(tmp_path_factory.mktemp('chargehistory') / 'chargehistory.json')
+    write_chargehistory_json(charge_sessions, json_file_path)
+    npz_file_path = json_file_path.replace('.json', '.npz')
+    write_chargehistory_npz(charge_sessions, npz_file_path)
+    return {'json': json_file_path, 'npz': npz_file_path}
+
+
+@pytest.mark.parametrize('chargehistory_format', ['json', 'npz'])
+@pytest.mark.parametrize('usage_interval_bounds', USAGE_INTERVALS)
+def test_processing_is_like_the_decimal_reference_across_dst(
+        chargehistory_file_paths, chargehistory_format, usage_interval_bounds):
+    usage_interval = UsageInterval(*usage_interval_bounds)
+    reference_rows = compute_reference_energy_details(chargehistory_file_paths['json'], usage_interval)
+    assert len(reference_rows) > 0
+
+    tariff = make_tariff(WEEKDAY_HIGH_RATE_INTERVAL, SATURDAY_HIGH_RATE_INTERVAL)
+    energy_detail_batch = collect_energy_detail_batch(
+        chargehistory_file_paths[chargehistory_format],
+        usage_interval,
+        ChargehistoryValidator(ValidationLevel.STRICT))
+    resolve_energy_rates(energy_detail_batch, usage_interval, EnergyRateResolver(MissingEnergyDetailsMode.RULES, tariff))
+    energy_details_df = compute_energy_details_df(energy_detail_batch, usage_interval, tariff)
+
+    energies = energies_to_decimals(
+        energy_details_df[TableColumns.ENERGY].to_numpy(), energy_details_df[ENERGY_DECIMALS_COLUMN].to_numpy())
+    rows = list(zip(
+        energy_details_df[TableColumns.DEVICE_ID],
+        energy_details_df[TableColumns.DEVICE_NAME],
+        [t.to_pydatetime() for t in energy_details_df[TableColumns.TIMESTAMP]],
+        energies,
+        energy_details_df[TableColumns.ENERGY_RATE]))
+    assert sorted((*r[:3], str(r[3]), r[4]) for r in rows) == sorted((*r[:3], str(r[3]), r[4]) for r in reference_rows)
+    assert to_exact_texts(compute_summary_df(energy_details_df)) == to_exact_texts(compute_reference_summary(reference_rows))
@@ -0,0 +1,205 @@
+import json
+import os
+import zipfile
+
+import pytest
+
+from datetime import date, datetime, timezone
+
+from chargehistory_cache import get_charge_session_key
+from chargehistory_generator import generate_chargehistory_sessions
+from chargehistory_io import DATA_KEY, PAGES_KEY, ChargehistoryNdjsonWriter, read_chargehistory_sessions
+from common import ChargeSession, UsageInterval
+from energy_rate_decisions import MissingEnergyDetailsMode
+from fake_zaptec_server import FakeZaptecApi, start_fake_zaptec_server
+from usage_fetcher import fetch_usage
+from usage_pipeline import fetch_and_process_usage
+from usage_processor import process_usage
+
+
+INSTALLATION_ID = 'installation-id'
+NUM_CHARGING_STATIONS = 3
+PASSWORD = 'password'
+# The usage interval spans the DST transition of 2023-03-26; the chargehistory goes on for a few weeks after it.
+USAGE_INTERVAL_START = datetime(2023, 3, 1)
+USAGE_INTERVAL_END = datetime(2023, 4, 1)
+# Small pages, so that every fetch is paginated.
+MAX_PAGE_SIZE = 20
+
+
+@pytest.fixture(scope='module')
+def charge_sessions() -> list[dict]:
+    return list(generate_chargehistory_sessions(
+        start_date=date(2023, 2, 1),
+        num_years=0.25,
+        num_devices=NUM_CHARGING_STATIONS,
+        sessions_per_day=0.5,
+        missing_energy_details_fraction=0.05))
+
+
+def start_server(charge_sessions: list[dict], **kwargs):
+    api = FakeZaptecApi(
+        charge_sessions,
+        retry_after_seconds=0.01,
+        optional_password=PASSWORD,
+        optional_max_page_size=MAX_PAGE_SIZE,
+        **kwargs)
+    server = start_fake_zaptec_server(api, port=0)
+    return api, server, 'http://%s:%d' % server.server_address
+
+
+@pytest.fixture
+def fake_api(charge_sessions):
+    api, server, base_url = start_server(charge_sessions)
+    yield api, base_url
+    server.shutdown()
+
+
+@pytest.fixture
+def flaky_fake_api(charge_sessions):
+    # Server errors and throttled responses, which are retried.
+    api, server, base_url = start_server(charge_sessions, error_rate=0.1, throttle_rate=0.1, seed=1)
+    yield api, base_url
+    server.shutdown()
+
+
+def fetch(base_url: str, output_file_path, **kwargs) -> None:
+    fetch_usage(
+        username='owner@example.com',
+        get_password=lambda: PASSWORD,
+        installation_id=INSTALLATION_ID,
+        usage_interval=UsageInterval(USAGE_INTERVAL_START, USAGE_INTERVAL_END),
+        num_charging_stations=NUM_CHARGING_STATIONS,
+        output_chargehistory_file_name=str(output_file_path),
+        optional_overwrite=True,
+        optional_access_token_cache_file_path=None,
+        base_url=base_url,
+        **kwargs)
+
+
+def read_sorted_sessions(chargehistory_file_path) -> list[dict]:
+    return sorted(
+        read_chargehistory_sessions(str(chargehistory_file_path)),
+        key=lambda s: (s[ChargeSession.Key.START_DATE_TIME], get_charge_session_key(s)))
+
+
+def read_workbook_parts(excel_file_path) -> dict[str, bytes]:
+    # Everything but the creation time of the workbook.
+    with zipfile.ZipFile(excel_file_path) as excel_file:
+        return {n: excel_file.read(n) for n in excel_file.namelist() if n != 'docProps/core.xml'}
+
+
+def process(chargehistory_file_path, excel_file_path) -> None:
+    process_usage(
+        str(chargehistory_file_path),
+        UsageInterval(USAGE_INTERVAL_START, USAGE_INTERVAL_END),
+        str(excel_file_path),
+        missing_energy_details_mode=MissingEnergyDetailsMode.RULES)
+
+
+@pytest.fixture
+def direct_fetch(fake_api, tmp_path):
+    # The chargehistory fetched without failures, cache or resume, and its workbook.
+    _, base_url = fake_api
+    chargehistory_file_path = tmp_path / 'direct.json'
+    fetch(base_url, chargehistory_file_path)
+    excel_file_path = tmp_path / 'direct.xlsx'
+    process(chargehistory_file_path, excel_file_path)
+    return read_sorted_sessions(chargehistory_file_path), read_workbook_parts(excel_file_path)
+
+
+def test_direct_fetch_paginates_and_discovers_the_fetch_interval(charge_sessions, fake_api, direct_fetch):
+    api, _ = fake_api
+    sessions, _ = direct_fetch
+    assert api.counters['chargehistory_requests'] > len(sessions) / MAX_PAGE_SIZE
+
+    # Every charge session that starts in the usage interval, and at least one after it of every charging station.
+    def get_start(charge_session: dict) -> datetime:
+        return datetime.fromisoformat(charge_session[ChargeSession.Key.START_DATE_TIME])
+
+    keys = set(get_charge_session_key(s) for s in sessions)
+    usage_interval = UsageInterval(USAGE_INTERVAL_START, USAGE_INTERVAL_END)
+    start, end = (
+        d.astimezone(timezone.utc).replace(tzinfo=None) for d in (usage_interval.start_date_time, usage_interval.end_date_time))
+    assert all(get_charge_session_key(s) in keys for s in charge_sessions if start <= get_start(s) < end)
+    assert set(s[ChargeSession.Key.DEVICE_ID] for s in sessions if get_start(s) >= end) == set(
+        s[ChargeSession.Key.DEVICE_ID] for s in charge_sessions)
+
+
+def test_retried_fetch_is_like_the_direct_fetch(flaky_fake_api, direct_fetch, tmp_path):
+    api, base_url = flaky_fake_api
+    fetch(base_url, tmp_path / 'retried.json', max_concurrent_requests=3)
+    assert api.counters['injected_errors'] + api.counters['injected_throttles'] > 0
+    assert read_sorted_sessions(tmp_path / 'retried.json') == direct_fetch[0]
+
+
+def test_cached_fetch_is_like_the_direct_fetch(fake_api, direct_fetch, tmp_path):
+    api, base_url = fake_api
+    cache_dir_path = tmp_path / 'cache'
+    fetch(base_url, tmp_path / 'first.json', optional_cache_dir=str(cache_dir_path))
+    num_served_charge_sessions = api.counters['charge_sessions_served']
+    fetch(base_url, tmp_path / 'second.json', optional_cache_dir=str(cache_dir_path))
+
+    # The history is long over, so nothing is fetched again.
+    assert api.counters['charge_sessions_served'] == num_served_charge_sessions
+    assert read_sorted_sessions(tmp_path / 'first.json') == direct_fetch[0]
+    assert read_sorted_sessions(tmp_path / 'second.json') == direct_fetch[0]
+
+
+def test_resumed_fetch_is_like_the_direct_fetch(fake_api, direct_fetch, tmp_path):
+    _, base_url = fake_api
+    ndjson_file_path = tmp_path / 'resumed.ndjson.gz'
+    # An interrupted fetch: a few complete members, and an incomplete one.
+    with ChargehistoryNdjsonWriter(str(ndjson_file_path), member_size=10) as writer:
+        for charge_session in direct_fetch[0][:35]:
+            writer.write_charge_session(charge_session)
+    with open(ndjson_file_path, 'r+b') as ndjson_file:
+        ndjson_file.truncate(os.path.getsize(ndjson_file_path) - 10)
+
+    fetch(base_url, ndjson_file_path, resume=True)
+    assert read_sorted_sessions(ndjson_file_path) == direct_fetch[0]
+
+
+def test_pipeline_is_like_the_direct_fetch(flaky_fake_api, direct_fetch, tmp_path):
+    _, base_url = flaky_fake_api
+    excel_file_path = tmp_path / 'pipeline.xlsx'
+    raw_output_file_path = tmp_path / 'pipeline.json'
+    fetch_and_process_usage(
+        username='owner@example.com',
+        get_password=lambda: PASSWORD,
+        installation_id=INSTALLATION_ID,
+        usage_interval=UsageInterval(USAGE_INTERVAL_START, USAGE_INTERVAL_END),
+        num_charging_stations=NUM_CHARGING_STATIONS,
+        output_excel_file_name=str(excel_file_path),
+        optional_raw_output_file_name=str(raw_output_file_path),
+        optional_overwrite=True,
+        optional_access_token_cache_file_path=None,
+        missing_energy_details_mode=MissingEnergyDetailsMode.RULES,
+        base_url=base_url)
+
+    assert read_sorted_sessions(raw_output_file_path) == direct_fetch[0]
+    assert read_workbook_parts(excel_file_path) == direct_fetch[1]
+
+
+def test_fetched_and_pipeline_json_have_the_same_shape(fake_api, tmp_path):
+    _, base_url = fake_api
+    fetch(base_url, tmp_path / 'fetched.json')
+    fetch_and_process_usage(
+        username='owner@example.com',
+        get_password=lambda: PASSWORD,
+        installation_id=INSTALLATION_ID,
+        usage_interval=UsageInterval(USAGE_INTERVAL_START, USAGE_INTERVAL_END),
+        num_charging_stations=NUM_CHARGING_STATIONS,
+        output_excel_file_name=str(tmp_path / 'pipeline.xlsx'),
+        optional_raw_output_file_name=str(tmp_path / 'pipeline.json'),
+        optional_overwrite=True,
+        optional_access_token_cache_file_path=None,
+        missing_energy_details_mode=MissingEnergyDetailsMode.RULES,
+        base_url=base_url)
+
+    # Both are a single page with all the charge sessions.
+    for chargehistory_file_name in ['fetched.json', 'pipeline.json']:
+        with open(tmp_path / chargehistory_file_name) as chargehistory_file:
+            chargehistory_json = json.load(chargehistory_file)
+        assert list(chargehistory_json) == [PAGES_KEY, DATA_KEY]
+        assert chargehistory_json[PAGES_KEY] == 1
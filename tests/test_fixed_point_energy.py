@@ -0,0 +1,37 @@
+import json
+
+import numpy as np
+
+from decimal import Decimal
+
+from common import FixedPointEnergy, energies_to_decimals, energy_to_optional_fixed_point, make_energy_array,\
+    parse_fixed_point_energy
+
+
+def test_parse_keeps_the_decimals_of_the_text():
+    energy = parse_fixed_point_energy('3.50')
+    assert isinstance(energy, FixedPointEnergy)
+    assert int(energy) == 3500000
+    assert str(energy) == '3.50'
+
+
+def test_parse_falls_back_to_a_decimal_with_more_decimals_than_the_fixed_point_units():
+    for text in ('0.55150000000000004', '1.0000000', '1E+2'):
+        energy = parse_fixed_point_energy(text)
+        assert type(energy) is Decimal
+        assert str(energy) == text
+        assert energy_to_optional_fixed_point(energy) is None
+
+
+def test_chargehistory_energies_that_dont_fit_the_fixed_point_units_stay_exact():
+    charge_session_json = json.loads(
+        '{"Energy": 392.0034, "EnergyDetails": [{"Energy": 0.55150000000000004}, {"Energy": 391.4519}]}',
+        parse_float=parse_fixed_point_energy)
+    energies, energy_decimals = make_energy_array(
+        [energy_detail['Energy'] for energy_detail in charge_session_json['EnergyDetails']])
+    assert energies.dtype == object
+    assert str(sum(energies_to_decimals(energies, energy_decimals))) == '392.00340000000000004'
+
+    energies, energy_decimals = make_energy_array([charge_session_json['Energy']])
+    assert energies.dtype == np.int64
+    assert [str(e) for e in energies_to_decimals(energies, energy_decimals)] == ['392.0034']
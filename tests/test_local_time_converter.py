@@ -0,0 +1,35 @@
+import pandas as pd
+import pytest
+import pytz
+
+from datetime import datetime, timedelta
+
+from common import LocalTimeConverter, ZRH, ZRH_LOCAL_TIME_CONVERTER
+
+
+def get_probe_times(converter: LocalTimeConverter, start: datetime, end: datetime, freq: str) -> list[datetime]:
+    # Regular times in the span, and the microseconds and seconds around each transition.
+    probe_times = list(pd.date_range(start, end, freq=freq).to_pydatetime())
+    for t in converter.utc_transition_times[1:]:
+        probe_times += [t + timedelta(microseconds=d) for d in (-1, 0, 1)] + [t + timedelta(seconds=d) for d in (-1, 1)]
+    return [t for t in probe_times if start <= t <= end]
+
+
+@pytest.mark.parametrize('converter, start, end, freq', [
+    (ZRH_LOCAL_TIME_CONVERTER, datetime(1900, 1, 1), datetime(2045, 1, 1), '7h'),
+    (LocalTimeConverter(datetime(2023, 2, 15), datetime(2024, 11, 1)), datetime(2023, 2, 15), datetime(2024, 11, 1), 'h'),
+])
+def test_conversion_is_like_astimezone(converter, start, end, freq):
+    probe_times = get_probe_times(converter, start, end, freq)
+    expected_date_times = [pytz.utc.localize(t).astimezone(ZRH) for t in probe_times]
+
+    date_times = [converter.to_local_date_time(t) for t in probe_times]
+    assert [(d, d.tzinfo) for d in date_times] == [(d, d.tzinfo) for d in expected_date_times]
+    assert list(converter.to_wall_clock(pd.DatetimeIndex(probe_times))) == [
+        pd.Timestamp(d.replace(tzinfo=None)) for d in expected_date_times]
+
+
+def test_transitions_of_2023():
+    converter = LocalTimeConverter(datetime(2023, 1, 1), datetime(2024, 1, 1))
+    assert converter.utc_transition_times[1:] == [datetime(2023, 3, 26, 1), datetime(2023, 10, 29, 1)]
+    assert converter.utc_offsets == [timedelta(hours=1), timedelta(hours=2), timedelta(hours=1)]
@@ -0,0 +1,25 @@
+import pandas as pd
+
+from datetime import datetime, time, timedelta
+
+from common import EnergyRate, HighRateInterval
+from tariff import make_high_rate_tariff
+
+
+def test_high_rate_intervals_with_fractional_seconds_classify_whole_seconds_exactly():
+    high_rate_interval = HighRateInterval(time(7, 0, 0, 500000), time(20, 0, 0, 500000))
+    tariff = make_high_rate_tariff([high_rate_interval] * 7)
+    # Around both bounds of a day, in whole seconds.
+    date_times = [
+        datetime(2024, 3, 4, h) + timedelta(seconds=s) for h in (7, 20) for s in range(-2, 3)]
+
+    expected_energy_rates = [
+        EnergyRate.HIGH if high_rate_interval.start_time < d.time() <= high_rate_interval.end_time else EnergyRate.LOW
+        for d in date_times]
+    assert [tariff.compute_energy_rate(d) for d in date_times] == expected_energy_rates
+    assert list(tariff.compute_energy_rates(pd.DatetimeIndex(date_times))) == expected_energy_rates
+
+
+def test_high_rate_interval_within_a_second_has_no_high_rate():
+    tariff = make_high_rate_tariff([HighRateInterval(time(7, 0, 0, 200000), time(7, 0, 0, 800000))] * 7)
+    assert tariff.compute_energy_rate(datetime(2024, 3, 4, 7, 0, 1)) == EnergyRate.LOW
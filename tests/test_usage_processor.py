@@ -0,0 +1,199 @@
+import csv
+import os
+
+import pandas as pd
+
+import usage_processor
+
+from datetime import date, datetime, time
+
+from chargehistory_generator import generate_chargehistory_sessions, write_chargehistory_json
+from chargehistory_io import read_chargehistory_sessions, write_chargehistory_npz
+from common import HighRateInterval, UsageInterval
+from energy_rate_decisions import EnergyRateResolver, MissingEnergyDetailsMode
+from table_export import ExportFormat
+from usage_processor import TableColumns, compute_daily_energies_df, process_usage
+
+
+CHARGEHISTORY_JSON = '''{
+  "Pages": 1,
+  "Data": [
+    {
+      "Id": "session-1",
+      "DeviceId": "ZAP000001",
+      "DeviceName": "Station 1",
+      "StartDateTime": "2024-03-04T08:00:00.000000",
+      "EndDateTime": "2024-03-04T09:00:00",
+      "CommitEndDateTime": "2024-03-04T09:00:00.000000",
+      "Energy": 392.5549,
+      "EnergyDetails": [
+        {"Timestamp": "2024-03-04T08:15:00+00:00", "Energy": 0.55150000000000004},
+        {"Timestamp": "2024-03-04T08:30:00+00:00", "Energy": 392.0034}
+      ]
+    },
+    {
+      "Id": "session-2",
+      "DeviceId": "ZAP000002",
+      "DeviceName": "Station 2",
+      "StartDateTime": "2024-03-05T08:00:00.000000",
+      "EndDateTime": "2024-03-05T09:00:00",
+      "CommitEndDateTime": "2024-03-05T09:00:00.000000",
+      "Energy": 1.50,
+      "EnergyDetails": [
+        {"Timestamp": "2024-03-05T08:15:00+00:00", "Energy": 1.50}
+      ]
+    },
+    {
+      "Id": "session-3",
+      "DeviceId": "ZAP000003",
+      "DeviceName": "Station 3",
+      "StartDateTime": "2024-03-06T08:00:00.000000",
+      "EndDateTime": "2024-03-06T09:00:00",
+      "CommitEndDateTime": "2024-03-06T09:00:00.000000",
+      "Energy": 3.0,
+      "EnergyDetails": [
+        {"Timestamp": "2024-03-06T08:15:00+00:00", "Energy": 0.0},
+        {"Timestamp": "2024-03-06T08:30:00+00:00", "Energy": 3.0}
+      ]
+    },
+    {
+      "Id": "session-4",
+      "DeviceId": "ZAP000003",
+      "DeviceName": "Station 3",
+      "StartDateTime": "2024-03-07T08:00:00.000000",
+      "EndDateTime": "2024-03-07T09:00:00",
+      "CommitEndDateTime": "2024-03-07T09:00:00.000000",
+      "Energy": 0.10000000,
+      "EnergyDetails": []
+    }
+  ]
+}
+'''
+
+
+def read_csv_rows(path) -> list[dict]:
+    with open(path, newline='') as csv_file:
+        return list(csv.DictReader(csv_file))
+
+
+def test_energies_with_more_decimals_than_the_fixed_point_units_are_summed_exactly(tmp_path):
+    chargehistory_file_path = tmp_path / 'chargehistory.json'
+    chargehistory_file_path.write_text(CHARGEHISTORY_JSON)
+    output_dir_path = tmp_path / 'output'
+
+    process_usage(
+        str(chargehistory_file_path),
+        UsageInterval(datetime(2024, 3, 1), datetime(2024, 4, 1)),
+        str(output_dir_path),
+        missing_energy_details_mode=MissingEnergyDetailsMode.RULES,
+        export_format=ExportFormat.CSV,
+        optional_locale=None)
+
+    summary_rows = read_csv_rows(output_dir_path / 'Summary.csv')
+    assert [(r['DeviceId'], r['TotalEnergy']) for r in summary_rows] == [
+        ('ZAP000001', '392.55490000000000004'),
+        ('ZAP000002', '1.50'),
+        ('ZAP000003', '3.10000000'),
+        ('TotalEnergy', '397.15490000000000004'),
+    ]
+    device_rows = read_csv_rows(output_dir_path / 'ZAP000001.csv')
+    assert [r['Energy'] for r in device_rows] == ['0.55150000000000004', '392.0034']
+    assert [r['ChargeSessionEnergy'] for r in device_rows] == ['392.5549', '392.5549']
+
+
+def test_daily_energies_with_more_decimals_than_the_fixed_point_units_are_not_stored(tmp_path):
+    chargehistory_file_path = tmp_path / 'chargehistory.json'
+    chargehistory_file_path.write_text(CHARGEHISTORY_JSON)
+
+    for output_dir_name in ('first', 'second'):
+        process_usage(
+            str(chargehistory_file_path),
+            UsageInterval(datetime(2024, 3, 1), datetime(2024, 4, 1)),
+            str(tmp_path / output_dir_name),
+            missing_energy_details_mode=MissingEnergyDetailsMode.RULES,
+            optional_daily_energy_store_file_path=str(tmp_path / 'daily-energies.sqlite'),
+            optional_installation_id='installation-1',
+            export_format=ExportFormat.CSV,
+            optional_locale=None)
+
+        summary_rows = read_csv_rows(tmp_path / output_dir_name / 'Summary.csv')
+        assert [r['TotalEnergy'] for r in summary_rows] == ['392.55490000000000004', '1.50', '3.10000000', '397.15490000000000004']
+
+
+def test_a_second_run_with_a_daily_energy_store_only_processes_the_days_that_are_not_stored(tmp_path, monkeypatch):
+    chargehistory_file_path = str(tmp_path / 'chargehistory.json')
+    write_chargehistory_json(generate_chargehistory_sessions(
+        start_date=date(2023, 2, 25),
+        num_years=0.1,
+        num_devices=3,
+        sessions_per_day=2,
+        energy_details_interval=pd.Timedelta(minutes=15).to_pytimedelta(),
+        missing_energy_details_fraction=0.2), chargehistory_file_path)
+    # The first and last days are partial, and never stored.
+    usage_interval = UsageInterval(datetime(2023, 3, 1, 3), datetime(2023, 4, 1, 3))
+    partial_days = {date(2023, 3, 1), date(2023, 4, 1)}
+
+    classified_days = []
+    resolved_days = []
+
+    def compute_energy_details_df(*args):
+        energy_details_df = compute_energy_details_df.original(*args)
+        classified_days.append(set(compute_daily_energies_df(energy_details_df)[TableColumns.DAY]))
+        return energy_details_df
+
+    def resolve(self, charge_session):
+        resolved_days[-1].add(charge_session.start_date_time.date())
+        return resolve.original(self, charge_session)
+
+    compute_energy_details_df.original = usage_processor.compute_energy_details_df
+    resolve.original = EnergyRateResolver.resolve
+    monkeypatch.setattr(usage_processor, 'compute_energy_details_df', compute_energy_details_df)
+    monkeypatch.setattr(EnergyRateResolver, 'resolve', resolve)
+
+    for output_dir_name, optional_daily_energy_store_file_path in (
+            ('without_store', None),
+            ('first', str(tmp_path / 'daily-energies.sqlite')),
+            ('second', str(tmp_path / 'daily-energies.sqlite'))):
+        resolved_days.append(set())
+        process_usage(
+            chargehistory_file_path,
+            usage_interval,
+            str(tmp_path / output_dir_name),
+            weekday_high_rate_interval=HighRateInterval(time(7), time(20)),
+            saturday_high_rate_interval=HighRateInterval(time(7), time(13)),
+            missing_energy_details_mode=MissingEnergyDetailsMode.RULES,
+            optional_daily_energy_store_file_path=optional_daily_energy_store_file_path,
+            optional_installation_id='installation-1',
+            export_format=ExportFormat.CSV,
+            optional_locale=None)
+
+    assert classified_days[1] == classified_days[0] and len(classified_days[0]) > 20
+    assert len(resolved_days[1]) > 2 and resolved_days[1] == resolved_days[0]
+    assert len(classified_days[2]) > 0 and classified_days[2] <= partial_days
+    assert resolved_days[2] <= partial_days
+    summary_rows = read_csv_rows(tmp_path / 'without_store' / 'Summary.csv')
+    assert read_csv_rows(tmp_path / 'first' / 'Summary.csv') == summary_rows
+    assert read_csv_rows(tmp_path / 'second' / 'Summary.csv') == summary_rows
+
+
+def test_npz_chargehistories_are_reported_like_their_json(tmp_path):
+    chargehistory_file_path = tmp_path / 'chargehistory.json'
+    chargehistory_file_path.write_text(CHARGEHISTORY_JSON)
+    npz_file_path = tmp_path / 'chargehistory.npz'
+    write_chargehistory_npz(read_chargehistory_sessions(str(chargehistory_file_path)), str(npz_file_path))
+
+    for input_file_path, output_dir_name in ((chargehistory_file_path, 'json'), (npz_file_path, 'npz')):
+        process_usage(
+            str(input_file_path),
+            UsageInterval(datetime(2024, 3, 1), datetime(2024, 4, 1)),
+            str(tmp_path / output_dir_name),
+            missing_energy_details_mode=MissingEnergyDetailsMode.RULES,
+            export_format=ExportFormat.CSV,
+            optional_locale=None)
+
+    file_names = sorted(os.listdir(tmp_path / 'json'))
+    assert file_names == ['Summary.csv', 'ZAP000001.csv', 'ZAP000002.csv', 'ZAP000003.csv']
+    assert sorted(os.listdir(tmp_path / 'npz')) == file_names
+    for file_name in file_names:
+        assert read_csv_rows(tmp_path / 'npz' / file_name) == read_csv_rows(tmp_path / 'json' / file_name)
+    assert [r['Energy'] for r in read_csv_rows(tmp_path / 'npz' / 'ZAP000003.csv')] == ['0.0', '3.0', '0.10000000']
@@ -0,0 +1,25 @@
+import pandas as pd
+import pytest
+
+from decimal import Decimal
+
+from xlsx_writer import StreamingXlsxWriter
+
+
+def test_empty_texts_are_blank_cells(tmp_path):
+    openpyxl = pytest.importorskip('openpyxl')
+    excel_file_path = str(tmp_path / 'output.xlsx')
+    df = pd.DataFrame({
+        'DeviceId': ['ZAP000001', 'Total'],
+        'DeviceName': ['Ladestation 1', ''],
+        'Energy': [Decimal('1.50'), Decimal('1.50')],
+        'Comment': ['', None]})
+    with StreamingXlsxWriter(excel_file_path) as writer:
+        writer.write_sheet('Summary', df, num_index_columns=2)
+
+    worksheet = openpyxl.load_workbook(excel_file_path)['Summary']
+    assert [[c.value for c in row] for row in worksheet.iter_rows(min_row=2)] == [
+        ['ZAP000001', 'Ladestation 1', '1.50', None],
+        ['Total', None, '1.50', None]]
+    # The blank index cell is still formatted like the header.
+    assert worksheet['B3'].font.bold
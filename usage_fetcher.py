@@ -1,43 +1,26 @@
 import argparse
 import inquirer
-import json
 import os
 import pytz
-import requests
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from enum import Enum
 from getpass import getpass
-from http import HTTPStatus
-from ratelimit import limits, sleep_and_retry
+from typing import Callable, Iterator
 
+from access_token_cache import DEFAULT_ACCESS_TOKEN_CACHE_FILE_PATH, AccessTokenManager
+from chargehistory_cache import ChargehistoryCache, get_charge_session_key
+from chargehistory_io import GZIP_NDJSON_SUFFIX, ZSTD_NDJSON_SUFFIX, ChargehistoryNdjsonWriter, is_chargehistory_ndjson,\
+    open_chargehistory_writer
+from chargehistory_validation import validate_charge_sessions
 from common import ChargeSession, UsageInterval, ZRH
+from metrics import METRICS, add_metrics_arguments, enable_metrics_from_args, report_metrics
+from zaptec_client import ZAPTEC_API_BASE_URL, RateLimiter, ZaptecClient
 
 
 DATA_KEY = 'Data'
-
-
-def fetch_access_token(
-        username: str,
-        password: str) -> str:
-    AUTH_URL = 'https://api.zaptec.com/oauth/token'
-    ACCESS_TOKEN_KEY = 'access_token'
-
-    data = {
-        'grant_type': 'password',
-        'username': username,
-        'password': password,
-    }
-
-    response = requests.post(AUTH_URL, data=data)
-    assert response.status_code == HTTPStatus.OK,\
-        'expected auth respose status code to be 200 (OK), but it was: %d.' % (response.status_code,)
-
-    response_json = response.json()
-    assert ACCESS_TOKEN_KEY in response_json,\
-        'access token not in auth response json: %s.' % (response_json,)
-
-    return response_json[ACCESS_TOKEN_KEY]
+DEFAULT_MAX_CONCURRENT_REQUESTS = 4
 
 
 class DetailLevel(Enum):
@@ -45,17 +28,16 @@ class DetailLevel(Enum):
     DETAILED = 1
 
 
-@sleep_and_retry
-@limits(calls=900, period=60)
 def fetch_chargehistory_page(
-        access_token: str,
+        client: ZaptecClient,
+        access_token_manager: AccessTokenManager,
         installation_id: str,
         fetch_interval: UsageInterval,
         page_size: int = 5000,
         page_index: int = 0,
         detail_level: int = DetailLevel.SUMMARY,
         include_disabled: bool = True) -> dict:
-    CHARGEHISTORY_URL = 'https://api.zaptec.com/api/chargehistory'
+    CHARGEHISTORY_PATH = '/api/chargehistory'
     AUTH_KEY = 'Authorization'
     INSTALLATION_ID_KEY = 'InstallationId'
     FROM_KEY = 'From'
@@ -65,8 +47,9 @@ def fetch_chargehistory_page(
     DETAIL_LEVEL_KEY = 'DetailLevel'
     INCLUDE_DISABLED_KEY = 'IncludeDisabled'
 
+    # The access token is refreshed here if it is about to expire, e.g. during a long paginated fetch.
     headers = {
-        AUTH_KEY: 'Bearer %s' % (access_token,),
+        AUTH_KEY: 'Bearer %s' % (access_token_manager.get_access_token(),),
     }
     params = {
         INSTALLATION_ID_KEY: installation_id,
@@ -78,23 +61,31 @@ def fetch_chargehistory_page(
         INCLUDE_DISABLED_KEY: include_disabled,
     }
 
-    response = requests.get(CHARGEHISTORY_URL, headers=headers, params=params)
-    assert response.status_code == HTTPStatus.OK,\
-        'expected chargehistory respose status code to be 200 (OK), but it was: %d.' % (response.status_code,)
-
-    return response.json()
+    with METRICS.stage('chargehistory_page', nested=False, PageIndex=page_index, DetailLevel=detail_level.name):
+        page_json = client.get_json(CHARGEHISTORY_PATH, headers=headers, params=params)
+    METRICS.increment('chargehistory_pages')
+    METRICS.increment('charge_sessions_fetched', len(page_json.get(DATA_KEY) or []))
+    return page_json
 
 
-def fetch_chargehistory(
-        access_token: str,
+def iterate_chargehistory_pages(
+        client: ZaptecClient,
+        access_token_manager: AccessTokenManager,
         installation_id: str,
         fetch_interval: UsageInterval,
         detail_level: int = DetailLevel.SUMMARY,
-        include_disabled: bool = True) -> dict:
+        include_disabled: bool = True,
+        max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS) -> Iterator[dict]:
+    # Yields the pages in order, each as soon as it and the ones before it were fetched, so that they can be
+    # processed while the next ones are still being fetched.
     PAGES_KEY = 'Pages'
 
+    assert max_concurrent_requests > 0,\
+        'the maximum number of concurrent requests needs to be > 0, but it was: %d.' % (max_concurrent_requests,)
+
     response_json = fetch_chargehistory_page(
-        access_token=access_token,
+        client=client,
+        access_token_manager=access_token_manager,
         installation_id=installation_id,
         fetch_interval=fetch_interval,
         detail_level=detail_level,
@@ -102,27 +93,200 @@ def fetch_chargehistory(
     assert PAGES_KEY in response_json, 'missing \'%s\' from response json: %s.' % (PAGES_KEY, response_json)
     assert response_json[PAGES_KEY] >= 0, 'the number of pages is < 0: %s.' % (response_json,)
     assert DATA_KEY in response_json, 'missing \'%s\' from response json: %s.' % (DATA_KEY, response_json)
-
-    for page_index in range(1, response_json[PAGES_KEY]):
-        page_json = fetch_chargehistory_page(
-            access_token=access_token,
+    yield response_json
+
+    # The remaining pages are fetched concurrently; the client's rate limit is shared by all threads
+    # and executor.map() returns the pages in order.
+    def fetch_page(page_index: int) -> dict:
+        return fetch_chargehistory_page(
+            client=client,
+            access_token_manager=access_token_manager,
             installation_id=installation_id,
             fetch_interval=fetch_interval,
             page_index=page_index,
             detail_level=detail_level,
             include_disabled=include_disabled)
-        assert DATA_KEY in page_json, 'missing \'%s\' from page json: %s.' % (DATA_KEY, page_json)
 
-        response_json[DATA_KEY].extend(page_json[DATA_KEY])
+    with ThreadPoolExecutor(max_workers=max_concurrent_requests) as executor:
+        for page_json in executor.map(fetch_page, range(1, response_json[PAGES_KEY])):
+            assert DATA_KEY in page_json, 'missing \'%s\' from page json: %s.' % (DATA_KEY, page_json)
+            yield page_json
+
 
+def fetch_chargehistory(
+        client: ZaptecClient,
+        access_token_manager: AccessTokenManager,
+        installation_id: str,
+        fetch_interval: UsageInterval,
+        detail_level: int = DetailLevel.SUMMARY,
+        include_disabled: bool = True,
+        max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS) -> dict:
+    page_jsons = iterate_chargehistory_pages(
+        client=client,
+        access_token_manager=access_token_manager,
+        installation_id=installation_id,
+        fetch_interval=fetch_interval,
+        detail_level=detail_level,
+        include_disabled=include_disabled,
+        max_concurrent_requests=max_concurrent_requests)
+    response_json = next(page_jsons)
+    for page_json in page_jsons:
+        response_json[DATA_KEY].extend(page_json[DATA_KEY])
     return response_json
 
 
+def iterate_chargehistory_with_cache(
+        client: ZaptecClient,
+        access_token_manager: AccessTokenManager,
+        installation_id: str,
+        fetch_interval: UsageInterval,
+        cache: ChargehistoryCache,
+        max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS) -> Iterator[dict]:
+    # Yields the charge sessions fetched for the missing intervals as they arrive, and then the cached ones
+    # that weren't fetched again.
+    cached_charge_sessions = cache.get_sessions(fetch_interval)
+
+    # Only the intervals that aren't synced yet are fetched, at the detailed level.
+    missing_intervals = cache.find_missing_intervals(fetch_interval)
+    fetched_charge_session_keys = set()
+    num_cache_misses = 0
+    for missing_interval in missing_intervals:
+        fetched_at = datetime.now(ZRH)
+        fetched_charge_sessions = []
+        for page_json in iterate_chargehistory_pages(
+                client=client,
+                access_token_manager=access_token_manager,
+                installation_id=installation_id,
+                fetch_interval=missing_interval,
+                detail_level=DetailLevel.DETAILED,
+                max_concurrent_requests=max_concurrent_requests):
+            fetched_charge_sessions.extend(page_json[DATA_KEY])
+            for charge_session in page_json[DATA_KEY]:
+                key = get_charge_session_key(charge_session)
+                if key not in fetched_charge_session_keys:
+                    fetched_charge_session_keys.add(key)
+                    yield charge_session
+        cache.add(missing_interval, fetched_charge_sessions, fetched_at)
+        num_cache_misses += len(fetched_charge_sessions)
+    cache.save()
+
+    for charge_session in cached_charge_sessions:
+        if get_charge_session_key(charge_session) not in fetched_charge_session_keys:
+            yield charge_session
+
+    METRICS.increment('chargehistory_cache_hits', len(cached_charge_sessions))
+    METRICS.increment('chargehistory_cache_misses', num_cache_misses)
+    print('Chargehistory cache: %d cached charge sessions reused, %d charge sessions fetched in %d missing interval(s).'
+        % (len(cached_charge_sessions), num_cache_misses, len(missing_intervals)))
+
+
+def fetch_chargehistory_with_cache(
+        client: ZaptecClient,
+        access_token_manager: AccessTokenManager,
+        installation_id: str,
+        fetch_interval: UsageInterval,
+        cache: ChargehistoryCache,
+        max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS) -> dict:
+    return {
+        DATA_KEY: sorted(
+            iterate_chargehistory_with_cache(
+                client=client,
+                access_token_manager=access_token_manager,
+                installation_id=installation_id,
+                fetch_interval=fetch_interval,
+                cache=cache,
+                max_concurrent_requests=max_concurrent_requests),
+            key=lambda s: (s[ChargeSession.Key.START_DATE_TIME], get_charge_session_key(s))),
+    }
+
+
+def iterate_detailed_charge_sessions(
+        client: ZaptecClient,
+        access_token_manager: AccessTokenManager,
+        installation_id: str,
+        fetch_interval: UsageInterval,
+        optional_cache: ChargehistoryCache | None = None,
+        max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS) -> Iterator[dict]:
+    # The streaming counterpart of fetch_detailed_chargehistory(), which yields the charge sessions in the
+    # order they arrive instead of collecting them.
+    if optional_cache is not None:
+        yield from iterate_chargehistory_with_cache(
+            client=client,
+            access_token_manager=access_token_manager,
+            installation_id=installation_id,
+            fetch_interval=fetch_interval,
+            cache=optional_cache,
+            max_concurrent_requests=max_concurrent_requests)
+        return
+    for page_json in iterate_chargehistory_pages(
+            client=client,
+            access_token_manager=access_token_manager,
+            installation_id=installation_id,
+            fetch_interval=fetch_interval,
+            detail_level=DetailLevel.DETAILED,
+            max_concurrent_requests=max_concurrent_requests):
+        yield from page_json[DATA_KEY]
+
+
+def fetch_detailed_chargehistory(
+        client: ZaptecClient,
+        access_token_manager: AccessTokenManager,
+        installation_id: str,
+        fetch_interval: UsageInterval,
+        optional_cache: ChargehistoryCache | None = None,
+        max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS) -> dict:
+    if optional_cache is None:
+        return fetch_chargehistory(
+            client=client,
+            access_token_manager=access_token_manager,
+            installation_id=installation_id,
+            fetch_interval=fetch_interval,
+            detail_level=DetailLevel.DETAILED,
+            max_concurrent_requests=max_concurrent_requests)
+    return fetch_chargehistory_with_cache(
+        client=client,
+        access_token_manager=access_token_manager,
+        installation_id=installation_id,
+        fetch_interval=fetch_interval,
+        cache=optional_cache,
+        max_concurrent_requests=max_concurrent_requests)
+
+
+def iterate_usage_charge_sessions(
+        client: ZaptecClient,
+        access_token_manager: AccessTokenManager,
+        installation_id: str,
+        usage_interval: UsageInterval,
+        after_usage_charge_sessions: list[dict],
+        optional_cache: ChargehistoryCache | None = None,
+        max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS) -> Iterator[dict]:
+    # The same charge sessions as the chargehistory that usage_fetcher.py writes, in the order they arrive.
+    charge_session_keys = set()
+    for charge_session in iterate_detailed_charge_sessions(
+            client=client,
+            access_token_manager=access_token_manager,
+            installation_id=installation_id,
+            fetch_interval=usage_interval,
+            optional_cache=optional_cache,
+            max_concurrent_requests=max_concurrent_requests):
+        charge_session_keys.add(get_charge_session_key(charge_session))
+        yield charge_session
+    # The charge sessions after the end of the usage interval were already fetched.
+    for charge_session in after_usage_charge_sessions:
+        if get_charge_session_key(charge_session) not in charge_session_keys:
+            yield charge_session
+
+
 def determine_fetch_interval(
-        access_token: str,
+        client: ZaptecClient,
+        access_token_manager: AccessTokenManager,
         installation_id: str,
         usage_interval: UsageInterval,
-        num_charging_stations: int) -> UsageInterval:
+        num_charging_stations: int,
+        max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS,
+        optional_cache: ChargehistoryCache | None = None) -> tuple[UsageInterval, list[dict]]:
+    # Returns the fetch interval, together with the detailed charge sessions that were already fetched
+    # after the end of the usage interval, up to the end of the fetch interval.
     current_date_time = datetime.now(ZRH)
     assert usage_interval.end_date_time <= current_date_time,\
         'the usage interval ends in the future'
@@ -133,65 +297,65 @@ def determine_fetch_interval(
     MAX_TOTAL_ADDED_TIMEDELTA = min(
         timedelta(weeks=8),
         current_date_time - usage_interval.end_date_time + FETCH_INCREMENT_TIMEDELTA)
-
-    fetch_interval = usage_interval.copy()
-    fetch_interval_step = usage_interval.copy()
-    device_id_set = set()
-
-    while len(device_id_set) < num_charging_stations and\
-            fetch_interval.end_date_time + FETCH_INCREMENT_TIMEDELTA\
-            <= usage_interval.end_date_time + MAX_TOTAL_ADDED_TIMEDELTA:
-        fetch_interval.end_date_time += FETCH_INCREMENT_TIMEDELTA
-
-        fetch_interval_step.start_date_time = fetch_interval_step.end_date_time
-        fetch_interval_step.end_date_time += FETCH_INCREMENT_TIMEDELTA
-
-        chargehistory_json = fetch_chargehistory(
-            access_token=access_token,
+    MAX_NUM_INCREMENTS = MAX_TOTAL_ADDED_TIMEDELTA // FETCH_INCREMENT_TIMEDELTA\
+        if FETCH_INCREMENT_TIMEDELTA > timedelta(0) else 0
+
+    # The fetch interval is extended by whole increments, until it includes a charging session of every
+    # charging station. Instead of probing one increment per request, the probes double in size (1, 1, 2,
+    # 4 increments), at the detailed level so that the probed charge sessions don't need to be fetched again.
+    num_api_calls_before = client.num_requests
+    probe_charge_sessions = []
+    device_id_to_first_increment = {}
+    num_probed_increments = 0
+    while len(device_id_to_first_increment) < num_charging_stations and num_probed_increments < MAX_NUM_INCREMENTS:
+        num_probe_increments = min(max(1, num_probed_increments), MAX_NUM_INCREMENTS - num_probed_increments)
+
+        probe_interval = usage_interval.copy()
+        probe_interval.start_date_time = usage_interval.end_date_time + num_probed_increments * FETCH_INCREMENT_TIMEDELTA
+        probe_interval.end_date_time = probe_interval.start_date_time + num_probe_increments * FETCH_INCREMENT_TIMEDELTA
+
+        chargehistory_json = fetch_detailed_chargehistory(
+            client=client,
+            access_token_manager=access_token_manager,
             installation_id=installation_id,
-            fetch_interval=fetch_interval_step)
+            fetch_interval=probe_interval,
+            optional_cache=optional_cache,
+            max_concurrent_requests=max_concurrent_requests)
 
+        validate_charge_sessions(chargehistory_json[DATA_KEY])
         for charge_session_json in chargehistory_json[DATA_KEY]:
             charge_session = ChargeSession(charge_session_json)
 
             assert usage_interval.end_date_time <= charge_session.end_date_time,\
                 'expected the end time of the charging session to be after the usage time: %s' % (charge_session.end_date_time,)
-            device_id_set.add(charge_session.device_id)
-
-    assert len(device_id_set) >= num_charging_stations,\
-        'didn\'t manage to find a charging session after the usage interval for all charging stations: %s' % (device_id_set,)
-    return fetch_interval
+            increment = min(
+                max((charge_session.start_date_time - usage_interval.end_date_time) // FETCH_INCREMENT_TIMEDELTA, num_probed_increments),
+                num_probed_increments + num_probe_increments - 1)
+            device_id_to_first_increment[charge_session.device_id] = min(
+                increment, device_id_to_first_increment.get(charge_session.device_id, increment))
+            probe_charge_sessions.append((increment, charge_session_json))
 
+        num_probed_increments += num_probe_increments
 
-def fetch_usage(
-        username: str,
-        password: str,
-        installation_id: str,
-        usage_interval: UsageInterval,
-        num_charging_stations: int,
-        output_chargehistory_file_name: str) -> None:
-    assert num_charging_stations > 0,\
-        'the number of charging stations needs to be > 0, but it was: %d.' % (num_charging_stations,)
+    assert len(device_id_to_first_increment) >= num_charging_stations,\
+        'didn\'t manage to find a charging session after the usage interval for all charging stations: %s' % (set(device_id_to_first_increment),)
 
-    access_token = fetch_access_token(
-        username=username,
-        password=password)
+    # The fetch interval is the same as when extending it one increment at a time.
+    num_increments = sorted(device_id_to_first_increment.values())[num_charging_stations - 1] + 1
+    fetch_interval = usage_interval.copy()
+    fetch_interval.end_date_time += num_increments * FETCH_INCREMENT_TIMEDELTA
 
-    fetch_interval = determine_fetch_interval(
-        access_token=access_token,
-        installation_id=installation_id,
-        usage_interval=usage_interval,
-        num_charging_stations=num_charging_stations)
-    print('Fetching charging history for the interval: %s - %s'
-        % (fetch_interval.start_date_time, fetch_interval.end_date_time))
+    print('Determined the fetch interval with %d API call(s) instead of at least %d, and without re-fetching its '
+        '%d charge session(s) after the usage interval.' % (
+            client.num_requests - num_api_calls_before,
+            num_increments,
+            sum(1 for increment, _ in probe_charge_sessions if increment < num_increments)))
+    return fetch_interval, [s for increment, s in probe_charge_sessions if increment < num_increments]
 
-    chargehistory_json = fetch_chargehistory(
-        access_token=access_token,
-        installation_id=installation_id,
-        fetch_interval=fetch_interval,
-        detail_level=DetailLevel.DETAILED)
 
-    if os.path.exists(output_chargehistory_file_name):
+def check_output_file_overwrite(output_file_name: str, optional_overwrite: bool | None) -> None:
+    # If optional_overwrite is None and the output file exists, the user is asked whether to overwrite it.
+    if os.path.exists(output_file_name) and optional_overwrite is None:
         answers = inquirer.prompt([
             inquirer.List(
                 'overwrite_file',
@@ -201,9 +365,125 @@ def fetch_usage(
         if answers['overwrite_file'] != 'Yes':
             print('Data not saved.')
             exit(1)
+    assert optional_overwrite is not False or not os.path.exists(output_file_name),\
+        'the output file already exists: %s.' % (output_file_name,)
 
-    with open(output_chargehistory_file_name, 'w') as chargehistory_file:
-        json.dump(chargehistory_json, chargehistory_file, indent=2)
+
+def fetch_usage(
+        username: str,
+        get_password: Callable[[], str],
+        installation_id: str,
+        usage_interval: UsageInterval,
+        num_charging_stations: int,
+        output_chargehistory_file_name: str,
+        max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS,
+        optional_cache_dir: str | None = None,
+        optional_rate_limiter: RateLimiter | None = None,
+        optional_overwrite: bool | None = None,
+        optional_access_token_cache_file_path: str | None = DEFAULT_ACCESS_TOKEN_CACHE_FILE_PATH,
+        resume: bool = False,
+        base_url: str = ZAPTEC_API_BASE_URL) -> None:
+    # If optional_overwrite is None and the output file exists, the user is asked whether to overwrite it.
+    # get_password() is only called if there is no cached access token that is still valid. A compressed NDJSON
+    # output is appended to as the charge sessions arrive; with resume, the charge sessions already in it are
+    # kept, and only the missing ones appended.
+    assert num_charging_stations > 0,\
+        'the number of charging stations needs to be > 0, but it was: %d.' % (num_charging_stations,)
+    is_ndjson_output = is_chargehistory_ndjson(output_chargehistory_file_name)
+    assert is_ndjson_output or not resume,\
+        'only compressed NDJSON outputs, ending with \'%s\' or \'%s\', can be resumed: %s.' % (
+            GZIP_NDJSON_SUFFIX, ZSTD_NDJSON_SUFFIX, output_chargehistory_file_name)
+    # Asked before fetching, since a compressed NDJSON output is written while it's fetched.
+    if is_ndjson_output and not resume:
+        check_output_file_overwrite(output_chargehistory_file_name, optional_overwrite)
+
+    with ZaptecClient(
+            base_url=base_url, pool_size=max_concurrent_requests, rate_limiter=optional_rate_limiter) as client:
+        access_token_manager = AccessTokenManager(
+            client=client,
+            username=username,
+            get_password=get_password,
+            optional_cache_file_path=optional_access_token_cache_file_path)
+        # Authenticate before anything else, so that a wrong password fails early.
+        access_token_manager.get_access_token()
+
+        optional_cache = ChargehistoryCache(optional_cache_dir, installation_id)\
+            if optional_cache_dir is not None else None
+
+        with METRICS.stage('fetch_interval_discovery'):
+            fetch_interval, after_usage_charge_sessions = determine_fetch_interval(
+                client=client,
+                access_token_manager=access_token_manager,
+                installation_id=installation_id,
+                usage_interval=usage_interval,
+                num_charging_stations=num_charging_stations,
+                max_concurrent_requests=max_concurrent_requests,
+                optional_cache=optional_cache)
+        print('Fetching charging history for the interval: %s - %s'
+            % (fetch_interval.start_date_time, fetch_interval.end_date_time))
+
+        if is_ndjson_output:
+            with METRICS.stage('usage_interval_fetch'),\
+                    ChargehistoryNdjsonWriter(output_chargehistory_file_name, resume=resume) as writer:
+                for charge_session in iterate_usage_charge_sessions(
+                        client=client,
+                        access_token_manager=access_token_manager,
+                        installation_id=installation_id,
+                        usage_interval=usage_interval,
+                        after_usage_charge_sessions=after_usage_charge_sessions,
+                        optional_cache=optional_cache,
+                        max_concurrent_requests=max_concurrent_requests):
+                    writer.write_charge_session(charge_session)
+            METRICS.increment('charge_sessions', writer.num_charge_sessions + writer.num_skipped_charge_sessions)
+            if resume:
+                print('Resumed %s: %d charge sessions were already written, %d appended.'
+                    % (output_chargehistory_file_name, writer.num_skipped_charge_sessions, writer.num_charge_sessions))
+            return
+
+        # The charge sessions after the end of the usage interval were already fetched.
+        with METRICS.stage('usage_interval_fetch'):
+            chargehistory_json = fetch_detailed_chargehistory(
+                client=client,
+                access_token_manager=access_token_manager,
+                installation_id=installation_id,
+                fetch_interval=usage_interval,
+                optional_cache=optional_cache,
+                max_concurrent_requests=max_concurrent_requests)
+        charge_session_keys = set(get_charge_session_key(s) for s in chargehistory_json[DATA_KEY])
+        chargehistory_json[DATA_KEY].extend(
+            s for s in after_usage_charge_sessions if get_charge_session_key(s) not in charge_session_keys)
+
+    check_output_file_overwrite(output_chargehistory_file_name, optional_overwrite)
+
+    METRICS.increment('charge_sessions', len(chargehistory_json[DATA_KEY]))
+    # The same writers as the raw output of usage_pipeline.py, so that both write the same files, e.g. the JSON as
+    # a single page.
+    with METRICS.stage('output_write'), open_chargehistory_writer(output_chargehistory_file_name) as writer:
+        for charge_session_json in chargehistory_json[DATA_KEY]:
+            writer.write_charge_session(charge_session_json)
+
+
+def add_fetching_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        '--max_concurrent_requests',
+        type=int,
+        default=DEFAULT_MAX_CONCURRENT_REQUESTS,
+        help='the maximum number of chargehistory pages fetched concurrently; the API rate limit '
+        'is shared by all of them (default: %(default)s)')
+    parser.add_argument(
+        '--cache_dir',
+        help='a directory in which to cache the fetched charge sessions across runs; only the time ranges '
+        'that aren\'t cached yet, or whose charge sessions might still change, are fetched again')
+    parser.add_argument(
+        '--access_token_cache_file',
+        default=DEFAULT_ACCESS_TOKEN_CACHE_FILE_PATH,
+        help='the file in which the Zaptec API access tokens are cached across runs, readable only by the '
+        'current user; an empty path disables it (default: %(default)s)')
+    parser.add_argument(
+        '--base_url',
+        default=ZAPTEC_API_BASE_URL,
+        help='the base URL of the Zaptec API, e.g. of a local \'fake_zaptec_server.py\' for tests and '
+        'benchmarks (default: %(default)s)')
 
 
 def main():
@@ -213,7 +493,7 @@ def main():
     parser.add_argument(
         'username',
         help='the Zaptec account username, for calling the Zaptec API; '
-        'the password will be prompted during execution')
+        'the password will be prompted during execution, unless a cached access token is still valid')
     parser.add_argument(
         'installation_id',
         help='the Zaptec installation ID')
@@ -234,18 +514,35 @@ def main():
         'after the usage period')
     parser.add_argument(
         'output_chargehistory_file_name',
-        help='the path to the output Zaptec chargehistory API response, in JSON format')
+        help='the path to the output Zaptec chargehistory API response, in JSON format, in the '
+        'columnar .npz format if the path ends with \'.npz\', or in the compressed NDJSON format, appended '
+        'to as it\'s fetched, if the path ends with \'%s\' or \'%s\' (which needs the zstandard package)'
+        % (GZIP_NDJSON_SUFFIX, ZSTD_NDJSON_SUFFIX))
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='for a compressed NDJSON output, e.g. of an interrupted fetch, keep the charge sessions that are '
+        'already in it, and only append the missing ones')
+    add_fetching_arguments(parser)
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
-    password = getpass()
+    enable_metrics_from_args(args)
 
     fetch_usage(
         username=args.username,
-        password=password,
+        get_password=getpass,
         installation_id=args.installation_id,
         usage_interval=UsageInterval(args.usage_interval_start, args.usage_interval_end),
         num_charging_stations=args.num_charging_stations,
-        output_chargehistory_file_name=args.output_chargehistory_file_name)
+        output_chargehistory_file_name=args.output_chargehistory_file_name,
+        max_concurrent_requests=args.max_concurrent_requests,
+        optional_cache_dir=args.cache_dir,
+        optional_access_token_cache_file_path=args.access_token_cache_file or None,
+        resume=args.resume,
+        base_url=args.base_url)
+
+    report_metrics(args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,197 @@
+import argparse
+
+from contextlib import ExitStack
+from datetime import datetime
+from getpass import getpass
+from typing import Callable, Iterator
+
+from access_token_cache import DEFAULT_ACCESS_TOKEN_CACHE_FILE_PATH, AccessTokenManager
+from chargehistory_cache import ChargehistoryCache
+from chargehistory_io import open_chargehistory_writer
+from chargehistory_validation import ChargehistoryValidator, ValidationLevel
+from common import HighRateInterval, UsageInterval
+from energy_rate_decisions import EnergyRateResolver, MissingEnergyDetailsMode
+from metrics import METRICS, add_metrics_arguments, enable_metrics_from_args, report_metrics
+from table_export import ExportFormat
+from usage_fetcher import DEFAULT_MAX_CONCURRENT_REQUESTS, add_fetching_arguments, check_output_file_overwrite,\
+    determine_fetch_interval, iterate_usage_charge_sessions
+from usage_processor import LOCALE, add_processing_arguments, collect_energy_detail_batch_from_sessions,\
+    get_locale_from_args, make_tariff, make_period_usage_intervals_from_args, report_usage
+from zaptec_client import ZAPTEC_API_BASE_URL, RateLimiter, ZaptecClient
+
+
+def tee_charge_sessions(charge_sessions: Iterator[dict], writer) -> Iterator[dict]:
+    for charge_session in charge_sessions:
+        writer.write_charge_session(charge_session)
+        yield charge_session
+
+
+def fetch_and_process_usage(
+        username: str,
+        get_password: Callable[[], str],
+        installation_id: str,
+        usage_interval: UsageInterval,
+        num_charging_stations: int,
+        output_excel_file_name: str,
+        optional_raw_output_file_name: str | None = None,
+        max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS,
+        optional_cache_dir: str | None = None,
+        optional_rate_limiter: RateLimiter | None = None,
+        optional_overwrite: bool | None = None,
+        optional_access_token_cache_file_path: str | None = DEFAULT_ACCESS_TOKEN_CACHE_FILE_PATH,
+        weekday_high_rate_interval: HighRateInterval = None,
+        saturday_high_rate_interval: HighRateInterval = None,
+        missing_energy_details_mode: MissingEnergyDetailsMode = MissingEnergyDetailsMode.PROMPT,
+        optional_energy_rate_decisions_file_path: str | None = None,
+        validation_level: ValidationLevel = ValidationLevel.STRICT,
+        optional_daily_energy_store_file_path: str | None = None,
+        optional_tariff_file_path: str | None = None,
+        optional_period_usage_intervals: list[UsageInterval] | None = None,
+        combined_workbook: bool = False,
+        base_url: str = ZAPTEC_API_BASE_URL,
+        export_format: ExportFormat = ExportFormat.EXCEL,
+        optional_locale: str | None = LOCALE) -> None:
+    # Parses the charge sessions while the chargehistory pages are still being fetched, instead of writing
+    # the whole chargehistory to a file and loading it again. The raw chargehistory is only written, along
+    # the way, if optional_raw_output_file_name is set.
+    assert num_charging_stations > 0,\
+        'the number of charging stations needs to be > 0, but it was: %d.' % (num_charging_stations,)
+    # Asked before fetching, since the raw chargehistory is written while it's fetched.
+    if optional_raw_output_file_name is not None:
+        check_output_file_overwrite(optional_raw_output_file_name, optional_overwrite)
+
+    tariff = make_tariff(weekday_high_rate_interval, saturday_high_rate_interval, optional_tariff_file_path)
+    energy_rate_resolver = EnergyRateResolver(
+        missing_energy_details_mode,
+        tariff,
+        optional_energy_rate_decisions_file_path,
+        optional_locale)
+
+    with ZaptecClient(
+            base_url=base_url, pool_size=max_concurrent_requests, rate_limiter=optional_rate_limiter) as client:
+        access_token_manager = AccessTokenManager(
+            client=client,
+            username=username,
+            get_password=get_password,
+            optional_cache_file_path=optional_access_token_cache_file_path)
+        # Authenticate before anything else, so that a wrong password fails early.
+        access_token_manager.get_access_token()
+
+        optional_cache = ChargehistoryCache(optional_cache_dir, installation_id)\
+            if optional_cache_dir is not None else None
+
+        with METRICS.stage('fetch_interval_discovery'):
+            fetch_interval, after_usage_charge_sessions = determine_fetch_interval(
+                client=client,
+                access_token_manager=access_token_manager,
+                installation_id=installation_id,
+                usage_interval=usage_interval,
+                num_charging_stations=num_charging_stations,
+                max_concurrent_requests=max_concurrent_requests,
+                optional_cache=optional_cache)
+        print('Fetching charging history for the interval: %s - %s'
+            % (fetch_interval.start_date_time, fetch_interval.end_date_time))
+
+        with ExitStack() as exit_stack:
+            charge_sessions = METRICS.timed_iterator('usage_interval_fetch', iterate_usage_charge_sessions(
+                client=client,
+                access_token_manager=access_token_manager,
+                installation_id=installation_id,
+                usage_interval=usage_interval,
+                after_usage_charge_sessions=after_usage_charge_sessions,
+                optional_cache=optional_cache,
+                max_concurrent_requests=max_concurrent_requests))
+            if optional_raw_output_file_name is not None:
+                charge_sessions = tee_charge_sessions(
+                    charge_sessions, exit_stack.enter_context(open_chargehistory_writer(optional_raw_output_file_name)))
+            with METRICS.stage('session_parsing'):
+                energy_detail_batch = collect_energy_detail_batch_from_sessions(
+                    charge_sessions, usage_interval, ChargehistoryValidator(validation_level))
+
+    report_usage(
+        energy_detail_batch,
+        usage_interval,
+        output_excel_file_name,
+        tariff,
+        energy_rate_resolver,
+        optional_daily_energy_store_file_path,
+        installation_id,
+        optional_period_usage_intervals,
+        combined_workbook,
+        export_format,
+        optional_locale)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Fetch usage from \'https://api.zaptec.com/api/chargehistory/\' and process it while '
+        'it\'s fetched.')
+
+    parser.add_argument(
+        'username',
+        help='the Zaptec account username, for calling the Zaptec API; '
+        'the password will be prompted during execution, unless a cached access token is still valid')
+    parser.add_argument(
+        'installation_id',
+        help='the Zaptec installation ID')
+    parser.add_argument(
+        'usage_interval_start',
+        type=datetime.fromisoformat,
+        help='the start of the usage reporting period, in the Europe/Zurich time zone, '
+        'but without explicit time zone info')
+    parser.add_argument(
+        'usage_interval_end',
+        type=datetime.fromisoformat,
+        help='the end of the usage reporting period, in the Europe/Zurich time zone, '
+        'but without explicit time zone info')
+    parser.add_argument(
+        'num_charging_stations',
+        type=int,
+        help='the number of charging stations for which to include at least one session that ended '
+        'after the usage period')
+    parser.add_argument(
+        'output_excel_file_name',
+        help='the path to the output Excel file, or to the output directory with --export_format csv or parquet')
+    parser.add_argument(
+        '--raw_output_file',
+        help='the path to which to also write the fetched Zaptec chargehistory, in JSON format, in the '
+        'columnar .npz format if the path ends with \'.npz\', or in the compressed NDJSON format if it ends '
+        'with \'.ndjson.gz\' or \'.ndjson.zst\'; if unspecified, it isn\'t written')
+    add_fetching_arguments(parser)
+    add_processing_arguments(parser)
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    enable_metrics_from_args(args)
+
+    fetch_and_process_usage(
+        username=args.username,
+        get_password=getpass,
+        installation_id=args.installation_id,
+        usage_interval=UsageInterval(args.usage_interval_start, args.usage_interval_end),
+        num_charging_stations=args.num_charging_stations,
+        output_excel_file_name=args.output_excel_file_name,
+        optional_raw_output_file_name=args.raw_output_file,
+        max_concurrent_requests=args.max_concurrent_requests,
+        optional_cache_dir=args.cache_dir,
+        optional_access_token_cache_file_path=args.access_token_cache_file or None,
+        weekday_high_rate_interval=
+            HighRateInterval(args.weekday_high_rate_interval[0], args.weekday_high_rate_interval[1])
+            if args.weekday_high_rate_interval is not None
+            else None,
+        saturday_high_rate_interval=
+            HighRateInterval(args.saturday_high_rate_interval[0], args.saturday_high_rate_interval[1])
+            if args.saturday_high_rate_interval is not None
+            else None,
+        missing_energy_details_mode=args.missing_energy_details,
+        optional_energy_rate_decisions_file_path=args.energy_rate_decisions_file,
+        validation_level=args.validation,
+        optional_daily_energy_store_file_path=args.daily_energy_store,
+        optional_tariff_file_path=args.tariff_file,
+        optional_period_usage_intervals=make_period_usage_intervals_from_args(args),
+        combined_workbook=args.combined_workbook,
+        base_url=args.base_url,
+        export_format=args.export_format,
+        optional_locale=get_locale_from_args(args))
+
+    report_metrics(args)
@@ -1,30 +1,358 @@
 import argparse
-import json
+import os
+import pytz
 
+import numpy as np
 import pandas as pd
 
-from datetime import datetime, time, timezone
-from decimal import Decimal
+from datetime import date, datetime, time, timezone
 from enum import Enum
 from functools import total_ordering
-from UliPlot.XLSX import auto_adjust_xlsx_column_width
+from typing import Iterable
 
-from common import ChargeSession, EnergyDetail, EnergyRate, HighRateInterval,\
-    TIMESTAMP_RECORD_DELAY, UsageInterval, ZRH, is_timezone_naive
+from chargehistory_index import IndexKey, find_indexed_positions, open_chargehistory_index, read_indexed_charge_sessions
+from chargehistory_io import NPZ_ENERGY_DETAIL_ENERGY_KEYS, NPZ_ENERGY_KEYS, NpzKey, is_chargehistory_npz,\
+    read_chargehistory_npz, read_chargehistory_sessions, select_npz_energies, validate_chargehistory_npz_columns
+from chargehistory_validation import ChargehistoryValidator, SAMPLED_VALIDATION_STRIDE, ValidationLevel
+from daily_energy_store import DailyEnergy, DailyEnergyStore, get_whole_days, make_tariff_key
+from common import ChargeSession, EnergyDetail, EnergyRate, HighRateInterval, LocalTimeConverter,\
+    TIMESTAMP_RECORD_DELAY, UsageInterval, ZRH, ZRH_LOCAL_TIME_CONVERTER, are_in_usage_interval, compute_energy_rates,\
+    compute_usage_interval_indices,\
+    FixedPointEnergy, are_exact_decimal_energies, concatenate_energies, energies_to_decimals, energy_to_fixed_point,\
+    energy_to_optional_fixed_point, fixed_point_to_decimals, get_energy_decimals,\
+    is_timezone_naive, make_energy_array, parse_energy_detail_timestamps, parse_fixed_point_energy
+from energy_rate_decisions import EnergyRateResolver, MissingEnergyDetailsMode
+from metrics import METRICS, add_metrics_arguments, enable_metrics_from_args, report_metrics
+from table_export import ExportFormat, open_table_writer
+from tariff import Tariff, get_energy_rate_name, make_high_rate_tariff, read_tariff
 
 
 LOCALE = 'de-CH'
 
 
-def process_usage(
+# The energy details of JSON chargehistories are converted to arrays this many at a time, so that no Python
+# object is kept per energy detail for the whole history.
+ENERGY_DETAILS_CHUNK_SIZE = 1 << 16
+
+
+class EnergyDetailBatch:
+    # The rows of the energy details table, as a struct of arrays: one row per energy detail, plus one row
+    # per charge session without energy details, with a missing (NaT) timestamp; its energy rate is the
+    # charge session's. Each row references its charge session by index, the timestamps are int64
+    # nanoseconds in UTC and the energies are fixed-point (see ENERGY_FIXED_POINT_SCALE), with the number
+    # of decimals they were written with, or, if some have more decimals than that, all exact Decimals.
+    def __init__(
+            self,
+            charge_sessions: list[ChargeSession],
+            charge_session_indices: np.ndarray,
+            timestamps: pd.DatetimeIndex,
+            energies: np.ndarray,
+            energy_decimals: np.ndarray):
+        self.charge_sessions = charge_sessions
+        self.charge_session_indices = charge_session_indices
+        self.timestamps = timestamps
+        self.energies = energies
+        self.energy_decimals = energy_decimals
+
+
+def make_energy_detail_batch(
+        charge_sessions: list[ChargeSession],
+        charge_session_indices: list[np.ndarray],
+        timestamps: list[np.ndarray],
+        energies: list[np.ndarray],
+        energy_decimals: list[np.ndarray]) -> EnergyDetailBatch:
+    # From chunks of rows, with the timestamps as int64 nanoseconds in UTC (NaT without energy detail).
+    def concatenate(arrays: list[np.ndarray], dtype) -> np.ndarray:
+        return np.concatenate(arrays).astype(dtype, copy=False) if len(arrays) > 0 else np.array([], dtype=dtype)
+
+    charge_session_indices = concatenate(charge_session_indices, np.int32)
+    energies = concatenate_energies(energies, energy_decimals)
+    negative_energy_indices = np.flatnonzero(energies < 0)
+    assert len(negative_energy_indices) == 0,\
+        'The energy is < 0 for %d energy details, e.g. of charge session: %s.' % (
+            len(negative_energy_indices),
+            charge_sessions[charge_session_indices[negative_energy_indices[0]]].raw_charge_session)
+    return EnergyDetailBatch(
+        charge_sessions=charge_sessions,
+        charge_session_indices=charge_session_indices,
+        timestamps=pd.DatetimeIndex(concatenate(timestamps, np.int64).view('datetime64[ns]')).tz_localize(pytz.utc),
+        energies=energies,
+        energy_decimals=concatenate(energy_decimals, np.int8))
+
+
+def is_charge_session_outside_usage_interval(charge_session: ChargeSession, usage_interval: UsageInterval) -> bool:
+    return charge_session.end_date_time <= usage_interval.start_date_time\
+        or usage_interval.end_date_time <= charge_session.start_date_time - TIMESTAMP_RECORD_DELAY
+
+
+def resolve_energy_rates(
+        energy_detail_batch: EnergyDetailBatch,
+        usage_interval: UsageInterval,
+        energy_rate_resolver: EnergyRateResolver) -> None:
+    # Only once the whole chargehistory is known to be valid, and the days that are already stored are dropped,
+    # so that nobody is prompted in vain. The decisions taken so far are saved also if this is interrupted.
+    try:
+        for i in np.unique(energy_detail_batch.charge_session_indices[energy_detail_batch.timestamps.isna()]):
+            charge_session = energy_detail_batch.charge_sessions[i]
+            charge_session.compute_energy_details_or_rate(usage_interval, energy_rate_resolver.resolve)
+            assert charge_session.optional_energy_rate is not None,\
+                'The charging session is missing both energy details and an explicit energy rate: %s'\
+                    % charge_session.raw_charge_session
+    finally:
+        energy_rate_resolver.save_decisions()
+
+
+def collect_energy_detail_batch_from_sessions(
+        charge_session_jsons: Iterable[dict],
+        usage_interval: UsageInterval,
+        validator: ChargehistoryValidator) -> EnergyDetailBatch:
+    return collect_energy_detail_batch_from_indexed_sessions(
+        enumerate(charge_session_jsons), usage_interval, validator)
+
+
+def collect_energy_detail_batch_from_indexed_sessions(
+        indexed_charge_session_jsons: Iterable[tuple[int, dict]],
+        usage_interval: UsageInterval,
+        validator: ChargehistoryValidator) -> EnergyDetailBatch:
+    # The charge sessions come with their record index in the chargehistory, e.g. only some of them, read with
+    # an index.
+    charge_sessions = []
+    chunk_charge_session_indices = []
+    chunk_timestamps = []
+    chunk_energies = []
+    chunk_energy_decimals = []
+    row_charge_session_indices = []
+    row_timestamps = []
+    row_energies = []
+
+    def convert_rows() -> None:
+        # A chunk with energies that have more decimals than the fixed-point units keeps their exact Decimals.
+        energies, energy_decimals = make_energy_array(row_energies)
+        chunk_charge_session_indices.append(np.array(row_charge_session_indices, dtype=np.int32))
+        chunk_timestamps.append(parse_energy_detail_timestamps(row_timestamps).asi8)
+        chunk_energies.append(energies)
+        chunk_energy_decimals.append(energy_decimals)
+        row_charge_session_indices.clear()
+        row_timestamps.clear()
+        row_energies.clear()
+
+    for record_index, charge_session_json in indexed_charge_session_jsons:
+        # Invalid charge sessions are skipped, and all of them reported at the end.
+        if not validator.validate_charge_session(record_index, charge_session_json):
+            continue
+        charge_session = ChargeSession(charge_session_json)
+
+        if is_charge_session_outside_usage_interval(charge_session, usage_interval):
+            continue
+
+        charge_session_index = len(charge_sessions)
+        charge_sessions.append(charge_session)
+
+        raw_energy_details = charge_session.pop_raw_energy_details()
+        if len(raw_energy_details) == 0:
+            row_charge_session_indices.append(charge_session_index)
+            row_timestamps.append(None)
+            row_energies.append(charge_session.energy)
+            continue
+
+        for raw_energy_detail in raw_energy_details:
+            row_charge_session_indices.append(charge_session_index)
+            row_timestamps.append(raw_energy_detail[EnergyDetail.Key.TIMESTAMP])
+            row_energies.append(raw_energy_detail[EnergyDetail.Key.ENERGY])
+        if len(row_timestamps) >= ENERGY_DETAILS_CHUNK_SIZE:
+            convert_rows()
+
+    if len(row_timestamps) > 0:
+        convert_rows()
+    validator.assert_valid()
+    return make_energy_detail_batch(
+        charge_sessions, chunk_charge_session_indices, chunk_timestamps, chunk_energies, chunk_energy_decimals)
+
+
+def collect_energy_detail_batch_from_json(
         chargehistory_file_path: str,
         usage_interval: UsageInterval,
-        output_excel_file_name: str,
-        weekday_high_rate_interval: HighRateInterval = None,
-        saturday_high_rate_interval: HighRateInterval = None) -> None:
+        validator: ChargehistoryValidator) -> EnergyDetailBatch:
+    # The charge sessions are streamed, so loading them is timed while they are parsed.
+    return collect_energy_detail_batch_from_sessions(
+        METRICS.timed_iterator(
+            'json_load', read_chargehistory_sessions(chargehistory_file_path, parse_float=parse_fixed_point_energy)),
+        usage_interval,
+        validator)
+
+
+def collect_energy_detail_batch_from_index(
+        chargehistory_file_path: str,
+        usage_interval: UsageInterval,
+        validator: ChargehistoryValidator) -> EnergyDetailBatch:
+    # Only the charge sessions in the usage interval are read and parsed.
+    with METRICS.stage('index_load'):
+        index = open_chargehistory_index(chargehistory_file_path)
+        positions = find_indexed_positions(index, usage_interval)
+    METRICS.increment('indexed_charge_sessions_skipped', int(index[IndexKey.NUM_RECORDS]) - len(positions))
+    return collect_energy_detail_batch_from_indexed_sessions(
+        METRICS.timed_iterator(
+            'json_load',
+            read_indexed_charge_sessions(chargehistory_file_path, index, positions, parse_float=parse_fixed_point_energy)),
+        usage_interval,
+        validator)
+
+
+def collect_energy_detail_batch_from_columns(
+        columns: dict[NpzKey, np.ndarray],
+        usage_interval: UsageInterval,
+        validator: ChargehistoryValidator) -> EnergyDetailBatch:
+    # Nothing is parsed here: only the charge sessions in the usage interval are turned into objects, and
+    # the rows of their energy details are gathered from the flat arrays at once.
+    validate_chargehistory_npz_columns(columns, validator)
+    validator.assert_valid()
+
+    start_date_times = pd.DatetimeIndex(columns[NpzKey.START_DATE_TIMES].view('datetime64[ns]'))
+    commit_end_date_times = pd.DatetimeIndex(columns[NpzKey.COMMIT_END_DATE_TIMES].view('datetime64[ns]'))
+    energy_details_offsets = columns[NpzKey.ENERGY_DETAILS_OFFSETS]
+
+    is_charge_session_included = ~np.asarray(
+        (commit_end_date_times.tz_localize(pytz.utc) <= pd.Timestamp(usage_interval.start_date_time))
+        | (pd.Timestamp(usage_interval.end_date_time) <= start_date_times.tz_localize(pytz.utc) - TIMESTAMP_RECORD_DELAY))
+    included_indices = np.flatnonzero(is_charge_session_included)
+    charge_session_energies, charge_session_energy_decimals = select_npz_energies(
+        columns, NPZ_ENERGY_KEYS, included_indices)
+
+    charge_sessions = []
+    for i, energy, energy_decimals in zip(included_indices, charge_session_energies, charge_session_energy_decimals):
+        charge_session = ChargeSession({
+            # The key of the original charge session, e.g. for the energy rate decisions.
+            'Id': str(columns[NpzKey.SESSION_KEYS][i]),
+            ChargeSession.Key.DEVICE_ID.value: str(columns[NpzKey.DEVICE_IDS][i]),
+            ChargeSession.Key.DEVICE_NAME.value: str(columns[NpzKey.DEVICE_NAMES][i]),
+            ChargeSession.Key.ENERGY.value:
+                energy if are_exact_decimal_energies(charge_session_energies) else FixedPointEnergy(energy, energy_decimals),
+            ChargeSession.Key.START_DATE_TIME.value: start_date_times[i].isoformat(),
+            ChargeSession.Key.COMMIT_END_DATE_TIME.value: commit_end_date_times[i].isoformat(),
+        })
+        charge_sessions.append(charge_session)
+
+    # A charge session without energy details has one row, with its own energy.
+    num_energy_details = energy_details_offsets[included_indices + 1] - energy_details_offsets[included_indices]
+    num_rows = np.maximum(num_energy_details, 1)
+    row_charge_session_indices = np.repeat(np.arange(len(included_indices), dtype=np.int32), num_rows)
+    row_offsets = np.repeat(np.cumsum(num_rows) - num_rows, num_rows)
+    row_energy_detail_indices = np.repeat(energy_details_offsets[included_indices], num_rows)\
+        + np.arange(len(row_charge_session_indices)) - row_offsets
+    has_energy_detail = np.repeat(num_energy_details > 0, num_rows)
+
+    timestamps = np.full(len(row_charge_session_indices), pd.NaT.value, dtype=np.int64)
+    timestamps[has_energy_detail] = columns[NpzKey.ENERGY_DETAIL_TIMESTAMPS][row_energy_detail_indices[has_energy_detail]]
+    session_energies, session_energy_decimals = select_npz_energies(
+        columns, NPZ_ENERGY_KEYS, included_indices[row_charge_session_indices[~has_energy_detail]])
+    energy_detail_energies, energy_detail_energy_decimals = select_npz_energies(
+        columns, NPZ_ENERGY_DETAIL_ENERGY_KEYS, row_energy_detail_indices[has_energy_detail])
+    # Both are put in the order of the rows, as exact Decimals if either of them are.
+    row_indices = np.concatenate([np.flatnonzero(~has_energy_detail), np.flatnonzero(has_energy_detail)])
+    energies = np.empty(len(row_indices), dtype=object if are_exact_decimal_energies(session_energies)
+        or are_exact_decimal_energies(energy_detail_energies) else np.int64)
+    energies[row_indices] = concatenate_energies(
+        [session_energies, energy_detail_energies], [session_energy_decimals, energy_detail_energy_decimals])
+    energy_decimals = np.empty(len(row_indices), dtype=np.int8)
+    energy_decimals[row_indices] = np.concatenate([session_energy_decimals, energy_detail_energy_decimals])
+    return make_energy_detail_batch(
+        charge_sessions, [row_charge_session_indices], [timestamps], [energies], [energy_decimals])
+
+
+def collect_energy_detail_batch_from_npz(
+        npz_file_path: str,
+        usage_interval: UsageInterval,
+        validator: ChargehistoryValidator) -> EnergyDetailBatch:
+    with METRICS.stage('npz_load'):
+        columns = read_chargehistory_npz(npz_file_path)
+    return collect_energy_detail_batch_from_columns(columns, usage_interval, validator)
+
+
+@total_ordering
+class TableColumns(str, Enum):
+    DEVICE_ID = 'DeviceId'
+    DEVICE_NAME = 'DeviceName'
+    TIMESTAMP = 'Timestamp'
+    ENERGY = 'Energy'
+    ENERGY_RATE = 'EnergyRate'
+    START_DATE_TIME = 'StartDateTime'
+    COMMIT_END_DATE_TIME = 'CommitEndDateTime'
+    CHARGE_SESSION_ENERGY = 'ChargeSessionEnergy'
+    COMMENT = 'Comment'
+    DAY = 'Day'
+    PERIOD = 'Period'
+
+    def __lt__(self, other):
+        if self.__class__ is other.__class__:
+            return self.value < other.value
+        return NotImplemented
+
+    def get_text(self, locale: str):
+        return TABLE_COLUMNS_LOCALES[locale][self]
+
+
+TABLE_COLUMNS_LOCALES = {
+    'de-CH': {
+        TableColumns.DEVICE_ID: 'Ladestation Seriennummer',
+        TableColumns.DEVICE_NAME: 'Ladestation Name',
+        TableColumns.TIMESTAMP: 'Zeitpunkt (Europe/Zürich)',
+        TableColumns.ENERGY: 'Energie (kWh)',
+        TableColumns.ENERGY_RATE: 'Energietarif',
+        TableColumns.START_DATE_TIME: 'Gestartet (Europe/Zürich)',
+        TableColumns.COMMIT_END_DATE_TIME: 'Beendet (Europe/Zürich)',
+        TableColumns.CHARGE_SESSION_ENERGY: 'Ladevorgang Energie (kWh)',
+        TableColumns.COMMENT: "Hinweis",
+        TableColumns.DAY: 'Tag (Europe/Zürich)',
+        TableColumns.PERIOD: 'Periode',
+    },
+}
+
 
+# The number of decimals of the fixed-point energies of the energy details table, so that they are exported,
+# and summed, like the Decimals of the chargehistory; these columns aren't exported.
+ENERGY_DECIMALS_COLUMN = 'EnergyDecimals'
+CHARGE_SESSION_ENERGY_DECIMALS_COLUMN = 'ChargeSessionEnergyDecimals'
+# The index of the usage interval of each row, when reporting several of them at once.
+PERIOD_INDEX_COLUMN = 'PeriodIndex'
+
+ENERGY_DETAILS_SORT_COLUMNS = (TableColumns.START_DATE_TIME, TableColumns.COMMIT_END_DATE_TIME, TableColumns.TIMESTAMP)
+DAILY_ENERGIES_SORT_COLUMNS = (TableColumns.DAY, TableColumns.ENERGY_RATE)
+
+
+@total_ordering
+class SummaryTableLabels(str, Enum):
+    TOTAL_ENERGY = 'TotalEnergy'
+    LOW_ENERGY = 'LowEnergy'
+    HIGH_ENERGY = 'HighEnergy'
+
+    def __lt__(self, other):
+        if self.__class__ is other.__class__:
+            return self.value < other.value
+        return NotImplemented
+
+    def get_text(self, locale: str):
+        return SUMMARY_TABLE_LABELS_LOCALES[locale][self]
+
+
+SUMMARY_TABLE_LABELS_LOCALES = {
+    'de-CH': {
+        SummaryTableLabels.TOTAL_ENERGY: 'Gesamtenergie (kWh)',
+        SummaryTableLabels.LOW_ENERGY: 'Niedertarif Energie (kWh)',
+        SummaryTableLabels.HIGH_ENERGY: 'Hochtarif Energie (kWh)',
+    },
+}
+
+# The summary label of the energy of the other energy rates of a tariff, from the energy rate's label.
+ENERGY_RATE_ENERGY_LABEL_LOCALES = {
+    'de-CH': '%s Energie (kWh)',
+}
+
+
+def make_weekday_to_optional_high_rate_interval(
+        weekday_high_rate_interval: HighRateInterval = None,
+        saturday_high_rate_interval: HighRateInterval = None) -> [HighRateInterval | None]:
     # The high-rate interval for a date or datetime .weekday().
-    WEEKDAY_TO_OPTIONAL_HIGH_RATE_INTERVAL = [
+    return [
         weekday_high_rate_interval,   # Monday
         weekday_high_rate_interval,   # Tuesday
         weekday_high_rate_interval,   # Wednesday
@@ -34,156 +362,764 @@ def process_usage(
         None,                         # Sunday
     ]
 
-    with open(chargehistory_file_path) as chargehistory_file:
-        chargehistory_json = json.load(chargehistory_file, parse_float=Decimal)
-
-    @total_ordering
-    class TableColumns(str, Enum):
-        DEVICE_ID = 'DeviceId'
-        DEVICE_NAME = 'DeviceName'
-        TIMESTAMP = 'Timestamp'
-        ENERGY = 'Energy'
-        ENERGY_RATE = 'EnergyRate'
-        START_DATE_TIME = 'StartDateTime'
-        COMMIT_END_DATE_TIME = 'CommitEndDateTime'
-        CHARGE_SESSION_ENERGY = 'ChargeSessionEnergy'
-        COMMENT = 'Comment'
-
-        def __lt__(self, other):
-            if self.__class__ is other.__class__:
-                return self.value < other.value
-            return NotImplemented
-
-        def get_text(self, locale: str):
-            return TABLE_COLUMNS_LOCALES[locale][self]
-
-    TABLE_COLUMNS_LOCALES = {
-        'de-CH': {
-            TableColumns.DEVICE_ID: 'Ladestation Seriennummer',
-            TableColumns.DEVICE_NAME: 'Ladestation Name',
-            TableColumns.TIMESTAMP: 'Zeitpunkt (Europe/Zürich)',
-            TableColumns.ENERGY: 'Energie (kWh)',
-            TableColumns.ENERGY_RATE: 'Energietarif',
-            TableColumns.START_DATE_TIME: 'Gestartet (Europe/Zürich)',
-            TableColumns.COMMIT_END_DATE_TIME: 'Beendet (Europe/Zürich)',
-            TableColumns.CHARGE_SESSION_ENERGY: 'Ladevorgang Energie (kWh)',
-            TableColumns.COMMENT: "Hinweis",
-        },
-    }
-
-    energy_details_rows = []
-    for charge_session_json in chargehistory_json['Data']:
-        charge_session = ChargeSession(charge_session_json)
 
-        if charge_session.end_date_time <= usage_interval.start_date_time\
-                or usage_interval.end_date_time <= charge_session.start_date_time - TIMESTAMP_RECORD_DELAY:
-            # This charge session is outside the usage interval.
-            continue
+def collect_energy_detail_batch(
+        chargehistory_file_path: str,
+        usage_interval: UsageInterval,
+        validator: ChargehistoryValidator,
+        use_chargehistory_index: bool = False) -> EnergyDetailBatch:
+    # The .npz format is columnar, so it's selected without an index.
+    if is_chargehistory_npz(chargehistory_file_path):
+        return collect_energy_detail_batch_from_npz(chargehistory_file_path, usage_interval, validator)
+    if use_chargehistory_index:
+        return collect_energy_detail_batch_from_index(chargehistory_file_path, usage_interval, validator)
+    return collect_energy_detail_batch_from_json(chargehistory_file_path, usage_interval, validator)
 
-        charge_session.compute_energy_details_or_rate(usage_interval)
 
-        if charge_session.optional_energy_details is None:
-            assert charge_session.optional_energy_rate is not None,\
-                'The charging session is missing both energy details and an explicit energy rate: %s'\
-                    % charge_session_json
-            energy_details_rows.append([
-                charge_session.device_id,
-                charge_session.device_name,
-                None,
-                charge_session.energy,
-                charge_session.optional_energy_rate,
-                charge_session.start_date_time,
-                charge_session.end_date_time,
-                charge_session.energy,
-                charge_session.comment])
-            continue
+def compute_energy_details_df(
+        energy_detail_batch: EnergyDetailBatch,
+        usage_interval: UsageInterval,
+        tariff: Tariff) -> pd.DataFrame:
+    timestamps = energy_detail_batch.timestamps
+    has_energy_detail = ~timestamps.isna()
+    is_row_included = np.ones(len(timestamps), dtype=bool)
+    is_row_included[has_energy_detail] = are_in_usage_interval(timestamps[has_energy_detail], usage_interval)
+    return compute_included_energy_details_df(energy_detail_batch, is_row_included, tariff)
+
+
+def compute_period_indices(energy_detail_batch: EnergyDetailBatch, usage_intervals: list[UsageInterval]) -> np.ndarray:
+    # The index of the usage interval of each row, or -1. An energy detail is in a usage interval like
+    # is_in_usage_interval(), and a charge session without energy details in the one it overlaps, like
+    # is_charge_session_outside_usage_interval(), which it needs to fall entirely inside.
+    timestamps = energy_detail_batch.timestamps
+    has_energy_detail = ~timestamps.isna()
+    period_indices = np.full(len(timestamps), -1, dtype=np.int64)
+    period_indices[has_energy_detail] = compute_usage_interval_indices(timestamps[has_energy_detail], usage_intervals)
 
-        for energy_detail in charge_session.optional_energy_details:
-            if not energy_detail.is_in_usage_interval(usage_interval):
+    charge_session_period_indices = np.full(len(energy_detail_batch.charge_sessions), -1, dtype=np.int64)
+    for i in np.unique(energy_detail_batch.charge_session_indices[~has_energy_detail]):
+        charge_session = energy_detail_batch.charge_sessions[i]
+        for period_index, usage_interval in enumerate(usage_intervals):
+            if is_charge_session_outside_usage_interval(charge_session, usage_interval):
                 continue
-            energy_details_rows.append([
-                charge_session.device_id,
-                charge_session.device_name,
-                energy_detail.timestamp,
-                energy_detail.energy,
-                energy_detail.compute_energy_rate(WEEKDAY_TO_OPTIONAL_HIGH_RATE_INTERVAL),
-                charge_session.start_date_time,
-                charge_session.end_date_time,
-                charge_session.energy,
-                charge_session.comment])
-
-    @total_ordering
-    class SummaryTableLabels(str, Enum):
-        TOTAL_ENERGY = 'TotalEnergy'
-        LOW_ENERGY = 'LowEnergy'
-        HIGH_ENERGY = 'HighEnergy'
-
-        def __lt__(self, other):
-            if self.__class__ is other.__class__:
-                return self.value < other.value
-            return NotImplemented
-
-        def get_text(self, locale: str):
-            return SUMMARY_TABLE_LABELS_LOCALES[locale][self]
-
-    SUMMARY_TABLE_LABELS_LOCALES = {
-        'de-CH': {
-            SummaryTableLabels.TOTAL_ENERGY: 'Gesamtenergie (kWh)',
-            SummaryTableLabels.LOW_ENERGY: 'Niedertarif Energie (kWh)',
-            SummaryTableLabels.HIGH_ENERGY: 'Hochtarif Energie (kWh)',
-        },
-    }
-
-    energy_details_df = pd.DataFrame(
-        energy_details_rows, columns=[k for k in TableColumns])
-    summary_df = pd.pivot_table(
-        energy_details_df[[
-            TableColumns.DEVICE_ID,
-            TableColumns.DEVICE_NAME,
-            TableColumns.ENERGY,
-            TableColumns.ENERGY_RATE]],
-        values=TableColumns.ENERGY,
-        index=[TableColumns.DEVICE_ID, TableColumns.DEVICE_NAME],
-        columns=[TableColumns.ENERGY_RATE],
-        fill_value=0,
-        aggfunc='sum',
-        margins=True,
-        margins_name=SummaryTableLabels.TOTAL_ENERGY)
+            assert usage_interval.start_date_time <= charge_session.start_date_time\
+                and charge_session.end_date_time <= usage_interval.end_date_time,\
+                'Charge sessions without energy details that don\'t fall entirely inside '\
+                'a usage interval are not supported: %s' % (charge_session.raw_charge_session,)
+            charge_session_period_indices[i] = period_index
+            break
+    period_indices[~has_energy_detail] = charge_session_period_indices[
+        energy_detail_batch.charge_session_indices[~has_energy_detail]]
+    return period_indices
+
+
+def compute_period_energy_details_df(
+        energy_detail_batch: EnergyDetailBatch,
+        usage_intervals: list[UsageInterval],
+        tariff: Tariff) -> pd.DataFrame:
+    # The energy details of all the usage intervals, classified at once, with the index of their usage interval.
+    period_indices = compute_period_indices(energy_detail_batch, usage_intervals)
+    is_row_included = period_indices >= 0
+    energy_details_df = compute_included_energy_details_df(energy_detail_batch, is_row_included, tariff)
+    energy_details_df[PERIOD_INDEX_COLUMN] = period_indices[is_row_included]
+    return energy_details_df
+
+
+def compute_included_energy_details_df(
+        energy_detail_batch: EnergyDetailBatch,
+        is_row_included: np.ndarray,
+        tariff: Tariff) -> pd.DataFrame:
+    # Filter and classify all the energy details at once.
+    timestamps = energy_detail_batch.timestamps
+    has_energy_detail = ~timestamps.isna()
+
+    charge_sessions = energy_detail_batch.charge_sessions
+    charge_session_indices = energy_detail_batch.charge_session_indices
+    charge_session_start_date_times = pd.to_datetime([cs.start_date_time for cs in charge_sessions], utc=True)
+    charge_session_end_date_times = pd.to_datetime([cs.end_date_time for cs in charge_sessions], utc=True)
+
+    charge_session_energies, charge_session_energy_decimals = make_energy_array([cs.energy for cs in charge_sessions])
+
+    # All the datetimes of the report are converted with one offset table for its time span.
+    report_date_times = timestamps[has_energy_detail]\
+        .append(charge_session_start_date_times)\
+        .append(charge_session_end_date_times)
+    local_time_converter = LocalTimeConverter(report_date_times.min(), report_date_times.max())\
+        if len(report_date_times) > 0 else ZRH_LOCAL_TIME_CONVERTER
+
+    energy_rates = np.array([cs.optional_energy_rate for cs in charge_sessions], dtype=object)[charge_session_indices]
+    energy_rates[has_energy_detail] = compute_energy_rates(
+        timestamps[has_energy_detail], tariff, local_time_converter)
+
+    # The datetimes are local wall-clock times without time zone info, because Excel doesn't support them.
+    row_charge_session_indices = charge_session_indices[is_row_included]
+    return pd.DataFrame({
+        TableColumns.DEVICE_ID: np.array([cs.device_id for cs in charge_sessions], dtype=object)[row_charge_session_indices],
+        TableColumns.DEVICE_NAME: np.array([cs.device_name for cs in charge_sessions], dtype=object)[row_charge_session_indices],
+        TableColumns.TIMESTAMP: local_time_converter.to_wall_clock(timestamps[is_row_included]),
+        TableColumns.ENERGY: energy_detail_batch.energies[is_row_included],
+        ENERGY_DECIMALS_COLUMN: energy_detail_batch.energy_decimals[is_row_included],
+        TableColumns.ENERGY_RATE: energy_rates[is_row_included],
+        TableColumns.START_DATE_TIME: local_time_converter.to_wall_clock(charge_session_start_date_times)[row_charge_session_indices],
+        TableColumns.COMMIT_END_DATE_TIME: local_time_converter.to_wall_clock(charge_session_end_date_times)[row_charge_session_indices],
+        TableColumns.CHARGE_SESSION_ENERGY: charge_session_energies[row_charge_session_indices],
+        CHARGE_SESSION_ENERGY_DECIMALS_COLUMN: charge_session_energy_decimals[row_charge_session_indices],
+        TableColumns.COMMENT: np.array([cs.comment for cs in charge_sessions], dtype=object)[row_charge_session_indices],
+    })
+
+
+def rename_summary_columns(summary_df: pd.DataFrame) -> pd.DataFrame:
     summary_df.columns = [SummaryTableLabels.LOW_ENERGY if c == EnergyRate.LOW else c for c in summary_df.columns]
     summary_df.columns = [SummaryTableLabels.HIGH_ENERGY if c == EnergyRate.HIGH else c for c in summary_df.columns]
+    return summary_df
+
+
+def compute_summary_df(energy_details_df: pd.DataFrame) -> pd.DataFrame:
+    def pivot(values: str, aggfunc: str, fill_value: int) -> pd.DataFrame:
+        return pd.pivot_table(
+            energy_details_df[[
+                TableColumns.DEVICE_ID,
+                TableColumns.DEVICE_NAME,
+                values,
+                TableColumns.ENERGY_RATE]],
+            values=values,
+            index=[TableColumns.DEVICE_ID, TableColumns.DEVICE_NAME],
+            columns=[TableColumns.ENERGY_RATE],
+            fill_value=fill_value,
+            aggfunc=aggfunc,
+            margins=True,
+            margins_name=SummaryTableLabels.TOTAL_ENERGY)
+
+    # Energies with more decimals than the fixed-point units are summed as Decimals.
+    if are_exact_decimal_energies(energy_details_df[TableColumns.ENERGY].to_numpy()):
+        return rename_summary_columns(pivot(TableColumns.ENERGY, 'sum', 0))
+
+    # The energies are summed as int64 fixed-point energies, which is exact. Like a sum of Decimals, each sum
+    # then has as many decimals as the most precise of its energies, and the missing ones are 0.
+    fixed_point_summary_df = pivot(TableColumns.ENERGY, 'sum', 0)
+    decimals_summary_df = pivot(ENERGY_DECIMALS_COLUMN, 'max', -1)
+    summary_df = pd.DataFrame(
+        np.where(
+            decimals_summary_df.to_numpy() >= 0,
+            fixed_point_to_decimals(fixed_point_summary_df.to_numpy().ravel(), np.maximum(decimals_summary_df.to_numpy(), 0).ravel())
+                .reshape(fixed_point_summary_df.shape),
+            0),
+        index=fixed_point_summary_df.index,
+        columns=fixed_point_summary_df.columns)
+    return rename_summary_columns(summary_df)
+
+
+def compute_daily_energies_df(energy_details_df: pd.DataFrame) -> pd.DataFrame:
+    # The energy per device, local day and energy rate. An energy detail belongs to a day like it belongs to a
+    # usage interval, and a charge session without energy details to the day it started.
+    days = (energy_details_df[TableColumns.TIMESTAMP] - TIMESTAMP_RECORD_DELAY - pd.Timedelta(1, 'ns')).dt.normalize()
+    days = days.fillna(energy_details_df[TableColumns.START_DATE_TIME].dt.normalize())
+    daily_energies_df = energy_details_df[[
+        TableColumns.DEVICE_ID,
+        TableColumns.DEVICE_NAME,
+        TableColumns.ENERGY_RATE,
+        TableColumns.ENERGY,
+        ENERGY_DECIMALS_COLUMN]].copy()
+    daily_energies_df[TableColumns.DAY] = days.dt.date
+    return daily_energies_df\
+        .groupby([TableColumns.DEVICE_ID, TableColumns.DEVICE_NAME, TableColumns.DAY, TableColumns.ENERGY_RATE], sort=True)\
+        .agg({TableColumns.ENERGY: 'sum', ENERGY_DECIMALS_COLUMN: 'max'})\
+        .reset_index()
+
+
+def drop_energy_detail_batch_days(energy_detail_batch: EnergyDetailBatch, days: set[date]) -> EnergyDetailBatch:
+    # The rows of the local days, which belong to them like in compute_daily_energies_df(), are dropped, and so
+    # are the charge sessions without any other rows.
+    if len(days) == 0:
+        return energy_detail_batch
+    timestamps = energy_detail_batch.timestamps
+    has_energy_detail = ~timestamps.isna()
+    local_time_converter = LocalTimeConverter(timestamps[has_energy_detail].min(), timestamps[has_energy_detail].max())\
+        if has_energy_detail.any() else ZRH_LOCAL_TIME_CONVERTER
+
+    row_days = np.empty(len(timestamps), dtype='datetime64[D]')
+    wall_clock_timestamps = local_time_converter.to_wall_clock(timestamps[has_energy_detail])
+    row_days[has_energy_detail] = (wall_clock_timestamps - TIMESTAMP_RECORD_DELAY - pd.Timedelta(1, 'ns'))\
+        .normalize().to_numpy().astype('datetime64[D]')
+    charge_session_days = np.array(
+        [cs.start_date_time.date() for cs in energy_detail_batch.charge_sessions], dtype='datetime64[D]')
+    row_days[~has_energy_detail] = charge_session_days[energy_detail_batch.charge_session_indices[~has_energy_detail]]
+    is_row_kept = ~np.isin(row_days, np.array(sorted(days), dtype='datetime64[D]'))
+
+    kept_charge_session_indices, charge_session_indices = np.unique(
+        energy_detail_batch.charge_session_indices[is_row_kept], return_inverse=True)
+    return EnergyDetailBatch(
+        charge_sessions=[energy_detail_batch.charge_sessions[i] for i in kept_charge_session_indices],
+        charge_session_indices=charge_session_indices.astype(np.int32),
+        timestamps=timestamps[is_row_kept],
+        energies=energy_detail_batch.energies[is_row_kept],
+        energy_decimals=energy_detail_batch.energy_decimals[is_row_kept])
+
+
+def make_daily_energies(daily_energies_df: pd.DataFrame) -> list[DailyEnergy]:
+    # The daily energies that are exact Decimals are stored as fixed-point energies, see
+    # get_unstorable_days().
+    if are_exact_decimal_energies(daily_energies_df[TableColumns.ENERGY].to_numpy()):
+        return [
+            DailyEnergy(device_id, device_name, day, energy_rate, energy_to_fixed_point(energy), get_energy_decimals(energy))
+            for device_id, device_name, day, energy_rate, energy in zip(
+                daily_energies_df[TableColumns.DEVICE_ID],
+                daily_energies_df[TableColumns.DEVICE_NAME],
+                daily_energies_df[TableColumns.DAY],
+                daily_energies_df[TableColumns.ENERGY_RATE],
+                daily_energies_df[TableColumns.ENERGY])]
+    return [
+        DailyEnergy(device_id, device_name, day, energy_rate, energy, energy_decimals)
+        for device_id, device_name, day, energy_rate, energy, energy_decimals in zip(
+            daily_energies_df[TableColumns.DEVICE_ID],
+            daily_energies_df[TableColumns.DEVICE_NAME],
+            daily_energies_df[TableColumns.DAY],
+            daily_energies_df[TableColumns.ENERGY_RATE],
+            daily_energies_df[TableColumns.ENERGY],
+            daily_energies_df[ENERGY_DECIMALS_COLUMN])]
+
+
+def make_daily_energies_df(daily_energies: list[DailyEnergy]) -> pd.DataFrame:
+    return pd.DataFrame({
+        TableColumns.DEVICE_ID: np.array([de.device_id for de in daily_energies], dtype=object),
+        TableColumns.DEVICE_NAME: np.array([de.device_name for de in daily_energies], dtype=object),
+        TableColumns.DAY: np.array([de.day for de in daily_energies], dtype=object),
+        TableColumns.ENERGY_RATE: np.array([de.energy_rate for de in daily_energies], dtype=object),
+        TableColumns.ENERGY: np.array([de.energy for de in daily_energies], dtype=np.int64),
+        ENERGY_DECIMALS_COLUMN: np.array([de.energy_decimals for de in daily_energies], dtype=np.int8),
+    })
+
+
+def get_unstorable_days(daily_energies_df: pd.DataFrame) -> set:
+    # The days with a daily energy that has more decimals than the fixed-point units, which the store doesn't hold.
+    if not are_exact_decimal_energies(daily_energies_df[TableColumns.ENERGY].to_numpy()):
+        return set()
+    return set(
+        day for day, energy in zip(daily_energies_df[TableColumns.DAY], daily_energies_df[TableColumns.ENERGY])
+        if energy_to_optional_fixed_point(energy) is None)
+
+
+def read_stored_days(
+        daily_energy_store_file_path: str,
+        installation_id: str,
+        tariff: Tariff,
+        usage_intervals: list[UsageInterval]) -> set[date]:
+    # The whole days of the usage intervals that are already stored, whose energy details therefore needn't be
+    # resolved nor classified.
+    whole_days = set(d for usage_interval in usage_intervals for d in get_whole_days(usage_interval))
+    with DailyEnergyStore(daily_energy_store_file_path, installation_id, make_tariff_key(tariff)) as store:
+        if store.num_invalidated_days > 0:
+            print('Invalidated %d stored day(s), which were computed with other tariff settings.' % (
+                store.num_invalidated_days,))
+        return store.get_stored_days() & whole_days
+
+
+def compute_daily_energies_df_with_store(
+        energy_details_df: pd.DataFrame,
+        usage_interval: UsageInterval,
+        daily_energy_store_file_path: str,
+        installation_id: str,
+        tariff: Tariff,
+        stored_days: Iterable[date]) -> pd.DataFrame:
+    # The whole days of the usage interval that are already stored, see read_stored_days(), are read from the
+    # store, and only the others, e.g. new days, or the partial days at the boundaries, come from their energy
+    # details. The whole days that are over are then stored for later runs.
+    whole_days = set(get_whole_days(usage_interval))
+    stored_days = set(stored_days) & whole_days
+    today = datetime.now(ZRH).date()
+    with METRICS.stage('daily_aggregation'):
+        daily_energies_df = compute_daily_energies_df(energy_details_df)
+    with DailyEnergyStore(daily_energy_store_file_path, installation_id, make_tariff_key(tariff)) as store:
+        new_days = set(d for d in whole_days - stored_days if d < today) - get_unstorable_days(daily_energies_df)
+        store.write_daily_energies(
+            new_days, make_daily_energies(daily_energies_df[daily_energies_df[TableColumns.DAY].isin(new_days)]))
+        stored_daily_energies_df = make_daily_energies_df(store.read_daily_energies(stored_days))
+    if are_exact_decimal_energies(daily_energies_df[TableColumns.ENERGY].to_numpy()):
+        stored_daily_energies_df[TableColumns.ENERGY] = energies_to_decimals(
+            stored_daily_energies_df[TableColumns.ENERGY].to_numpy(),
+            stored_daily_energies_df[ENERGY_DECIMALS_COLUMN].to_numpy())
+
+    print('%d day(s) read from the daily energy store, %d newly stored.' % (len(stored_days), len(new_days)))
+    METRICS.increment('stored_days_read', len(stored_days))
+    METRICS.increment('stored_days_written', len(new_days))
+    return pd.concat([stored_daily_energies_df, daily_energies_df], ignore_index=True)
+
+
+SUMMARY_SHEET_NAME = 'Überblick'
+# The name of the summary table without a locale.
+SUMMARY_TABLE_NAME = 'Summary'
+
+
+def get_summary_sheet_name(optional_locale: str | None) -> str:
+    return SUMMARY_SHEET_NAME if optional_locale is not None else SUMMARY_TABLE_NAME
+
+
+def get_label_text(label: TableColumns | SummaryTableLabels, optional_locale: str | None) -> str:
+    # Without a locale, the tables have the keys of their columns and labels, e.g. for other programs.
+    return label.get_text(optional_locale) if optional_locale is not None else label.value
+
+
+def get_energy_rate_text(tariff: Tariff, energy_rate: str, optional_locale: str | None) -> str:
+    return tariff.get_energy_rate_text(energy_rate, optional_locale) if optional_locale is not None\
+        else get_energy_rate_name(energy_rate)
+
+
+def get_energy_rate_energy_label(tariff: Tariff, energy_rate: str, optional_locale: str | None) -> str:
+    # E.g. 'Spitzentarif Energie (kWh)', or 'PeakEnergy' without a locale, like the summary labels.
+    if optional_locale is None:
+        return '%sEnergy' % (get_energy_rate_name(energy_rate),)
+    return ENERGY_RATE_ENERGY_LABEL_LOCALES[optional_locale] % (tariff.get_energy_rate_text(energy_rate, optional_locale),)
+
+
+def write_summary_sheet(
+        writer,
+        sheet_name: str,
+        summary_df: pd.DataFrame,
+        tariff: Tariff,
+        optional_locale: str | None = LOCALE) -> None:
+    # Only formatting changes from here on, on a copy of the table.
+    summary_df = summary_df.copy()
+    summary_df.columns = [
+        get_label_text(c, optional_locale) if isinstance(c, SummaryTableLabels)
+        else get_energy_rate_energy_label(tariff, c, optional_locale)
+        for c in summary_df.columns]
+    summary_df.index.names = [get_label_text(c, optional_locale) for c in summary_df.index.names]
+    summary_df.index = summary_df.index.set_levels(
+        [get_label_text(x, optional_locale) if isinstance(x, Enum) else x
+            for x in summary_df.index.levels[0]],
+            level=0,
+            verify_integrity=True)
+    with METRICS.stage('sheet', SheetName=sheet_name, Rows=len(summary_df)):
+        writer.write_sheet(sheet_name, summary_df.reset_index(), num_index_columns=summary_df.index.nlevels)
+
+
+def write_device_sheets(
+        writer,
+        energy_details_df: pd.DataFrame,
+        tariff: Tariff,
+        device_sheet_sort_columns: Iterable[TableColumns] = ENERGY_DETAILS_SORT_COLUMNS,
+        optional_locale: str | None = LOCALE) -> None:
+    # The device sheets either list the energy details or, with a daily energy store, the daily energies.
+    # Only formatting changes from here on, on a copy of the table.
+    energy_details_df = energy_details_df.copy()
+
+    # The fixed-point energies are only exported as Decimals, i.e. as their exact text.
+    energy_details_df[TableColumns.ENERGY] = energies_to_decimals(
+        energy_details_df[TableColumns.ENERGY].to_numpy(), energy_details_df.pop(ENERGY_DECIMALS_COLUMN).to_numpy())
+    if TableColumns.CHARGE_SESSION_ENERGY in energy_details_df.columns:
+        energy_details_df[TableColumns.CHARGE_SESSION_ENERGY] = energies_to_decimals(
+            energy_details_df[TableColumns.CHARGE_SESSION_ENERGY].to_numpy(),
+            energy_details_df.pop(CHARGE_SESSION_ENERGY_DECIMALS_COLUMN).to_numpy())
+
+    energy_details_df[TableColumns.ENERGY_RATE] = energy_details_df[TableColumns.ENERGY_RATE].apply(
+        lambda er: get_energy_rate_text(tariff, er, optional_locale))
+    # A single pass over the devices, in the order of their IDs.
+    for device_id, device_energy_details_df in energy_details_df.groupby(TableColumns.DEVICE_ID, sort=True):
+        device_energy_details_df = device_energy_details_df.sort_values(by=list(device_sheet_sort_columns))
+        device_energy_details_df.columns = [get_label_text(c, optional_locale) for c in device_energy_details_df.columns]
+        with METRICS.stage('sheet', SheetName=device_id, Rows=len(device_energy_details_df)):
+            writer.write_sheet(device_id, device_energy_details_df)
+
+
+def write_usage_excel(
+        summary_df: pd.DataFrame,
+        energy_details_df: pd.DataFrame,
+        output_excel_file_name: str,
+        tariff: Tariff,
+        device_sheet_sort_columns: Iterable[TableColumns] = ENERGY_DETAILS_SORT_COLUMNS,
+        export_format: ExportFormat = ExportFormat.EXCEL,
+        optional_locale: str | None = LOCALE) -> None:
+    # With the CSV or Parquet export format, the output is a directory with a file per sheet.
+    with open_table_writer(export_format, output_excel_file_name) as writer:
+        write_summary_sheet(writer, get_summary_sheet_name(optional_locale), summary_df, tariff, optional_locale)
+        write_device_sheets(writer, energy_details_df, tariff, device_sheet_sort_columns, optional_locale)
+
+
+def get_export_stage_name(export_format: ExportFormat) -> str:
+    # E.g. 'excel_export'.
+    return '%s_export' % (export_format.value,)
+
+
+def make_tariff(
+        weekday_high_rate_interval: HighRateInterval = None,
+        saturday_high_rate_interval: HighRateInterval = None,
+        optional_tariff_file_path: str | None = None) -> Tariff:
+    # Either a tariff file, or the high-rate intervals, which are a tariff with the low and high energy rates.
+    if optional_tariff_file_path is not None:
+        assert weekday_high_rate_interval is None and saturday_high_rate_interval is None,\
+            'the high-rate intervals can\'t be combined with a tariff file, which has its own.'
+        return read_tariff(optional_tariff_file_path)
+    return make_high_rate_tariff(make_weekday_to_optional_high_rate_interval(
+        weekday_high_rate_interval, saturday_high_rate_interval))
+
+
+def compute_device_sheets_df(
+        energy_details_df: pd.DataFrame,
+        usage_interval: UsageInterval,
+        tariff: Tariff,
+        optional_daily_energy_store_file_path: str | None = None,
+        optional_installation_id: str | None = None,
+        stored_days: Iterable[date] = ()) -> tuple[pd.DataFrame, tuple[TableColumns, ...]]:
+    # The table of the device sheets, which the summary is computed from, and how to sort it.
+    if optional_daily_energy_store_file_path is None:
+        return energy_details_df, ENERGY_DETAILS_SORT_COLUMNS
+    with METRICS.stage('daily_energy_store'):
+        daily_energies_df = compute_daily_energies_df_with_store(
+            energy_details_df,
+            usage_interval,
+            optional_daily_energy_store_file_path,
+            optional_installation_id,
+            tariff,
+            stored_days)
+    return daily_energies_df, DAILY_ENERGIES_SORT_COLUMNS
+
+
+def count_energy_detail_batch(energy_detail_batch: EnergyDetailBatch) -> None:
+    METRICS.increment('charge_sessions', len(energy_detail_batch.charge_sessions))
+    METRICS.increment('energy_details', int((~energy_detail_batch.timestamps.isna()).sum()))
+    METRICS.increment('charge_sessions_without_energy_details', int(energy_detail_batch.timestamps.isna().sum()))
+
+
+def report_usage(
+        energy_detail_batch: EnergyDetailBatch,
+        usage_interval: UsageInterval,
+        output_excel_file_name: str,
+        tariff: Tariff,
+        energy_rate_resolver: EnergyRateResolver,
+        optional_daily_energy_store_file_path: str | None = None,
+        optional_installation_id: str | None = None,
+        optional_period_usage_intervals: list[UsageInterval] | None = None,
+        combined_workbook: bool = False,
+        export_format: ExportFormat = ExportFormat.EXCEL,
+        optional_locale: str | None = LOCALE) -> None:
+    # With optional_period_usage_intervals, e.g. the months of the usage interval, each of them is reported, see
+    # report_usage_periods().
+    if optional_period_usage_intervals is not None:
+        assert all(
+            usage_interval.start_date_time <= ui.start_date_time and ui.end_date_time <= usage_interval.end_date_time
+            for ui in optional_period_usage_intervals),\
+            'the periods need to be inside the usage interval %s - %s.' % (
+                usage_interval.start_date_time, usage_interval.end_date_time)
+    count_energy_detail_batch(energy_detail_batch)
+
+    # The days that are already stored are dropped first, so that only the other days are resolved and
+    # classified.
+    stored_days = set()
+    if optional_daily_energy_store_file_path is not None:
+        assert optional_installation_id is not None,\
+            'the daily energy store needs the installation ID, since several installations can share it.'
+        stored_days = read_stored_days(
+            optional_daily_energy_store_file_path,
+            optional_installation_id,
+            tariff,
+            optional_period_usage_intervals if optional_period_usage_intervals is not None else [usage_interval])
+        energy_detail_batch = drop_energy_detail_batch_days(energy_detail_batch, stored_days)
+    with METRICS.stage('energy_rate_resolution'):
+        resolve_energy_rates(energy_detail_batch, usage_interval, energy_rate_resolver)
+
+    if optional_period_usage_intervals is not None:
+        report_usage_periods(
+            energy_detail_batch,
+            optional_period_usage_intervals,
+            output_excel_file_name,
+            tariff,
+            energy_rate_resolver,
+            optional_daily_energy_store_file_path,
+            optional_installation_id,
+            stored_days,
+            combined_workbook,
+            export_format,
+            optional_locale)
+        return
+
+    with METRICS.stage('classification'):
+        energy_details_df = compute_energy_details_df(energy_detail_batch, usage_interval, tariff)
+    METRICS.increment('energy_detail_rows', len(energy_details_df))
+    device_sheets_df, device_sheet_sort_columns = compute_device_sheets_df(
+        energy_details_df,
+        usage_interval,
+        tariff,
+        optional_daily_energy_store_file_path,
+        optional_installation_id,
+        stored_days)
+    with METRICS.stage('pivot'):
+        summary_df = compute_summary_df(device_sheets_df)
 
     print(summary_df)
+    energy_rate_resolver.print_summary()
+
+    # Export the data to an .xlsx file, or to CSV or Parquet files.
+    with METRICS.stage(get_export_stage_name(export_format)):
+        write_usage_excel(
+            summary_df,
+            device_sheets_df,
+            output_excel_file_name,
+            tariff,
+            device_sheet_sort_columns,
+            export_format,
+            optional_locale)
+
+
+def get_usage_interval_label(usage_interval: UsageInterval) -> str:
+    # The local start of the usage interval, e.g. '2024-03-01', which is unique among sorted usage intervals that
+    # don't overlap, and short enough for a sheet name.
+    start_date_time = usage_interval.start_date_time.replace(tzinfo=None)
+    return start_date_time.strftime('%Y-%m-%d' if start_date_time.time() == time() else '%Y-%m-%dT%H%M%S')
+
+
+def get_period_excel_file_name(output_excel_file_name: str, period_label: str) -> str:
+    root, extension = os.path.splitext(output_excel_file_name)
+    return '%s %s%s' % (root, period_label, extension)
+
+
+def report_usage_periods(
+        energy_detail_batch: EnergyDetailBatch,
+        usage_intervals: list[UsageInterval],
+        output_excel_file_name: str,
+        tariff: Tariff,
+        energy_rate_resolver: EnergyRateResolver,
+        optional_daily_energy_store_file_path: str | None = None,
+        optional_installation_id: str | None = None,
+        stored_days: Iterable[date] = (),
+        combined_workbook: bool = False,
+        export_format: ExportFormat = ExportFormat.EXCEL,
+        optional_locale: str | None = LOCALE) -> None:
+    # Like report_usage() for each of the usage intervals, but with the energy details of all of them classified
+    # at once, once their energy rates are resolved, and the stored days dropped. Each usage interval gets its own
+    # workbook, named after its start, or its own summary sheet in a combined workbook, whose device sheets then
+    # list the energy details of all of them.
+    assert len(usage_intervals) > 0, 'there needs to be at least one usage interval.'
 
-    # Export the data to an .xlsx file; only formatting changes from here on.
-
-    # Drop timezone info because Excel doesn't support datetimes w/ timezone info.
-    energy_details_df[TableColumns.TIMESTAMP] = energy_details_df[TableColumns.TIMESTAMP].apply(
-        lambda d: d.replace(tzinfo=None))
-    energy_details_df[TableColumns.START_DATE_TIME] = energy_details_df[TableColumns.START_DATE_TIME].apply(
-        lambda d: d.replace(tzinfo=None))
-    energy_details_df[TableColumns.COMMIT_END_DATE_TIME] = energy_details_df[TableColumns.COMMIT_END_DATE_TIME].apply(
-        lambda d: d.replace(tzinfo=None))
-
-    with pd.ExcelWriter(output_excel_file_name) as writer:
-        summary_df.columns = [c.get_text(LOCALE) for c in summary_df.columns]
-        summary_df.index.names = [c.get_text(LOCALE) for c in summary_df.index.names]
-        summary_df.index = summary_df.index.set_levels(
-            [x.get_text(LOCALE) if isinstance(x, Enum) else x
-                for x in summary_df.index.levels[0]],
-                level=0,
-                verify_integrity=True)
-        summary_df.to_excel(writer, sheet_name='Überblick')
-        auto_adjust_xlsx_column_width(summary_df, writer, sheet_name="Überblick", margin=2)
-
-        energy_details_df[TableColumns.ENERGY_RATE] = energy_details_df[TableColumns.ENERGY_RATE].apply(
-            lambda er: er.get_text(LOCALE))
-        for device_id in sorted(energy_details_df[TableColumns.DEVICE_ID].unique()):
-            device_energy_details_df = energy_details_df[energy_details_df[TableColumns.DEVICE_ID] == device_id]
-            device_energy_details_df = device_energy_details_df.sort_values(
-                by=[TableColumns.START_DATE_TIME, TableColumns.COMMIT_END_DATE_TIME, TableColumns.TIMESTAMP])
-            device_energy_details_df.columns = [c.get_text(LOCALE) for c in device_energy_details_df.columns]
-            device_energy_details_df.to_excel(writer, sheet_name=device_id, index=False)
-            auto_adjust_xlsx_column_width(device_energy_details_df, writer, sheet_name=device_id, margin=2, index=False)
+    with METRICS.stage('classification'):
+        energy_details_df = compute_period_energy_details_df(energy_detail_batch, usage_intervals, tariff)
+    METRICS.increment('energy_detail_rows', len(energy_details_df))
+
+    period_summary_dfs = []
+    period_device_sheets_dfs = []
+    device_sheet_sort_columns = ENERGY_DETAILS_SORT_COLUMNS
+    for period_index, usage_interval in enumerate(usage_intervals):
+        period_label = get_usage_interval_label(usage_interval)
+        period_energy_details_df = energy_details_df[energy_details_df[PERIOD_INDEX_COLUMN] == period_index]\
+            .drop(columns=PERIOD_INDEX_COLUMN)
+        device_sheets_df, device_sheet_sort_columns = compute_device_sheets_df(
+            period_energy_details_df,
+            usage_interval,
+            tariff,
+            optional_daily_energy_store_file_path,
+            optional_installation_id,
+            stored_days)
+        with METRICS.stage('pivot', Period=period_label):
+            summary_df = compute_summary_df(device_sheets_df)
+
+        print('%s - %s:' % (usage_interval.start_date_time, usage_interval.end_date_time))
+        print(summary_df)
+
+        if combined_workbook:
+            period_summary_dfs.append((period_label, summary_df))
+            device_sheets_df = device_sheets_df.copy()
+            device_sheets_df.insert(0, TableColumns.PERIOD, period_label)
+            period_device_sheets_dfs.append(device_sheets_df)
+            continue
+        with METRICS.stage(get_export_stage_name(export_format), Period=period_label):
+            write_usage_excel(
+                summary_df,
+                device_sheets_df,
+                get_period_excel_file_name(output_excel_file_name, period_label),
+                tariff,
+                device_sheet_sort_columns,
+                export_format,
+                optional_locale)
+
+    energy_rate_resolver.print_summary()
+
+    if combined_workbook:
+        with METRICS.stage(get_export_stage_name(export_format)),\
+                open_table_writer(export_format, output_excel_file_name) as writer:
+            for period_label, summary_df in period_summary_dfs:
+                write_summary_sheet(
+                    writer,
+                    '%s %s' % (get_summary_sheet_name(optional_locale), period_label),
+                    summary_df,
+                    tariff,
+                    optional_locale)
+            write_device_sheets(
+                writer,
+                pd.concat(period_device_sheets_dfs, ignore_index=True),
+                tariff,
+                device_sheet_sort_columns,
+                optional_locale)
+
+
+class ReportPeriod(str, Enum):
+    MONTH = 'month'
+    QUARTER = 'quarter'
+    YEAR = 'year'
+
+
+REPORT_PERIOD_MONTHS = {
+    ReportPeriod.MONTH: 1,
+    ReportPeriod.QUARTER: 3,
+    ReportPeriod.YEAR: 12,
+}
+
+
+def split_usage_interval(
+        usage_interval_start: datetime,
+        usage_interval_end: datetime,
+        optional_report_period: ReportPeriod | None = None,
+        split_date_times: Iterable[datetime] = ()) -> list[UsageInterval]:
+    # The usage interval split at the starts of the calendar months, quarters or years, and at the given
+    # datetimes, all in the Europe/Zurich time zone, but without explicit time zone info. The first and last
+    # periods can be partial.
+    boundaries = set(d for d in split_date_times if usage_interval_start < d < usage_interval_end)
+    if optional_report_period is not None:
+        num_months = REPORT_PERIOD_MONTHS[optional_report_period]
+        # The first start of a period after the start of the usage interval.
+        month_index = usage_interval_start.year * 12 + usage_interval_start.month - 1
+        month_index += num_months - month_index % num_months
+        while True:
+            boundary = datetime(month_index // 12, month_index % 12 + 1, 1)
+            if boundary >= usage_interval_end:
+                break
+            boundaries.add(boundary)
+            month_index += num_months
+    date_times = [usage_interval_start] + sorted(boundaries) + [usage_interval_end]
+    return [UsageInterval(start, end) for start, end in zip(date_times, date_times[1:])]
+
+
+def process_usage(
+        chargehistory_file_path: str,
+        usage_interval: UsageInterval,
+        output_excel_file_name: str,
+        weekday_high_rate_interval: HighRateInterval = None,
+        saturday_high_rate_interval: HighRateInterval = None,
+        missing_energy_details_mode: MissingEnergyDetailsMode = MissingEnergyDetailsMode.PROMPT,
+        optional_energy_rate_decisions_file_path: str | None = None,
+        validation_level: ValidationLevel = ValidationLevel.STRICT,
+        optional_daily_energy_store_file_path: str | None = None,
+        optional_installation_id: str | None = None,
+        optional_tariff_file_path: str | None = None,
+        use_chargehistory_index: bool = False,
+        optional_period_usage_intervals: list[UsageInterval] | None = None,
+        combined_workbook: bool = False,
+        export_format: ExportFormat = ExportFormat.EXCEL,
+        optional_locale: str | None = LOCALE) -> None:
+    tariff = make_tariff(weekday_high_rate_interval, saturday_high_rate_interval, optional_tariff_file_path)
+    energy_rate_resolver = EnergyRateResolver(
+        missing_energy_details_mode,
+        tariff,
+        optional_energy_rate_decisions_file_path,
+        optional_locale)
+    with METRICS.stage('session_parsing'):
+        energy_detail_batch = collect_energy_detail_batch(
+            chargehistory_file_path,
+            usage_interval,
+            ChargehistoryValidator(validation_level),
+            use_chargehistory_index)
+
+    report_usage(
+        energy_detail_batch,
+        usage_interval,
+        output_excel_file_name,
+        tariff,
+        energy_rate_resolver,
+        optional_daily_energy_store_file_path,
+        optional_installation_id,
+        optional_period_usage_intervals,
+        combined_workbook,
+        export_format,
+        optional_locale)
+
+
+def make_period_usage_intervals_from_args(args: argparse.Namespace) -> list[UsageInterval] | None:
+    if args.report_period is None and args.split_at is None:
+        return None
+    return split_usage_interval(args.usage_interval_start, args.usage_interval_end, args.report_period, args.split_at or ())
+
+
+def get_locale_from_args(args: argparse.Namespace) -> str | None:
+    return LOCALE if not args.column_keys else None
+
+
+def add_processing_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        '--weekday_high_rate_interval',
+        nargs=2,
+        type=time.fromisoformat,
+        help='the high-rate weekdays interval, in the Europe/Zurich time zone, '
+        'but without explicit time zone info; if unspecified, the whole weekday '
+        'is considered low-rate',
+        metavar='DATETIME')
+    parser.add_argument(
+        '--saturday_high_rate_interval',
+        nargs=2,
+        type=time.fromisoformat,
+        help='the high-rate Saturday interval, in the Europe/Zurich time zone, '
+        'but without explicit time zone info; if unspecified, the entire Saturday '
+        'is considered low-rate',
+        metavar='DATETIME')
+    parser.add_argument(
+        '--tariff_file',
+        help='the path to a JSON tariff, see \'tariff.json.tmpl\', with any number of energy rates, weekday windows, '
+        'periods that start on given days, holidays and single-day overrides; it replaces the high-rate intervals')
+    parser.add_argument(
+        '--missing_energy_details',
+        type=MissingEnergyDetailsMode,
+        choices=[m.value for m in MissingEnergyDetailsMode],
+        default=MissingEnergyDetailsMode.PROMPT.value,
+        help='how to choose the energy rate of charge sessions without energy details: \'prompt\' asks for '
+        'each of them, \'rules\' uses the energy rate the charge session spent most time in, and reports '
+        'the ambiguous ones at the end (default: %(default)s)')
+    parser.add_argument(
+        '--energy_rate_decisions_file',
+        help='the path to a JSON file where the energy rates chosen for charge sessions without energy '
+        'details are remembered and reused on later runs; if unspecified, nothing is remembered')
+    parser.add_argument(
+        '--validation',
+        type=ValidationLevel,
+        choices=[v.value for v in ValidationLevel],
+        default=ValidationLevel.STRICT.value,
+        help='how much of the chargehistory to validate: \'strict\' checks every charge session and energy detail, '
+        '\'sampled\' every %dth charge session, and \'trusted\' nothing, e.g. for chargehistories written by '
+        '\'usage_fetcher.py\' or \'chargehistory_io.py\' (default: %%(default)s)' % (SAMPLED_VALIDATION_STRIDE,))
+    parser.add_argument(
+        '--daily_energy_store',
+        help='the path to a SQLite file where the energy per charging station, day and energy rate is stored, '
+        'so that later runs only process the days that aren\'t stored yet, e.g. new days; stored days are '
+        'invalidated when the tariff settings change, and the Excel file then lists the daily energies '
+        'instead of the energy details; several installations can share a store; if unspecified, nothing is stored')
+    parser.add_argument(
+        '--report_period',
+        type=ReportPeriod,
+        choices=[p.value for p in ReportPeriod],
+        help='report each calendar month, quarter or year of the usage interval, in one pass over the '
+        'chargehistory, each in its own Excel file, named after the output Excel file and the start of the period, '
+        'e.g. \'output 2024-03-01.xlsx\'; the first and last periods can be partial')
+    parser.add_argument(
+        '--split_at',
+        nargs='+',
+        type=datetime.fromisoformat,
+        help='report each part of the usage interval between these datetimes, in the Europe/Zurich time zone, '
+        'but without explicit time zone info, like --report_period, and combined with it',
+        metavar='DATETIME')
+    parser.add_argument(
+        '--combined_workbook',
+        action='store_true',
+        help='with --report_period or --split_at, write a single Excel file, with a summary sheet per period, and '
+        'device sheets with the period of each row')
+    parser.add_argument(
+        '--export_format',
+        type=ExportFormat,
+        choices=[f.value for f in ExportFormat],
+        default=ExportFormat.EXCEL.value,
+        help='the format of the output: \'excel\' writes a workbook with a sheet per table, \'csv\' and '
+        '\'parquet\' (which needs the pyarrow package) write a directory, at the output path, with a file per '
+        'table, which is faster for large reports (default: %(default)s)')
+    parser.add_argument(
+        '--column_keys',
+        action='store_true',
+        help='name the columns, tables and energy rates by their keys, e.g. \'DeviceId\' and \'Summary\', '
+        'instead of their localized texts, e.g. for other programs')
 
 
 if __name__ == '__main__':
@@ -192,7 +1128,9 @@ if __name__ == '__main__':
 
     parser.add_argument(
         'chargehistory_file_path',
-        help='the path to the Zaptec chargehistory API response, in JSON format')
+        help='the path to the Zaptec chargehistory API response, in JSON format, to its columnar '
+        'conversion, in the .npz format, or to its compressed NDJSON conversion, ending with \'.ndjson.gz\' or '
+        '\'.ndjson.zst\'')
     parser.add_argument(
         'usage_interval_start',
         type=datetime.fromisoformat,
@@ -205,25 +1143,24 @@ if __name__ == '__main__':
         'but without explicit time zone info; charging slots before this timestamp are ignored')
     parser.add_argument(
         'output_excel_file_name',
-        help='the path to the output Excel file')
+        help='the path to the output Excel file, or to the output directory with --export_format csv or parquet')
     parser.add_argument(
-        '--weekday_high_rate_interval',
-        nargs=2,
-        type=time.fromisoformat,
-        help='the high-rate weekdays interval, in the Europe/Zurich time zone, '
-        'but without explicit time zone info; if unspecified, the whole weekday '
-        'is considered low-rate',
-        metavar='DATETIME')
+        '--chargehistory_index',
+        action='store_true',
+        help='only read the charge sessions of the usage interval, found with a sidecar time-range index next '
+        'to the chargehistory, which is built, or rebuilt if the chargehistory changed, as needed; the .npz '
+        'format doesn\'t need one')
     parser.add_argument(
-        '--saturday_high_rate_interval',
-        nargs=2,
-        type=time.fromisoformat,
-        help='the high-rate Saturday interval, in the Europe/Zurich time zone, '
-        'but without explicit time zone info; if unspecified, the entire Saturday '
-        'is considered low-rate',
-        metavar='DATETIME')
+        '--installation_id',
+        help='the ID of the installation of the chargehistory, which its days are stored under with '
+        '--daily_energy_store, and which that therefore needs')
+    add_processing_arguments(parser)
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
+    if args.daily_energy_store is not None and args.installation_id is None:
+        parser.error('--daily_energy_store needs --installation_id.')
+    enable_metrics_from_args(args)
 
     process_usage(
         chargehistory_file_path=args.chargehistory_file_path,
@@ -236,4 +1173,17 @@ if __name__ == '__main__':
             HighRateInterval(args.saturday_high_rate_interval[0], args.saturday_high_rate_interval[1])
             if args.saturday_high_rate_interval is not None
             else None,
-        output_excel_file_name=args.output_excel_file_name)
+        output_excel_file_name=args.output_excel_file_name,
+        missing_energy_details_mode=args.missing_energy_details,
+        optional_energy_rate_decisions_file_path=args.energy_rate_decisions_file,
+        validation_level=args.validation,
+        optional_daily_energy_store_file_path=args.daily_energy_store,
+        optional_installation_id=args.installation_id,
+        optional_tariff_file_path=args.tariff_file,
+        use_chargehistory_index=args.chargehistory_index,
+        optional_period_usage_intervals=make_period_usage_intervals_from_args(args),
+        combined_workbook=args.combined_workbook,
+        export_format=args.export_format,
+        optional_locale=get_locale_from_args(args))
+
+    report_metrics(args)
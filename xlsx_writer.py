@@ -0,0 +1,83 @@
+import xlsxwriter
+
+import pandas as pd
+
+from datetime import date, datetime
+from decimal import Decimal
+
+
+# The same formatting as pandas.DataFrame.to_excel().
+DATETIME_NUMBER_FORMAT = 'YYYY-MM-DD HH:MM:SS'
+DATE_NUMBER_FORMAT = 'YYYY-MM-DD'
+HEADER_FORMAT = {'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'}
+
+COLUMN_WIDTH_MARGIN = 2
+
+
+class StreamingXlsxWriter:
+    # Writes .xlsx sheets row by row in XlsxWriter's constant memory mode, so that the memory used doesn't
+    # grow with the number of rows. The column widths are computed from the longest text written to each
+    # column, which XlsxWriter allows setting after the rows were written.
+    def __init__(self, file_name: str):
+        self.workbook = xlsxwriter.Workbook(file_name, {'constant_memory': True})
+        self.header_format = self.workbook.add_format(HEADER_FORMAT)
+        self.datetime_format = self.workbook.add_format({'num_format': DATETIME_NUMBER_FORMAT})
+        self.date_format = self.workbook.add_format({'num_format': DATE_NUMBER_FORMAT})
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.workbook.close()
+
+
+    def _to_cell_values(self, column: pd.Series) -> list:
+        if pd.api.types.is_datetime64_any_dtype(column.dtype):
+            if column.dt.tz is not None:
+                column = column.dt.tz_localize(None)
+            return [None if pd.isna(d) else d.to_pydatetime() for d in column.astype(object)]
+        # Like pandas, write Decimals as their exact text, and empty texts, e.g. the device name of the total of a
+        # summary, as blank cells.
+        return [str(v) if isinstance(v, Decimal) else None if v is None or v is pd.NaT or v == '' else v for v in column]
+
+
+    def write_sheet(self, sheet_name: str, df: pd.DataFrame, num_index_columns: int = 0) -> None:
+        # The first num_index_columns columns are formatted like the header, like pandas does for the index.
+        worksheet = self.workbook.add_worksheet(sheet_name)
+
+        max_text_lengths = []
+        for column_index, column_name in enumerate(df.columns):
+            worksheet.write(0, column_index, column_name, self.header_format)
+            max_text_lengths.append(len(str(column_name)))
+
+        columns = [self._to_cell_values(df.iloc[:, column_index]) for column_index in range(len(df.columns))]
+        datetime_text_length = len(DATETIME_NUMBER_FORMAT)
+        for row_index, row in enumerate(zip(*columns), start=1):
+            for column_index, v in enumerate(row):
+                if v is None:
+                    if column_index < num_index_columns:
+                        worksheet.write_blank(row_index, column_index, None, self.header_format)
+                    continue
+
+                if isinstance(v, str):
+                    text_length = len(v)
+                    worksheet.write_string(
+                        row_index, column_index, v, self.header_format if column_index < num_index_columns else None)
+                elif isinstance(v, date) and not isinstance(v, datetime):
+                    text_length = len(DATE_NUMBER_FORMAT)
+                    worksheet.write_datetime(row_index, column_index, v, self.date_format)
+                elif hasattr(v, 'strftime'):
+                    text_length = datetime_text_length
+                    worksheet.write_datetime(row_index, column_index, v, self.datetime_format)
+                else:
+                    text_length = len(str(v))
+                    worksheet.write(
+                        row_index, column_index, v, self.header_format if column_index < num_index_columns else None)
+
+                if max_text_lengths[column_index] < text_length:
+                    max_text_lengths[column_index] = text_length
+
+        for column_index, max_text_length in enumerate(max_text_lengths):
+            worksheet.set_column(column_index, column_index, max_text_length + COLUMN_WIDTH_MARGIN)
@@ -0,0 +1,221 @@
+import random
+import re
+import requests
+import threading
+import time
+
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from http import HTTPStatus
+from multiprocessing.managers import BaseManager
+from requests.adapters import HTTPAdapter
+
+from metrics import METRICS
+
+
+ZAPTEC_API_BASE_URL = 'https://api.zaptec.com'
+
+DEFAULT_RATE_LIMIT_CALLS = 900
+DEFAULT_RATE_LIMIT_PERIOD_SECONDS = 60
+
+RETRY_STATUS_CODES = frozenset([
+    HTTPStatus.TOO_MANY_REQUESTS,
+    HTTPStatus.INTERNAL_SERVER_ERROR,
+    HTTPStatus.BAD_GATEWAY,
+    HTTPStatus.SERVICE_UNAVAILABLE,
+    HTTPStatus.GATEWAY_TIMEOUT,
+])
+
+
+def _parse_retry_after_seconds(retry_after: str) -> float | None:
+    # Retry-After is either a number of seconds or an HTTP date.
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    # A sliding window rate limiter shared by all the threads that use it. The limit starts at the
+    # documented 900 calls per minute, and is then updated from the rate limit headers of the API
+    # responses, when the server reports them.
+    LIMIT_HEADER = 'X-RateLimit-Limit'
+    REMAINING_HEADER = 'X-RateLimit-Remaining'
+    RESET_HEADER = 'X-RateLimit-Reset'
+
+    def __init__(
+            self,
+            calls: int = DEFAULT_RATE_LIMIT_CALLS,
+            period_seconds: float = DEFAULT_RATE_LIMIT_PERIOD_SECONDS):
+        assert calls > 0, 'the rate limit calls need to be > 0, but they were: %d.' % (calls,)
+        assert period_seconds > 0, 'the rate limit period needs to be > 0, but it was: %s.' % (period_seconds,)
+
+        self.calls = calls
+        self.period_seconds = period_seconds
+        self.blocked_until = 0.0
+        self.call_times = deque()
+        self.num_sleeps = 0
+        self.sleep_seconds = 0.0
+        self.lock = threading.Lock()
+
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while len(self.call_times) > 0 and self.call_times[0] <= now - self.period_seconds:
+                    self.call_times.popleft()
+
+                if now < self.blocked_until:
+                    wait_seconds = self.blocked_until - now
+                elif len(self.call_times) < self.calls:
+                    self.call_times.append(now)
+                    return
+                else:
+                    wait_seconds = self.call_times[0] + self.period_seconds - now
+                self.num_sleeps += 1
+                self.sleep_seconds += wait_seconds
+            METRICS.increment('rate_limit_sleeps')
+            METRICS.increment('rate_limit_sleep_seconds', wait_seconds)
+            time.sleep(wait_seconds)
+
+
+    def get_sleep_counters(self) -> tuple[int, float]:
+        # The number and the total seconds of the sleeps of all the users of the rate limiter. With a
+        # RateLimiterManager, they sleep in the manager process, whose METRICS nobody reports.
+        with self.lock:
+            return self.num_sleeps, self.sleep_seconds
+
+
+    def block_for(self, seconds: float) -> None:
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+    def update_from_headers(self, headers) -> None:
+        # E.g. 'X-RateLimit-Limit: 900' or, in the IETF draft format, 'X-RateLimit-Limit: 900;w=60'.
+        limit_match = re.match(r'\s*(\d+)(?:\s*;\s*w=(\d+))?', headers.get(RateLimiter.LIMIT_HEADER, ''))
+        if limit_match is not None and int(limit_match.group(1)) > 0:
+            with self.lock:
+                self.calls = int(limit_match.group(1))
+                if limit_match.group(2) is not None and int(limit_match.group(2)) > 0:
+                    self.period_seconds = int(limit_match.group(2))
+
+        remaining = headers.get(RateLimiter.REMAINING_HEADER, '').strip()
+        reset = headers.get(RateLimiter.RESET_HEADER, '').strip()
+        if remaining == '0' and re.fullmatch(r'\d+(\.\d+)?', reset) is not None:
+            # The reset is either the number of seconds until the window resets or a Unix timestamp.
+            reset_seconds = float(reset)
+            if reset_seconds > time.time() / 2:
+                reset_seconds -= time.time()
+            self.block_for(max(0.0, reset_seconds))
+
+
+class RateLimiterManager(BaseManager):
+    # Serves RateLimiter instances from a separate process, so that clients in several processes share
+    # one rate limit: RateLimiterManager().RateLimiter() returns a proxy that can be passed to ZaptecClient
+    # in any process, and each proxy call runs in its own thread of the manager process.
+    pass
+
+
+RateLimiterManager.register('RateLimiter', RateLimiter)
+
+
+class ZaptecClient:
+    def __init__(
+            self,
+            base_url: str = ZAPTEC_API_BASE_URL,
+            pool_size: int = 10,
+            max_retries: int = 5,
+            backoff_factor_seconds: float = 0.5,
+            max_backoff_seconds: float = 60,
+            timeout_seconds: float = 60,
+            rate_limiter: RateLimiter | None = None):
+        assert max_retries >= 0, 'the maximum number of retries needs to be >= 0, but it was: %d.' % (max_retries,)
+
+        self.base_url = base_url.rstrip('/')
+        self.max_retries = max_retries
+        self.backoff_factor_seconds = backoff_factor_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.timeout_seconds = timeout_seconds
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.num_requests = 0
+        self.num_requests_lock = threading.Lock()
+
+        # Keep-alive connections are reused across requests and threads.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+
+    def close(self) -> None:
+        self.session.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    def _compute_backoff_seconds(self, attempt: int, optional_response: requests.Response | None) -> float:
+        # Exponential backoff with full jitter, but never shorter than what the server asked for.
+        backoff_seconds = random.uniform(
+            0, min(self.max_backoff_seconds, self.backoff_factor_seconds * 2 ** attempt))
+        if optional_response is not None and 'Retry-After' in optional_response.headers:
+            retry_after_seconds = _parse_retry_after_seconds(optional_response.headers['Retry-After'])
+            if retry_after_seconds is not None:
+                backoff_seconds = max(backoff_seconds, retry_after_seconds)
+        return backoff_seconds
+
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        url = self.base_url + path
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            with self.num_requests_lock:
+                self.num_requests += 1
+            METRICS.increment('http_requests')
+            try:
+                response = self.session.request(method, url, timeout=self.timeout_seconds, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                backoff_seconds = self._compute_backoff_seconds(attempt, None)
+                METRICS.increment('http_retries')
+                METRICS.increment('http_retry_sleep_seconds', backoff_seconds)
+                time.sleep(backoff_seconds)
+                continue
+
+            METRICS.increment('http_response_bytes', len(response.content))
+            self.rate_limiter.update_from_headers(response.headers)
+            if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                break
+
+            backoff_seconds = self._compute_backoff_seconds(attempt, response)
+            if response.status_code == HTTPStatus.TOO_MANY_REQUESTS:
+                # Throttling applies to every thread, not only this one.
+                self.rate_limiter.block_for(backoff_seconds)
+            METRICS.increment('http_retries')
+            METRICS.increment('http_retry_sleep_seconds', backoff_seconds)
+            time.sleep(backoff_seconds)
+
+        assert response.status_code == HTTPStatus.OK,\
+            'expected the %s %s response status code to be 200 (OK), but it was: %d.' % (method, path, response.status_code)
+        return response
+
+
+    def get_json(self, path: str, **kwargs):
+        return self.request('GET', path, **kwargs).json()
+
+
+    def post_json(self, path: str, **kwargs):
+        return self.request('POST', path, **kwargs).json()